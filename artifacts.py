@@ -0,0 +1,225 @@
+"""
+Storage of the JSON artifacts saved next to the activities.
+
+gcexport.py saves the JSON responses it uses (user stats, activity lists, device details, heart
+rate zones, samples, gear, ...) in the export directory. They can be stored compressed (option
+'--compress-json'):
+
+- 'none': plain '.json' files
+- 'gzip': '.json.gz' files
+- 'zstd': '.json.zst' files (needs the 'zstandard' package)
+
+With option '--bundle-json' the artifacts of the single activities (zones, samples, gear) are
+moved into one ZIP archive per month ('json-YYYY-MM.zip') at the end of a run; until then they
+are separate files, so an interrupted run loses nothing. ArtifactStore.read finds an artifact in
+any of these forms, whatever the current options are.
+"""
+
+import contextlib
+import fnmatch
+import os
+import re
+import threading
+
+from fileio import atomic_writer
+
+# compression -> extension appended to the name of the artifact
+COMPRESSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# the artifacts of single activities, which are bundled per month
+BUNDLED_PATTERN = re.compile(r'^activity_(\d+)(?:_zones|_samples|-gear)\.json(?:\.gz|\.zst)?$')
+BUNDLE_PATTERN = re.compile(r'^json-(\d{4}-\d{2})\.zip$')
+
+
+def zstd_available():
+    """True if the 'zstandard' package is installed"""
+    import importlib.util  # pylint: disable=import-outside-toplevel
+
+    return importlib.util.find_spec('zstandard') is not None
+
+
+def _zstandard():
+    try:
+        import zstandard  # pylint: disable=import-outside-toplevel
+    except ImportError as ex:
+        raise ImportError("Artifacts compressed with zstd need the 'zstandard' package (pip install zstandard)") from ex
+    return zstandard
+
+
+def artifact_name(stored_name):
+    """The name of an artifact, without the compression extension of the stored file"""
+    for extension in COMPRESSIONS.values():
+        if extension and stored_name.endswith(extension):
+            return stored_name[: -len(extension)]
+    return stored_name
+
+
+def decompress(data, stored_name):
+    """The content of an artifact, decompressed according to the extension of its stored name"""
+    if stored_name.endswith('.gz'):
+        import gzip  # pylint: disable=import-outside-toplevel
+
+        return gzip.decompress(data)
+    if stored_name.endswith('.zst'):
+        # the frames written by 'stream_writer' don't contain the content size
+        return _zstandard().ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+class ArtifactStore:
+    """Writes and reads the JSON artifacts in the configured form"""
+
+    def __init__(self, compression='none'):
+        """
+        :param compression: one of COMPRESSIONS
+        """
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'Unsupported compression: {compression}')
+        self.compression = compression
+        # start month ('YYYY-MM') of the activities seen in this run, see 'bundle'
+        self.months = {}
+        self._bundles = {}
+        self._lock = threading.Lock()
+
+    def stored_name(self, filename):
+        """The name under which an artifact is written"""
+        return filename + COMPRESSIONS[self.compression]
+
+    @contextlib.contextmanager
+    def writer(self, filename, file_time=None, sync=None):
+        """
+        Binary file for writing an artifact (uncompressed data), atomically like fileio.atomic_writer
+
+        :param filename:  name of the artifact, e.g. '.../activity_1_zones.json'
+        :param file_time: if given use as timestamp for the file written (in seconds since 1970-01-01)
+        :param sync:      FileSync applying the sync policy, None for no syncing
+        """
+        # atomic_writer removes the temporary file if the block fails
+        # pylint: disable-next=contextmanager-generator-missing-cleanup
+        with atomic_writer(self.stored_name(filename), file_time, sync) as stored_file:
+            if self.compression == 'gzip':
+                import gzip  # pylint: disable=import-outside-toplevel
+
+                with gzip.GzipFile(os.path.basename(filename), 'wb', fileobj=stored_file, mtime=0) as compressed_file:
+                    yield compressed_file
+            elif self.compression == 'zstd':
+                with _zstandard().ZstdCompressor().stream_writer(stored_file, closefd=False) as compressed_file:
+                    yield compressed_file
+            else:
+                yield stored_file
+
+    def encode(self, data):
+        """The stored form of the content of an artifact, for storing it elsewhere than in a file (see packfile.py)"""
+        if self.compression == 'gzip':
+            import gzip  # pylint: disable=import-outside-toplevel
+
+            return gzip.compress(data, mtime=0)
+        if self.compression == 'zstd':
+            return _zstandard().ZstdCompressor().compress(data)
+        return data
+
+    def write(self, filename, data, file_time=None, sync=None):
+        """
+        Write an artifact
+
+        :param data: content (bytes-like)
+        :return:     the name of the file written
+        """
+        with self.writer(filename, file_time, sync) as artifact_file:
+            artifact_file.write(data)
+        return self.stored_name(filename)
+
+    def _bundle_index(self, directory):
+        """dict stored name -> ZIP archive, for the bundles in 'directory'"""
+        with self._lock:
+            if directory not in self._bundles:
+                import zipfile  # pylint: disable=import-outside-toplevel
+
+                index = {}
+                for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+                    if BUNDLE_PATTERN.match(name):
+                        with zipfile.ZipFile(os.path.join(directory, name)) as bundle:
+                            index.update((member, os.path.join(directory, name)) for member in bundle.namelist())
+                self._bundles[directory] = index
+            return self._bundles[directory]
+
+    def read(self, filename):
+        """
+        The content of an artifact, from a plain or compressed file or from a bundle
+
+        :param filename: name of the artifact, e.g. '.../activity_1_zones.json'
+        :return:         content (bytes)
+        :raise FileNotFoundError: if the artifact doesn't exist in any form
+        """
+        # the configured form first, it is the most recent one
+        extensions = sorted(COMPRESSIONS.values(), key=lambda extension: extension != COMPRESSIONS[self.compression])
+        for extension in extensions:
+            try:
+                with open(filename + extension, 'rb') as stored_file:
+                    return decompress(stored_file.read(), extension)
+            except FileNotFoundError:
+                pass
+        directory, name = os.path.split(filename)
+        if BUNDLED_PATTERN.match(name):
+            index = self._bundle_index(directory)
+            for extension in extensions:
+                if name + extension in index:
+                    import zipfile  # pylint: disable=import-outside-toplevel
+
+                    with zipfile.ZipFile(index[name + extension]) as bundle:
+                        return decompress(bundle.read(name + extension), extension)
+        raise FileNotFoundError(f'No artifact {filename}')
+
+    def names(self, directory, pattern):
+        """
+        The artifacts in a directory (in any form) matching a pattern
+
+        :param pattern: glob pattern for the name of the artifact, e.g. 'activities-*.json'
+        :return:        sorted list of artifact names (with the directory, without the compression extension)
+        """
+        stored = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+        stored.update(self._bundle_index(directory))
+        names = {artifact_name(name) for name in stored}
+        return sorted(os.path.join(directory, name) for name in names if fnmatch.fnmatchcase(name, pattern))
+
+    def set_month(self, activity_id, time_local):
+        """Remember the start month of an activity (for 'bundle'), 'time_local' in ISO format"""
+        self.months[str(activity_id)] = time_local[:7]
+
+    def bundle(self, directory, sync=None):
+        """
+        Move the artifacts of the activities seen in this run (see 'set_month') into the bundles of
+        their months; each bundle is rewritten atomically before the files are removed
+
+        :param directory: the directory with the artifacts
+        :param sync:      FileSync applying the sync policy, None for no syncing
+        :return:          list of the files moved into bundles
+        """
+        import zipfile  # pylint: disable=import-outside-toplevel
+
+        loose = {}
+        for name in sorted(os.listdir(directory)):
+            match = BUNDLED_PATTERN.match(name)
+            if match and match.group(1) in self.months:
+                loose.setdefault(self.months[match.group(1)], []).append(name)
+
+        moved = []
+        for month, names in sorted(loose.items()):
+            bundle_name = os.path.join(directory, f'json-{month}.zip')
+            # a new version of an artifact replaces the old one, also if it is compressed differently
+            replaced = {artifact_name(name) for name in names}
+            with atomic_writer(bundle_name, sync=sync) as bundle_file, zipfile.ZipFile(bundle_file, 'w') as bundle:
+                if os.path.isfile(bundle_name):
+                    with zipfile.ZipFile(bundle_name) as old_bundle:
+                        for info in old_bundle.infolist():
+                            if artifact_name(info.filename) not in replaced:
+                                bundle.writestr(info, old_bundle.read(info))
+                for name in names:
+                    compress_type = zipfile.ZIP_DEFLATED if name.endswith('.json') else zipfile.ZIP_STORED
+                    bundle.write(os.path.join(directory, name), name, compress_type)
+            for name in names:
+                os.remove(os.path.join(directory, name))
+                moved.append(os.path.join(directory, name))
+        with self._lock:
+            self._bundles.pop(directory, None)
+        return moved
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for artifacts.py; Call them with this command line:
+
+py.test artifacts_test.py
+"""
+
+import os
+
+import pytest
+
+from artifacts import ArtifactStore
+
+
+def test_compressed_artifacts(tmp_path):
+    with open('json/activity_2541953812_zones.json', 'rb') as json_file:
+        zones = json_file.read()
+    filename = str(tmp_path / 'activity_2541953812_zones.json')
+
+    store = ArtifactStore('gzip')
+    assert store.write(filename, zones) == filename + '.gz'
+    assert os.listdir(str(tmp_path)) == ['activity_2541953812_zones.json.gz']
+    assert os.path.getsize(filename + '.gz') < len(zones)
+    # transparent reading, also with other options
+    assert store.read(filename) == ArtifactStore().read(filename) == zones
+
+    with pytest.raises(FileNotFoundError):
+        store.read(str(tmp_path / 'activity_1_zones.json'))
+
+
+def test_zstd_artifacts(tmp_path):
+    pytest.importorskip('zstandard')
+    filename = str(tmp_path / 'userstats.json')
+    with ArtifactStore('zstd').writer(filename) as artifact_file:
+        artifact_file.write(b'{"userMetrics": ')
+        artifact_file.write(b'[]}')
+    assert os.listdir(str(tmp_path)) == ['userstats.json.zst']
+    assert ArtifactStore().read(filename) == b'{"userMetrics": []}'
+
+
+def test_bundle(tmp_path):
+    directory = str(tmp_path)
+    store = ArtifactStore('gzip')
+    store.write(os.path.join(directory, 'activity_1_zones.json'), b'[1]')
+    store.write(os.path.join(directory, 'activity_1_samples.json'), b'{"metricsCount": 1}')
+    store.write(os.path.join(directory, 'activity_2_zones.json'), b'[2]')
+    store.write(os.path.join(directory, 'activity_3_zones.json'), b'[3]')
+    store.write(os.path.join(directory, 'activities-1-3.json'), b'[]')
+    store.set_month(1, '2018-03-08 12:23:22')
+    store.set_month(2, '2018-04-01 07:00:00')
+
+    moved = store.bundle(directory)
+    assert len(moved) == 3
+    # activity 3 wasn't seen in this run, the activity lists are never bundled
+    assert sorted(os.listdir(directory)) == [
+        'activities-1-3.json.gz',
+        'activity_3_zones.json.gz',
+        'json-2018-03.zip',
+        'json-2018-04.zip',
+    ]
+    assert store.read(os.path.join(directory, 'activity_1_samples.json')) == b'{"metricsCount": 1}'
+    assert store.names(directory, 'activity_*_zones.json') == [
+        os.path.join(directory, f'activity_{activity_id}_zones.json') for activity_id in (1, 2, 3)
+    ]
+
+    # a new version replaces the bundled one, also if it is compressed differently
+    ArtifactStore().write(os.path.join(directory, 'activity_1_zones.json'), b'[1, 1]')
+    store.bundle(directory)
+    assert sorted(os.listdir(directory))[-2:] == ['json-2018-03.zip', 'json-2018-04.zip']
+    assert store.read(os.path.join(directory, 'activity_1_zones.json')) == b'[1, 1]'
+    assert store.read(os.path.join(directory, 'activity_1_samples.json')) == b'{"metricsCount": 1}'
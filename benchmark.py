@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark for gcexport.py, using a local stand-in for Garmin Connect.
+
+The stand-in server serves the recorded fixtures from the 'json' and 'test_output'
+directories (cloned to the requested number of activities), optionally with added
+latency, errors and throttling. gcexport.main() is then run end to end against it,
+and throughput, request counts, latency percentiles and peak memory are reported.
+
+Usage example (compare the JSON reports of two commits):
+
+    python benchmark.py --activities 200 --latency 20 --json bench_output.json
+"""
+
+# Standard library imports
+import argparse
+import contextlib
+import copy
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import urlopen
+
+# Local application/library specific imports
+import gcexport
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+FIXTURES_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# all URL constants of gcexport.py pointing to Garmin Connect
+URL_NAMES = [name for name in dir(gcexport) if name.startswith('URL_GC_')]
+
+STATS_PATH = '/__benchmark_stats'
+
+
+def _fixture(*path):
+    """Read a file from the repository as bytes"""
+    with open(os.path.join(FIXTURES_DIR, *path), 'rb') as fixture:
+        return fixture.read()
+
+
+class Fixtures:  # pylint: disable=too-many-instance-attributes
+    """The recorded responses, prepared for serving an arbitrary number of activities"""
+
+    def __init__(self, activity_count, device_count):
+        self.activity_count = activity_count
+        self.device_count = device_count
+        self.summary = json.loads(_fixture('json', 'activitylist-service.json'))[0]
+        self.details = json.loads(_fixture('json', 'activity_2541953812.json'))
+        self.zones = _fixture('json', 'activity_2541953812_zones.json')
+        self.device = _fixture('json', 'device_856399.json')
+        self.activity_types = _fixture('json', 'activity_types.properties')
+        self.event_types = _fixture('json', 'event_types.properties')
+        self.gpx = _fixture('test_output', 'activity_20190519532.gpx')
+        userstats = json.loads(_fixture('json', 'userstats.json'))
+        userstats['userMetrics'][0]['totalActivities'] = activity_count
+        self.userstats = json.dumps(userstats).encode()
+
+        # the recorded samples use an older wrapper format, serve them as the current endpoint does
+        legacy = json.loads(_fixture('json', 'activity_2541953812_samples.json'))
+        legacy = legacy['com.garmin.activity.details.json.ActivityDetails']
+        self.samples = json.dumps(
+            {
+                'activityId': legacy['activityId'],
+                'measurementCount': legacy['measurementCount'],
+                'metricsCount': legacy['metricsCount'],
+                'metricDescriptors': [
+                    {'metricsIndex': m['metricsIndex'], 'key': m['key'], 'unit': {'key': m['unit']}} for m in legacy['measurements']
+                ],
+                'activityDetailMetrics': legacy['metrics'],
+                'detailsAvailable': legacy['detailsAvailable'],
+            }
+        ).encode()
+
+        fit_name = sorted(n for n in os.listdir(os.path.join(FIXTURES_DIR, 'latest_activities')) if n.endswith('.fit'))[0]
+        self.fit = _fixture('latest_activities', fit_name)
+
+    def activity_id(self, index):
+        """Synthetic activity ID for the activity with the given (zero-based) index"""
+        return self.summary['activityId'] + index
+
+    def device_id(self, activity_id):
+        """Synthetic device installation ID, cycling through 'device_count' devices"""
+        return self.details['metadataDTO']['deviceApplicationInstallationId'] + (activity_id % self.device_count)
+
+    def activity_list(self, start, limit, start_date=None, end_date=None):
+        """A page of the activity list, newest activity first, one activity per day (optionally between two dates)"""
+        page = []
+        begin = datetime.fromisoformat(self.summary['startTimeLocal'])
+        offset = datetime.fromisoformat(self.summary['startTimeLocal']) - datetime.fromisoformat(self.summary['startTimeGMT'])
+        # the activities of the date range: the newest has index 'first', the oldest 'end' - 1
+        first = max(0, (begin.date() - datetime.fromisoformat(end_date).date()).days) if end_date else 0
+        end = self.activity_count
+        if start_date:
+            end = min(end, (begin.date() - datetime.fromisoformat(start_date).date()).days + 1)
+        for index in range(first + start, min(first + start + limit, end)):
+            summary = copy.deepcopy(self.summary)
+            local = begin - timedelta(days=index)
+            summary['activityId'] = self.activity_id(index)
+            summary['startTimeLocal'] = local.strftime('%Y-%m-%d %H:%M:%S')
+            summary['startTimeGMT'] = (local - offset).strftime('%Y-%m-%d %H:%M:%S')
+            summary['beginTimestamp'] = int((local - offset).replace(tzinfo=timezone.utc).timestamp() * 1000)
+            page.append(summary)
+        return json.dumps(page).encode()
+
+    def original(self, activity_id):
+        """The recorded FIT file, zipped as the download service does"""
+        zip_buffer = io.BytesIO()
+        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_obj:
+            zip_obj.writestr(f'{activity_id}_ACTIVITY.fit', self.fit)
+        return zip_buffer.getvalue()
+
+    def activity_details(self, activity_id):
+        """The recorded activity details, with the activity and device IDs replaced"""
+        details = copy.deepcopy(self.details)
+        details['activityId'] = activity_id
+        details['metadataDTO']['deviceApplicationInstallationId'] = self.device_id(activity_id)
+        return json.dumps(details).encode()
+
+
+class FaultInjection:
+    """Latency, errors and throttling added by the stand-in server"""
+
+    def __init__(self, latency_ms, jitter_ms, error_rate, throttle_rps, seed):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.interval = 1 / throttle_rps if throttle_rps else 0
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def delay(self):
+        """Sleep for the configured latency, and longer if the request rate exceeds the throttle"""
+        with self.lock:
+            wait = self.latency + self.random.uniform(0, self.jitter)
+            if self.interval:
+                now = time.monotonic()
+                self.next_slot = max(self.next_slot, now) + self.interval
+                wait = max(wait, self.next_slot - now)
+        time.sleep(wait)
+
+    def fail(self):
+        """True if this request should fail"""
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+
+def make_handler(fixtures, faults):
+    """Create the request handler class serving 'fixtures' with the given 'faults'"""
+    paths = {name: urlsplit(getattr(gcexport, name)).path for name in URL_NAMES}
+    counters = {'requests': 0, 'errors': 0, 'bytes': 0}
+    counters_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        """Routes the gcexport.py requests to the fixtures"""
+
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            pass
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """Serve a GET request"""
+            url = urlsplit(self.path)
+            if url.path == STATS_PATH:
+                with counters_lock:
+                    self.reply(200, json.dumps(counters).encode())
+                return
+
+            faults.delay()
+            # errors only for the endpoints where gcexport.py retries: activity details and data files
+            retried = url.path.startswith('/download-service/') or (
+                url.path.startswith(paths['URL_GC_ACTIVITY']) and url.path[len(paths['URL_GC_ACTIVITY']) :].isdigit()
+            )
+            status, body = (500, b'') if retried and faults.fail() else self.route(url)
+            headers = {}
+            if url.path in (paths['URL_GC_ACT_PROPS'], paths['URL_GC_EVT_PROPS']):
+                # the property files support conditional requests, like the real server
+                headers['ETag'] = '"' + hashlib.sha1(body).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == headers['ETag']:
+                    status, body = 304, b''
+            with counters_lock:
+                counters['requests'] += 1
+                counters['errors'] += status >= 400 and status != 304
+                counters['bytes'] += len(body)
+            self.reply(status, body, headers)
+
+        def route(self, url):  # pylint: disable=too-many-return-statements
+            """Return (status, body) for the requested URL"""
+            path = url.path
+            query = parse_qs(url.query)
+            tail = path.rsplit('/', 1)[-1]
+            if path == paths['URL_GC_USER']:
+                return 200, b'{"displayName": "benchmark"}'
+            if path.startswith(paths['URL_GC_USERSTATS']):
+                return 200, fixtures.userstats
+            if path == paths['URL_GC_LIST']:
+                return 200, fixtures.activity_list(
+                    int(query['start'][0]),
+                    int(query['limit'][0]),
+                    query.get('startDate', [None])[0],
+                    query.get('endDate', [None])[0],
+                )
+            if path == paths['URL_GC_ACT_PROPS']:
+                return 200, fixtures.activity_types
+            if path == paths['URL_GC_EVT_PROPS']:
+                return 200, fixtures.event_types
+            if path.startswith(paths['URL_GC_DEVICE']):
+                return 200, fixtures.device
+            if path == paths['URL_GC_GEAR']:
+                return 200, b'[]'
+            if path.startswith(paths['URL_GC_GPX_ACTIVITY']) or path.startswith(paths['URL_GC_TCX_ACTIVITY']):
+                # no TCX fixture: the benchmark only cares about the payload size
+                return 200, fixtures.gpx
+            if path.startswith(paths['URL_GC_ORIGINAL_ACTIVITY']):
+                return 200, fixtures.original(int(tail))
+            if path.startswith(paths['URL_GC_ACTIVITY']):
+                parts = path[len(paths['URL_GC_ACTIVITY']) :].split('/')
+                if len(parts) == 1 and parts[0].isdigit():
+                    return 200, fixtures.activity_details(int(parts[0]))
+                if parts[-1] == 'hrTimeInZones':
+                    return 200, fixtures.zones
+                if parts[-1] == 'details':
+                    return 200, fixtures.samples
+            return 404, f'no fixture for {tail}'.encode()
+
+        def reply(self, status, body, headers=None):
+            """Send the response"""
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+def serve(port_queue, options):
+    """Run the stand-in server (target of the server process)"""
+    fixtures = Fixtures(options.activities, options.devices)
+    faults = FaultInjection(options.latency, options.jitter, options.error_rate, options.throttle, options.seed)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(fixtures, faults))
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB, None if unknown"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+
+
+def git_revision():
+    """Current git commit (for comparing reports across commits), None outside of a git checkout"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=FIXTURES_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_export(base_url, options, export_argv):
+    """
+    Run gcexport.main() against the stand-in server at 'base_url'
+
+    :return: tuple (elapsed seconds, list of per-request latencies in seconds)
+    """
+    for name in URL_NAMES:
+        setattr(gcexport, name, getattr(gcexport, name).replace(gcexport.GARMIN_BASE_URL, base_url))
+    gcexport.login_to_garmin_connect = lambda args: None
+    # garth is imported lazily by the login, which is skipped here; keep its import out of the measurement
+    import garth  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
+
+    latencies = []
+    original_http_response = gcexport.http_response
+
+    # all requests go through 'http_response', the latency includes reading (and for streamed responses parsing) the body
+    @contextlib.contextmanager
+    def timed_http_response(url, post=None, headers=None, response_headers=None):
+        start = time.perf_counter()
+        try:
+            with original_http_response(url, post, headers, response_headers) as response:
+                yield response
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    gcexport.http_response = timed_http_response
+
+    with tempfile.TemporaryDirectory(prefix='gcexport-benchmark-') as temp_dir:
+        directory = os.path.join(temp_dir, 'export')
+        argv = ['gcexport.py', '--format', options.format, '--directory', directory]
+        # '--shards' exports all activities of its date range
+        if '--shards' not in export_argv:
+            argv += ['--count', str(options.activities)]
+        argv += export_argv
+        output = io.StringIO() if not options.show_output else sys.stdout
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(output):
+            gcexport.main(argv)
+        elapsed = time.perf_counter() - start
+    return elapsed, latencies
+
+
+def parse_arguments(argv):
+    """Setup the argument parser and parse the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark gcexport.py against a local Garmin Connect stand-in',
+        epilog='Arguments after "--" are passed to gcexport.py, e.g. "-- --unzip --subdir {YYYY}"',
+    )
+    # fmt: off
+    parser.add_argument('-n', '--activities', type=int, default=50,
+        help='number of activities to export (default: 50)')
+    parser.add_argument('-f', '--format', choices=['gpx', 'tcx', 'original', 'json'], default='gpx',
+        help="export format (default: 'gpx')")
+    parser.add_argument('--devices', type=int, default=3,
+        help='number of distinct devices used by the activities (default: 3)')
+    parser.add_argument('--latency', type=float, default=0,
+        help='latency added to every response in milliseconds (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0,
+        help='random additional latency of up to this many milliseconds (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0,
+        help='fraction of activity detail and download requests failing with HTTP 500 (default: 0)')
+    parser.add_argument('--throttle', type=float, default=0,
+        help='maximum number of requests per second served, 0 for unlimited (default: 0)')
+    parser.add_argument('--seed', type=int, default=42,
+        help='seed for the random latency and errors (default: 42)')
+    parser.add_argument('--json', metavar='FILE',
+        help='also write the report as JSON to this file')
+    parser.add_argument('--show-output', action='store_true',
+        help='show the console output of gcexport.py')
+    # fmt: on
+    if '--' in argv:
+        split = argv.index('--')
+        return parser.parse_args(argv[1:split]), argv[split + 1 :]
+    return parser.parse_args(argv[1:]), []
+
+
+def main(argv):
+    """
+    Main entry point for benchmark.py
+    """
+    options, export_argv = parse_arguments(argv)
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(port_queue, options), daemon=True)
+    server.start()
+    base_url = f'http://127.0.0.1:{port_queue.get(timeout=30)}'
+
+    try:
+        elapsed, latencies = run_export(base_url, options, export_argv)
+        with urlopen(base_url + STATS_PATH) as response:
+            server_stats = json.loads(response.read())
+    finally:
+        server.terminate()
+
+    report = {
+        'revision': git_revision(),
+        'options': {k: v for k, v in vars(options).items() if k not in ('json', 'show_output')},
+        'export_args': export_argv,
+        'elapsed_s': round(elapsed, 3),
+        'activities_per_s': round(options.activities / elapsed, 2),
+        'requests': server_stats['requests'],
+        'requests_per_activity': round(server_stats['requests'] / options.activities, 2),
+        'errors_injected': server_stats['errors'],
+        'bytes_served': server_stats['bytes'],
+        'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1) if resource else None,
+    }
+
+    for key, value in report.items():
+        print(f'{key:22} {value}')
+    report['endpoints'] = gcexport.STATS.to_dict()['endpoints']
+    if options.json:
+        with open(options.json, 'w', encoding='utf-8') as json_file:
+            json.dump(report, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
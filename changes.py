@@ -0,0 +1,112 @@
+"""
+Change detection for activities edited in Garmin Connect after their export.
+
+An activity is only downloaded once: when its data file exists, a re-run skips it, so a new name,
+description or activity type, or a corrected elevation, never reaches the export. For each
+exported activity a hash of the summary fields the CSV record is built from (SUMMARY_FIELDS, the
+fields 'copy_details_to_summary' of gcexport.py takes from the details) is kept in the state store
+of the export directory (table 'activity_summaries'). With option '--refresh-changed' gcexport.py
+compares the hash of the summary in the activity list with the stored one:
+
+- unchanged: the activity is skipped without any further request
+- changed:   the data file is downloaded again and the CSV row of the activity is replaced
+- unknown (exported before the hashes were kept): skipped as before, the hash is stored
+
+The activity list is fetched anyway, so finding the changed activities costs no requests.
+"""
+
+import json
+import time
+
+# the summary fields compared, nested fields as 'parent.field'; see 'copy_details_to_summary' in gcexport.py
+SUMMARY_FIELDS = (
+    'activityName',
+    'description',
+    'activityType.typeId',
+    'activityType.typeKey',
+    'activityType.parentTypeId',
+    'eventType.typeKey',
+    'startTimeLocal',
+    'startTimeGMT',
+    'duration',
+    'distance',
+    'averageSpeed',
+    'maxHR',
+    'averageHR',
+    'elevationCorrected',
+)
+
+# results of 'ChangeDetector.check'
+NEW = 'new'
+UNCHANGED = 'unchanged'
+CHANGED = 'changed'
+UNKNOWN = 'unknown'
+
+
+def summary_hash(summary):
+    """Hash (hex) of the SUMMARY_FIELDS of an activity summary; missing fields count as None"""
+    # imported here, it is not needed at the start of gcexport.py (see startup_benchmark.py)
+    import hashlib  # pylint: disable=import-outside-toplevel
+
+    values = {}
+    for field in SUMMARY_FIELDS:
+        value = summary
+        for key in field.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+        values[field] = value
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ChangeDetector:
+    """The summary hashes of the exported activities, see the module documentation"""
+
+    def __init__(self, store=None):
+        """
+        :param store: StateStore to keep the hashes in; without one (see 'open') nothing is known or stored
+        """
+        self.store = None
+        # the stored hashes by activity ID, loaded on the first 'check'
+        self._hashes = None
+        # IDs (str) of the activities exported again in this run, see 'check'
+        self.refreshed = set()
+        if store is not None:
+            self.open(store)
+
+    def open(self, store):
+        """Use the hashes in 'store', creating the table if needed"""
+        store.execute('CREATE TABLE IF NOT EXISTS activity_summaries (activity_id INTEGER PRIMARY KEY, hash TEXT, updated REAL)')
+        self.store = store
+        self._hashes = None
+        self.refreshed = set()
+
+    def check(self, summary, exported):
+        """
+        Compare the summary of an activity with the one of its export
+
+        :param summary:  activity summary (from the activity list)
+        :param exported: True if the data file of the activity exists
+        :return:         NEW (not exported), UNCHANGED, CHANGED (remembered in 'refreshed') or UNKNOWN (no stored hash)
+        """
+        if not exported:
+            return NEW
+        if self._hashes is None:
+            # one query instead of one per activity, which would also commit the deferred writes each time
+            self._hashes = dict(self.store.execute('SELECT activity_id, hash FROM activity_summaries')) if self.store else {}
+        stored = self._hashes.get(int(summary['activityId']))
+        if stored is None:
+            return UNKNOWN
+        if stored == summary_hash(summary):
+            return UNCHANGED
+        self.refreshed.add(str(summary['activityId']))
+        return CHANGED
+
+    def record(self, summary):
+        """Store the hash of the summary of an exported activity (a deferred write, see 'StateStore.defer')"""
+        if self.store is not None:
+            activity_hash = summary_hash(summary)
+            self.store.defer(
+                'INSERT OR REPLACE INTO activity_summaries VALUES (?, ?, ?)',
+                (int(summary['activityId']), activity_hash, time.time()),
+            )
+            if self._hashes is not None:
+                self._hashes[int(summary['activityId'])] = activity_hash
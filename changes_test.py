@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for changes.py; Call them with this command line:
+
+py.test changes_test.py
+"""
+
+import copy
+import json
+
+from changes import CHANGED, NEW, UNCHANGED, UNKNOWN, ChangeDetector, summary_hash
+from state import STATE_FILE_NAME, StateStore
+
+
+def test_summary_hash():
+    with open('json/activities-list.json', encoding='utf-8') as json_list:
+        summary = json.load(json_list)[0]
+    edited = copy.deepcopy(summary)
+    assert summary_hash(edited) == summary_hash(summary)
+
+    # fields not compared don't matter
+    edited['calories'] = 4711
+    edited.pop('ownerDisplayName', None)
+    assert summary_hash(edited) == summary_hash(summary)
+
+    for field, value in (('activityName', 'renamed'), ('description', 'edited'), ('elevationCorrected', True)):
+        edited = copy.deepcopy(summary)
+        edited[field] = value
+        assert summary_hash(edited) != summary_hash(summary), field
+    edited = copy.deepcopy(summary)
+    edited['activityType']['typeKey'] = 'hiking'
+    assert summary_hash(edited) != summary_hash(summary)
+
+
+def test_change_detector(tmp_path):
+    store = StateStore(str(tmp_path / STATE_FILE_NAME))
+    detector = ChangeDetector(store)
+    summary = {'activityId': 2541953812, 'activityName': 'Morning run', 'activityType': {'typeKey': 'running'}}
+    assert detector.check(summary, exported=False) == NEW
+    assert detector.check(summary, exported=True) == UNKNOWN
+
+    detector.record(summary)
+    assert detector.check(summary, exported=True) == UNCHANGED
+    renamed = dict(summary, activityName='Evening run')
+    assert detector.check(renamed, exported=True) == CHANGED
+    assert detector.refreshed == {'2541953812'}
+
+    # the hashes are kept between runs (committed at the latest when the store is closed), the refreshed activities not
+    detector.record(renamed)
+    store.close()
+    detector = ChangeDetector(StateStore(str(tmp_path / STATE_FILE_NAME)))
+    assert detector.check(renamed, exported=True) == UNCHANGED
+    assert not detector.refreshed
+
+    # without a state store nothing is known
+    assert ChangeDetector().check(summary, exported=True) == UNKNOWN
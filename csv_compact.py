@@ -0,0 +1,231 @@
+"""
+Helper functions for compacting the 'activities.csv' file written by gcexport.py.
+
+Re-runs append to the CSV file, so after a while it can contain duplicate rows
+(e.g. after deleting data files) and rows out of chronological order. The compaction
+keeps the newest (last appended) row per activity ID and sorts the rows by start time,
+using an external merge sort so that memory usage is bounded by 'chunk_rows' rows,
+regardless of the size of the CSV file.
+
+'replace_rows' puts the rows appended for activities exported again in the place of their old rows.
+"""
+
+import csv
+import heapq
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import groupby
+
+# number of CSV rows held in memory at once while sorting
+CHUNK_ROWS = 20000
+
+
+def _parse_iso(value):
+    """Start time in epoch seconds from an ISO timestamp (naive timestamps are taken as UTC)"""
+    timestamp = datetime.fromisoformat(value.replace(' ', 'T'))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+def _parse_millis(value):
+    """Start time in epoch seconds from milliseconds since 1970-01-01"""
+    return int(value) / 1000
+
+
+# CSV template keys usable for sorting by start time, in order of preference
+TIME_COLUMN_PARSERS = {
+    'startTimeIso': _parse_iso,
+    'startTimeMillis': _parse_millis,
+    'startTimeRaw': _parse_iso,
+}
+
+
+@contextmanager
+def open_csv(csv_filename, id_column):
+    """
+    Open a CSV file written by gcexport.py, reading its header row
+
+    :param csv_filename: path of the CSV file
+    :param id_column:    header name of the activity ID column
+    :return:             context manager yielding a tuple (header, index of the ID column, csv.reader of the rows),
+                         with header None for an empty file
+    :raise ValueError:   if the ID column is missing
+    """
+    with open(csv_filename, 'r', encoding='utf-8', newline='') as csv_in:
+        reader = csv.reader(csv_in)
+        header = next(reader, None)
+        if header is not None and id_column not in header:
+            raise ValueError(f'Column "{id_column}" not found in {csv_filename}')
+        yield header, header.index(id_column) if header else None, reader
+
+
+def _write_run(rows, directory):
+    """Write an already sorted chunk of rows to a temporary run file and return its name"""
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.run', delete=False, encoding='utf-8', newline='') as run:
+        csv.writer(run).writerows(rows)
+        return run.name
+
+
+def _read_run(filename, key_fields):
+    """Read a run file written by '_write_run', converting the leading key fields back"""
+    with open(filename, 'r', encoding='utf-8', newline='') as run:
+        for row in csv.reader(run):
+            yield tuple(convert(row[i]) for i, convert in enumerate(key_fields)) + tuple(row[len(key_fields) :])
+
+
+def _external_sort(rows, key_fields, directory, chunk_rows, reverse=False):
+    """
+    Sort an iterable of tuples whose leading fields form the sort key, spilling
+    sorted runs of at most 'chunk_rows' tuples to disk and merging them lazily
+
+    :param rows:       iterable of tuples, the first len(key_fields) elements are the sort key
+    :param key_fields: list of conversion functions to restore the key fields from the run files
+    :param directory:  directory for the temporary run files
+    :param chunk_rows: maximum number of rows to sort in memory
+    :param reverse:    sort in descending order
+    :return:           generator of the sorted tuples
+    """
+    key_len = len(key_fields)
+    run_files = []
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            chunk.sort(key=lambda r: r[:key_len], reverse=reverse)
+            run_files.append(_write_run(chunk, directory))
+            chunk = []
+    chunk.sort(key=lambda r: r[:key_len], reverse=reverse)
+    runs = [_read_run(name, key_fields) for name in run_files]
+    runs.append(iter(chunk))
+    yield from heapq.merge(*runs, key=lambda r: r[:key_len], reverse=reverse)
+
+
+def compact_csv(csv_filename, id_column, time_columns, chunk_rows=CHUNK_ROWS, newest_first=True):
+    """
+    Rewrite a CSV file keeping only the newest (last) row per activity ID, sorted by start time.
+
+    The file is replaced atomically, so an interrupted compaction leaves the original file intact.
+
+    :param csv_filename: path of the CSV file to compact
+    :param id_column:    header name of the activity ID column
+    :param time_columns: list of (header name, parser) tuples for the start time; the first one present is used,
+                         the parser converts the cell value to epoch seconds
+    :param chunk_rows:   maximum number of rows held in memory
+    :param newest_first: sort order of the rewritten file (a fresh export lists the newest activity first)
+    :return:             tuple (rows read, rows written)
+    """
+    directory = os.path.dirname(os.path.abspath(csv_filename))
+    with open_csv(csv_filename, id_column) as (header, id_index, reader):
+        if header is None:
+            return 0, 0
+        time_index, time_parser = next(
+            ((header.index(name), parser) for name, parser in time_columns if name in header), (None, None)
+        )
+        if time_index is None:
+            logging.warning('No start time column found in %s, sorting by activity ID', csv_filename)
+
+        counts = {'read': 0, 'written': 0}
+
+        def numbered_rows():
+            # key: (activity id, sequence number); rows without an ID are never merged
+            for seq, row in enumerate(reader):
+                counts['read'] += 1
+                activity_id = row[id_index] if id_index < len(row) and row[id_index] else f'#{seq}'
+                yield (activity_id, seq) + tuple(row)
+
+        def newest_per_id(sorted_rows):
+            for _, group in groupby(sorted_rows, key=lambda r: r[0]):
+                *_, last = group
+                yield last[2:]
+
+        def timed_rows(rows):
+            # key: (has start time, start time, numeric activity id)
+            for row in rows:
+                start = None
+                if time_index is not None and time_index < len(row) and row[time_index]:
+                    try:
+                        start = time_parser(row[time_index])
+                    except ValueError:
+                        logging.warning('Unparseable start time "%s" in %s', row[time_index], csv_filename)
+                activity_id = row[id_index] if id_index < len(row) else ''
+                numeric_id = int(activity_id) if activity_id.isdigit() else 0
+                yield (int(start is not None), start or 0.0, numeric_id) + tuple(row)
+
+        with tempfile.TemporaryDirectory(dir=directory, prefix='.compact-') as work_dir:
+            deduplicated = newest_per_id(_external_sort(numbered_rows(), [str, int], work_dir, chunk_rows))
+            ordered = _external_sort(timed_rows(deduplicated), [int, float, int], work_dir, chunk_rows, reverse=newest_first)
+            with tempfile.NamedTemporaryFile(
+                'w', dir=directory, suffix='.csv.tmp', delete=False, encoding='utf-8', newline=''
+            ) as csv_out:
+                try:
+                    writer = csv.writer(csv_out, quoting=csv.QUOTE_ALL)
+                    writer.writerow(header)
+                    for row in ordered:
+                        writer.writerow(row[3:])
+                        counts['written'] += 1
+                    csv_out.flush()
+                    os.fsync(csv_out.fileno())
+                except BaseException:
+                    csv_out.close()
+                    os.remove(csv_out.name)
+                    raise
+
+    os.replace(csv_out.name, csv_filename)
+    logging.info('Compacted %s: %s rows read, %s rows written', csv_filename, counts['read'], counts['written'])
+    return counts['read'], counts['written']
+
+
+def replace_rows(csv_filename, id_column, activity_ids):
+    """
+    Move the newest (last) row of each of the given activities to the place of its first row, removing the others.
+
+    Used for the activities exported again (see changes.py): their new row was appended, the old one keeps its place
+    in the file. Only the rows of 'activity_ids' are held in memory; the file is replaced atomically.
+
+    :param csv_filename: path of the CSV file
+    :param id_column:    header name of the activity ID column
+    :param activity_ids: IDs (as strings) of the activities whose rows to replace
+    :return:             number of rows removed
+    """
+    activity_ids = set(activity_ids)
+    if not activity_ids or not os.path.isfile(csv_filename):
+        return 0
+    newest = {}
+    with open_csv(csv_filename, id_column) as (header, id_index, reader):
+        for row in reader if header else ():
+            if id_index < len(row) and row[id_index] in activity_ids:
+                newest[row[id_index]] = row
+    if not newest:
+        return 0
+
+    removed = 0
+    with open_csv(csv_filename, id_column) as (header, id_index, reader):
+        with tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(os.path.abspath(csv_filename)), suffix='.csv.tmp', delete=False, encoding='utf-8', newline=''
+        ) as csv_out:
+            try:
+                writer = csv.writer(csv_out, quoting=csv.QUOTE_ALL)
+                writer.writerow(header)
+                for row in reader:
+                    activity_id = row[id_index] if id_index < len(row) else None
+                    if activity_id not in newest:
+                        writer.writerow(row)
+                    elif newest[activity_id] is None:
+                        removed += 1
+                    else:
+                        writer.writerow(newest[activity_id])
+                        newest[activity_id] = None
+                csv_out.flush()
+                os.fsync(csv_out.fileno())
+            except BaseException:
+                csv_out.close()
+                os.remove(csv_out.name)
+                raise
+
+    os.replace(csv_out.name, csv_filename)
+    logging.info('Replaced the rows of %s activities in %s, %s rows removed', len(activity_ids), csv_filename, removed)
+    return removed
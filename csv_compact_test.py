@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for csv_compact.py; Call them with this command line:
+
+py.test csv_compact_test.py
+"""
+
+import csv
+import time
+
+from csv_compact import TIME_COLUMN_PARSERS, compact_csv, replace_rows
+
+HEADER = ['Start Time', 'Activity ID', 'Activity Name']
+TIME_COLUMNS = [('Start Time', TIME_COLUMN_PARSERS['startTimeIso'])]
+
+
+def write_csv(filename, rows):
+    with open(filename, 'w', encoding='utf-8', newline='') as csv_file:
+        writer = csv.writer(csv_file, quoting=csv.QUOTE_ALL)
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+
+
+def read_csv(filename):
+    with open(filename, 'r', encoding='utf-8', newline='') as csv_file:
+        return list(csv.reader(csv_file))
+
+
+def test_compact_csv_keeps_newest_row_and_sorts(tmp_path):
+    filename = tmp_path / 'activities.csv'
+    write_csv(
+        filename,
+        [
+            ['2018-03-08T12:23:22+01:00', '2541953812', 'old name'],
+            ['2018-03-06T07:00:00+01:00', '2540000000', 'older activity'],
+            ['2021-04-11T11:50:49+02:00', '6588349056', 'newest activity'],
+            ['2018-03-08T12:23:22+01:00', '2541953812', 'renamed'],
+        ],
+    )
+
+    # a chunk size of 1 forces the use of temporary run files
+    assert compact_csv(filename, 'Activity ID', TIME_COLUMNS, chunk_rows=1) == (4, 3)
+
+    rows = read_csv(filename)
+    assert rows[0] == HEADER
+    assert [row[1] for row in rows[1:]] == ['6588349056', '2541953812', '2540000000']
+    assert rows[2][2] == 'renamed'
+    assert [p.name for p in tmp_path.iterdir()] == ['activities.csv']
+
+
+def test_compact_csv_oldest_first_and_offsets(tmp_path):
+    filename = tmp_path / 'activities.csv'
+    write_csv(
+        filename,
+        [
+            # 10:00+02:00 is earlier than 09:30+00:00
+            ['2020-01-01T09:30:00+00:00', '2', 'b'],
+            ['2020-01-01T10:00:00+02:00', '1', 'a'],
+        ],
+    )
+
+    compact_csv(filename, 'Activity ID', TIME_COLUMNS, newest_first=False)
+
+    assert [row[1] for row in read_csv(filename)[1:]] == ['1', '2']
+
+
+def test_parse_iso_naive_is_utc(monkeypatch):
+    # independent of the local time zone (here one with a DST change)
+    monkeypatch.setenv('TZ', 'Europe/Zurich')
+    time.tzset()
+    try:
+        parse_iso = TIME_COLUMN_PARSERS['startTimeRaw']
+        assert parse_iso('2020-10-25 02:30:00') == parse_iso('2020-10-25T02:30:00+00:00') == 1603593000
+        assert parse_iso('2020-10-25 02:30:00') < parse_iso('2020-10-25 02:40:00')
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_replace_rows(tmp_path):
+    filename = tmp_path / 'activities.csv'
+    write_csv(
+        filename,
+        [
+            ['2021-04-11T11:50:49+02:00', '6588349056', 'newest activity'],
+            ['2018-03-08T12:23:22+01:00', '2541953812', 'old name'],
+            ['2018-03-06T07:00:00+01:00', '2540000000', 'older activity'],
+            ['2018-03-08T12:23:22+01:00', '2541953812', 'renamed'],
+            ['2018-03-06T07:00:00+01:00', '2540000000', 'duplicate, not replaced'],
+        ],
+    )
+
+    assert replace_rows(filename, 'Activity ID', {'2541953812', '1'}) == 1
+
+    rows = read_csv(filename)
+    assert [row[1:] for row in rows[1:]] == [
+        ['6588349056', 'newest activity'],
+        ['2541953812', 'renamed'],
+        ['2540000000', 'older activity'],
+        ['2540000000', 'duplicate, not replaced'],
+    ]
+    assert [p.name for p in tmp_path.iterdir()] == ['activities.csv']
+    assert replace_rows(filename, 'Activity ID', {'1'}) == 0
@@ -33,6 +33,7 @@ def download_latest_activities(count=20, days_back=30):
     
     cmd = [
         'python', 'gcexport.py',
+        '--agent',  # use the session agent if one is running (see session_agent.py)
         '-c', str(count),
         '-f', 'original',
         '-u',  # unzip files
@@ -0,0 +1,291 @@
+"""
+Writing the exported files.
+
+Files are written atomically: the data goes to a temporary file in the target directory,
+which is then renamed, so an interrupted run never leaves a truncated file behind (which
+a later run would take as already downloaded). How hard the data is pushed to the disk
+is chosen with a sync policy (option '--fsync'):
+
+- 'none':  leave it to the operating system (fastest)
+- 'batch': fsync the written files in batches and at the end of the run
+- 'file':  fsync every file before it is renamed (slowest, each file is durable once written)
+
+Whether an activity file already exists is looked up in an index (ActivityFileIndex) built by a
+single scan of the export directory, instead of probing the file system for every activity.
+
+Metadata operations that nothing waits for (setting the file times, renaming and removing the
+files of an unzipped archive) are handed to a background thread (MetadataWriter), so that on
+network file systems their round trips don't add up with the downloads.
+"""
+
+import contextlib
+import itertools
+import logging
+import os
+import queue
+import re
+import threading
+
+FSYNC_POLICIES = ['none', 'batch', 'file']
+
+# number of files written between two fsync rounds with policy 'batch'
+FSYNC_BATCH_FILES = 64
+
+# distinguishes the temporary files of concurrent writers in the same process
+_TEMP_COUNTER = itertools.count()
+
+
+def fsync_path(path):
+    """fsync a file or directory by name (directories can't be synced on Windows, which is ignored)"""
+    try:
+        file_descriptor = os.open(path, os.O_RDONLY)
+    except OSError as ex:
+        logging.debug('Unable to open %s for fsync: %s', path, ex)
+        return
+    try:
+        os.fsync(file_descriptor)
+    except OSError as ex:
+        logging.debug('Unable to fsync %s: %s', path, ex)
+    finally:
+        os.close(file_descriptor)
+
+
+class FileSync:
+    """Applies the sync policy to the written files"""
+
+    def __init__(self, policy='none', batch_files=FSYNC_BATCH_FILES):
+        """
+        :param policy:      one of FSYNC_POLICIES
+        :param batch_files: number of files per fsync round with policy 'batch'
+        """
+        if policy not in FSYNC_POLICIES:
+            raise ValueError(f'Unsupported fsync policy: {policy}')
+        self.policy = policy
+        self.batch_files = batch_files
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def add(self, filename):
+        """Remember a file to be synced with the next 'flush' (whatever the policy)"""
+        with self._lock:
+            self._pending.append(filename)
+            full = len(self._pending) >= self.batch_files
+        if full:
+            self.flush()
+
+    def written(self, filename):
+        """Called after a file has been written (and renamed into place)"""
+        if self.policy == 'batch':
+            self.add(filename)
+        elif self.policy == 'file':
+            fsync_path(os.path.dirname(filename) or '.')
+
+    def flush(self):
+        """fsync the pending files and their directories"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for filename in pending:
+            fsync_path(filename)
+        for directory in sorted({os.path.dirname(filename) or '.' for filename in pending}):
+            fsync_path(directory)
+
+
+# directories known to exist, see 'make_dirs'
+_KNOWN_DIRS = set()
+_KNOWN_DIRS_LOCK = threading.Lock()
+
+
+def make_dirs(directory):
+    """Create a directory (and its parents) unless it was already created or seen by this process"""
+    directory = os.path.normpath(directory)
+    with _KNOWN_DIRS_LOCK:
+        if directory in _KNOWN_DIRS:
+            return
+    os.makedirs(directory, exist_ok=True)
+    with _KNOWN_DIRS_LOCK:
+        _KNOWN_DIRS.add(directory)
+
+
+def forget_dirs():
+    """Forget the directories remembered by 'make_dirs' (they may have been removed since)"""
+    with _KNOWN_DIRS_LOCK:
+        _KNOWN_DIRS.clear()
+
+
+# files named after an activity: data files (optionally with '--fileprefix'), zones, samples and gear JSON
+ACTIVITY_FILE_PATTERN = re.compile(r'^(?:\d{8}-\d{6}-)?activity_(\d+)\D')
+
+
+class ActivityFileIndex:
+    """
+    The activity files in an export directory (including subdirectories), from one scan and kept
+    up to date with 'add' and 'discard'; paths outside the scanned directory (or before the scan)
+    are looked up in the file system
+    """
+
+    def __init__(self):
+        self.root = None
+        self._paths = set()
+        self._by_activity = {}
+        self._lock = threading.Lock()
+
+    def scan(self, root):
+        """
+        Index the activity files below 'root' (replacing the previous index); the directories found
+        are remembered by 'make_dirs'
+        """
+        self.root = os.path.abspath(root)
+        with self._lock:
+            self._paths = set()
+            self._by_activity = {}
+        for directory, _, filenames in os.walk(self.root, followlinks=True):
+            with _KNOWN_DIRS_LOCK:
+                _KNOWN_DIRS.add(os.path.normpath(os.path.join(root, os.path.relpath(directory, self.root))))
+            for filename in filenames:
+                self.add(os.path.join(directory, filename))
+
+    def _key(self, path):
+        """The absolute path and its activity ID, None if the file isn't an indexed activity file"""
+        path = os.path.abspath(path)
+        match = ACTIVITY_FILE_PATTERN.match(os.path.basename(path))
+        if not match or self.root is None or not path.startswith(os.path.join(self.root, '')):
+            return path, None
+        return path, match.group(1)
+
+    def add(self, path):
+        """Record a written activity file"""
+        path, activity_id = self._key(path)
+        if activity_id:
+            with self._lock:
+                self._paths.add(path)
+                self._by_activity.setdefault(activity_id, set()).add(path)
+
+    def discard(self, path):
+        """Record a removed activity file"""
+        path, activity_id = self._key(path)
+        if activity_id:
+            with self._lock:
+                self._paths.discard(path)
+                self._by_activity.get(activity_id, set()).discard(path)
+
+    def exists(self, path):
+        """True if the file exists"""
+        path, activity_id = self._key(path)
+        if not activity_id:
+            return os.path.isfile(path)
+        with self._lock:
+            return path in self._paths
+
+    def find(self, activity_id, extension=None):
+        """
+        The files of an activity
+
+        :param activity_id: ID of the activity (as string)
+        :param extension:   if given only the files with this extension (e.g. '.fit')
+        :return:            sorted list of paths
+        """
+        with self._lock:
+            paths = self._by_activity.get(str(activity_id), set())
+            return sorted(path for path in paths if extension is None or os.path.splitext(path)[1] == extension)
+
+    def files(self):
+        """All indexed files as sorted list of tuples (activity ID, path)"""
+        with self._lock:
+            return sorted((activity_id, path) for activity_id, paths in self._by_activity.items() for path in paths)
+
+
+class MetadataWriter:
+    """
+    Background thread applying metadata operations (utime, rename, remove) in the order they were
+    submitted; 'flush' waits until all submitted operations are done
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.done = 0
+        self.errors = 0
+
+    def _submit(self, operation, *arguments):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='metadata-writer', daemon=True)
+                self._thread.start()
+            self._queue.put((operation, arguments))
+
+    def utime(self, path, file_time):
+        """Set access and modification time of 'path' to 'file_time' (seconds since 1970-01-01)"""
+        self._submit(os.utime, path, (file_time, file_time))
+
+    def rename(self, source, destination):
+        """Rename 'source' to 'destination', replacing an existing file"""
+        self._submit(os.replace, source, destination)
+
+    def remove(self, path):
+        """Remove the file 'path'"""
+        self._submit(os.remove, path)
+
+    def _run(self):
+        while True:
+            operation, arguments = self._queue.get()
+            if operation is None:
+                return
+            try:
+                operation(*arguments)
+                self.done += 1
+            except OSError as ex:
+                self.errors += 1
+                logging.error('%s%s failed: %s', operation.__name__, arguments, ex)
+
+    def flush(self):
+        """Wait until all submitted operations have been applied and stop the thread (until the next operation)"""
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put((None, ()))
+                self._thread.join()
+                self._thread = None
+
+
+@contextlib.contextmanager
+def atomic_writer(filename, file_time=None, sync=None):
+    """
+    Binary file for writing a file atomically: the data goes to a temporary file, which replaces
+    'filename' when the block completes, and is removed if the block fails
+
+    :param filename:  name of the file to write
+    :param file_time: if given use as timestamp for the file written (in seconds since 1970-01-01)
+    :param sync:      FileSync applying the sync policy, None for no syncing
+    """
+    directory, basename = os.path.split(filename)
+    temp_name = os.path.join(directory, f'.{basename}.{os.getpid()}-{next(_TEMP_COUNTER)}.tmp')
+    # os.open (unlike tempfile) creates the file with the permissions given by the umask, like open()
+    file_descriptor = os.open(temp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        with os.fdopen(file_descriptor, 'wb') as temp_file:
+            yield temp_file
+            if sync and sync.policy == 'file':
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+        if file_time:
+            os.utime(temp_name, (file_time, file_time))
+        os.replace(temp_name, filename)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+    if sync:
+        sync.written(filename)
+
+
+def write_atomic(filename, data, file_time=None, sync=None):
+    """
+    Write bytes to a file, atomically replacing an existing file
+
+    :param filename:  name of the file to write
+    :param data:      content (bytes-like), written unchanged
+    :param file_time: if given use as timestamp for the file written (in seconds since 1970-01-01)
+    :param sync:      FileSync applying the sync policy, None for no syncing
+    """
+    with atomic_writer(filename, file_time, sync) as temp_file:
+        temp_file.write(data)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for fileio.py; Call them with this command line:
+
+py.test fileio_test.py
+"""
+
+import os
+
+import pytest
+
+from fileio import ActivityFileIndex, FileSync, MetadataWriter, forget_dirs, make_dirs, write_atomic
+
+
+def test_write_atomic(tmp_path):
+    filename = str(tmp_path / 'activity_1.gpx')
+    write_atomic(filename, b'<gpx/>', file_time=1618134649)
+    write_atomic(filename, 'fēnix'.encode('utf-8'))
+    with open(filename, 'rb') as written:
+        assert written.read() == 'fēnix'.encode('utf-8')
+    assert os.listdir(str(tmp_path)) == ['activity_1.gpx']
+
+    write_atomic(filename, b'<gpx/>', file_time=1618134649)
+    assert os.stat(filename).st_mtime == 1618134649
+
+
+def test_write_atomic_failure_keeps_old_file(tmp_path):
+    filename = str(tmp_path / 'activity_1.json')
+    write_atomic(filename, b'{}')
+    with pytest.raises(TypeError):
+        write_atomic(filename, {'not': 'bytes'})
+    with open(filename, 'rb') as written:
+        assert written.read() == b'{}'
+    assert os.listdir(str(tmp_path)) == ['activity_1.json']
+
+
+def test_write_atomic_honours_umask(tmp_path):
+    filename = str(tmp_path / 'activity_1.json')
+    old_umask = os.umask(0o022)
+    try:
+        write_atomic(filename, b'{}')
+    finally:
+        os.umask(old_umask)
+    assert os.stat(filename).st_mode & 0o777 == 0o644
+
+
+def test_file_sync_batches(tmp_path):
+    sync = FileSync('batch', batch_files=3)
+    for i in range(4):
+        write_atomic(str(tmp_path / f'activity_{i}.gpx'), b'<gpx/>', sync=sync)
+    # the first three were synced as a batch, the fourth waits for the next batch or the final flush
+    assert sync._pending == [str(tmp_path / 'activity_3.gpx')]  # pylint: disable=protected-access
+    sync.flush()
+    assert not sync._pending  # pylint: disable=protected-access
+
+    with pytest.raises(ValueError):
+        FileSync('sometimes')
+
+
+def test_metadata_writer(tmp_path):
+    writer = MetadataWriter()
+    unzipped = str(tmp_path / '2541953812.fit')
+    write_atomic(unzipped, b'FIT')
+    write_atomic(str(tmp_path / 'activity_2541953812.zip'), b'PK')
+    # applied in the order submitted: the time is set on the renamed file
+    writer.rename(unzipped, str(tmp_path / 'activity_2541953812.fit'))
+    writer.utime(str(tmp_path / 'activity_2541953812.fit'), 1520508202)
+    writer.remove(str(tmp_path / 'activity_2541953812.zip'))
+    writer.remove(str(tmp_path / 'missing.zip'))
+    writer.flush()
+    assert os.listdir(str(tmp_path)) == ['activity_2541953812.fit']
+    assert os.stat(tmp_path / 'activity_2541953812.fit').st_mtime == 1520508202
+    assert (writer.done, writer.errors) == (3, 1)
+
+
+def test_make_dirs(tmp_path):
+    directory = str(tmp_path / '2018' / '03')
+    make_dirs(directory)
+    make_dirs(directory)
+    assert os.path.isdir(directory)
+
+    # removed since (e.g. between two jobs of the session agent): created again once forgotten
+    os.rmdir(directory)
+    forget_dirs()
+    make_dirs(directory)
+    assert os.path.isdir(directory)
+
+
+def test_activity_file_index(tmp_path):
+    root = tmp_path / 'export'
+    os.makedirs(root / '2018' / '03')
+    os.makedirs(tmp_path / 'export2')
+    for name in ['activity_2541953812.fit', '2018/03/20180308-112322-activity_2541953812_zones.json', 'activities.csv',
+                 '2018/03/activity_995784118.gpx']:  # fmt: skip
+        write_atomic(str(root / name), b'')
+    index = ActivityFileIndex()
+    index.scan(str(root))
+
+    assert index.exists(str(root / '2018' / '03' / 'activity_995784118.gpx'))
+    assert not index.exists(str(root / 'activity_995784118.gpx'))
+    assert index.find('2541953812') == [str(root / '2018' / '03' / '20180308-112322-activity_2541953812_zones.json'),
+                                        str(root / 'activity_2541953812.fit')]  # fmt: skip
+    assert index.find(2541953812, '.fit') == [str(root / 'activity_2541953812.fit')]
+    assert len(index.files()) == 3
+
+    # not an activity file or outside of the export directory: looked up in the file system
+    assert index.exists(str(root / 'activities.csv'))
+    write_atomic(str(tmp_path / 'export2' / 'activity_1.gpx'), b'')
+    assert index.exists(str(tmp_path / 'export2' / 'activity_1.gpx'))
+
+    # only the index is consulted for the activity files in the export directory
+    index.add(str(root / '2018' / 'activity_1.gpx'))
+    index.discard(str(root / 'activity_2541953812.fit'))
+    assert index.exists(str(root / '2018' / 'activity_1.gpx'))
+    assert not index.exists(str(root / 'activity_2541953812.fit'))
+    assert index.find('1') == [str(root / '2018' / 'activity_1.gpx')]
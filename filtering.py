@@ -5,10 +5,14 @@ Helper functions for filtering the list of activities to download.
 import json
 import logging
 import os
+import threading
 
 DOWNLOADED_IDS_FILE_NAME = "downloaded_ids.json"
 KEY_IDS = "ids"
 
+# serializes the read-modify-write of the download stats file when activities are processed concurrently
+DOWNLOAD_STATS_LOCK = threading.Lock()
+
 
 def read_exclude(file):
     """
@@ -35,42 +39,44 @@ def read_exclude(file):
             return None
 
 
-def update_download_stats(activity_id, directory):
+def update_download_stats(activity_id, directory, file_name=DOWNLOADED_IDS_FILE_NAME):
     """
     Add item to download_stats file, if not already there. Call this for every successful downloaded activity.
     The statistic is independent of the downloaded file type.
     :param activity_id: String with activity ID
     :param directory: Download root directory
+    :param file_name: Name of the download_stats file (the shards of an export write their own, see sharding.py)
     """
-    file = os.path.join(directory, DOWNLOADED_IDS_FILE_NAME)
+    file = os.path.join(directory, file_name)
 
-    # Very first time: touch the file
-    if not os.path.exists(file):
-        with open(file, 'w', encoding='utf-8') as read_obj:
-            read_obj.write(json.dumps(""))
+    with DOWNLOAD_STATS_LOCK:
+        # Very first time: touch the file
+        if not os.path.exists(file):
+            with open(file, 'w', encoding='utf-8') as read_obj:
+                read_obj.write(json.dumps(""))
 
-    # read file
-    with open(file, 'r', encoding='utf-8') as read_obj:
-        data = read_obj.read()
+        # read file
+        with open(file, 'r', encoding='utf-8') as read_obj:
+            data = read_obj.read()
 
-        try:
-            obj = json.loads(data)
+            try:
+                obj = json.loads(data)
 
-        except json.JSONDecodeError:
-            obj = ""
+            except json.JSONDecodeError:
+                obj = ""
 
-    # Sanitize wrong formats
-    obj = dict(obj)
+        # Sanitize wrong formats
+        obj = dict(obj)
 
-    if KEY_IDS not in obj:
-        obj[KEY_IDS] = []
+        if KEY_IDS not in obj:
+            obj[KEY_IDS] = []
 
-    if activity_id in obj[KEY_IDS]:
-        logging.info("%s already in %s", activity_id, file)
-        return
+        if activity_id in obj[KEY_IDS]:
+            logging.info("%s already in %s", activity_id, file)
+            return
 
-    obj[KEY_IDS].append(activity_id)
-    obj[KEY_IDS].sort()
+        obj[KEY_IDS].append(activity_id)
+        obj[KEY_IDS].sort()
 
-    with open(file, 'w', encoding='utf-8') as write_obj:
-        write_obj.write(json.dumps(obj))
+        with open(file, 'w', encoding='utf-8') as write_obj:
+            write_obj.write(json.dumps(obj))
@@ -20,10 +20,13 @@ Activity & event types:
 """
 
 # Standard library imports
+# (modules only needed by some code paths, like garth for the login or zipfile for '--unzip', are
+# imported where they are used, to keep the startup fast; see startup_benchmark.py)
 import argparse
+import contextlib
 import csv
-import http.cookiejar
 import io
+import itertools
 import json
 import logging
 import os
@@ -31,10 +34,10 @@ import os.path
 import re
 import string
 import sys
+import threading
 import unicodedata
-import urllib.request
-import zipfile
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
 from getpass import getpass
 from math import floor
 from platform import python_version
@@ -42,17 +45,71 @@ from subprocess import call
 from timeit import default_timer as timer
 from urllib.error import HTTPError, URLError
 from urllib.parse import urlencode
-from urllib.request import Request
-
-# PyPI imports
-import garth
-from garth.exc import GarthException
 
 # Local application/library specific imports
-from filtering import read_exclude, update_download_stats
-
-COOKIE_JAR = http.cookiejar.CookieJar()
-OPENER = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(COOKIE_JAR), urllib.request.HTTPSHandler(debuglevel=0))
+from artifacts import BUNDLED_PATTERN, COMPRESSIONS, ArtifactStore, zstd_available
+from changes import CHANGED, UNCHANGED, ChangeDetector
+from fileio import FSYNC_POLICIES, ActivityFileIndex, FileSync, MetadataWriter, forget_dirs, make_dirs, write_atomic
+from filtering import DOWNLOADED_IDS_FILE_NAME, KEY_IDS, read_exclude, update_download_stats
+from instrumentation import ExportStats
+from jsonstream import iter_json_array, iter_json_object
+from metrics import METRICS_COLUMNS, compute_metrics, numpy_available
+from state import (
+    DEVICE_TTL_DAYS,
+    DONE,
+    FAILED,
+    IN_FLIGHT,
+    PROPERTIES_TTL_DAYS,
+    STATE_FILE_NAME,
+    DeviceRegistry,
+    PropertyCache,
+    StateStore,
+    WorkQueue,
+)
+
+# URL opener for all HTTP requests, built on first use, see 'get_opener'
+OPENER = None
+OPENER_LOCK = threading.Lock()
+
+# request and phase statistics of the current run, see instrumentation.py
+STATS = ExportStats()
+
+# sync policy for the written files, see '--fsync'
+FILE_SYNC = FileSync()
+
+# applies file times and renames in the background, see fileio.py
+METADATA = MetadataWriter()
+
+# the activity files in the export directory, scanned at the start of the export
+FILE_INDEX = ActivityFileIndex()
+
+# the JSON artifacts (user stats, activity lists, devices, zones, samples, ...), see '--compress-json'
+ARTIFACTS = ArtifactStore()
+
+# the pack files the activity files and artifacts are appended to instead, see '--pack' (a PackWriter while used)
+PACKS = None
+
+# writes the simplified copies of the GPX files in worker processes, see '--simplify' (a SimplifyPool while used)
+SIMPLIFIER = None
+
+# start and end points of the activities in the state store, see geoindex.py (a GeoIndex during the export)
+GEO_INDEX = None
+
+# hashes of the activity summaries in the state store, see changes.py and '--refresh-changed'
+CHANGES = ChangeDetector()
+
+# spaces the HTTP requests, shared by the worker processes of the shards, see '--rate-limit' and '--shards'
+# (a RateLimiter with '--rate-limit')
+RATE_LIMITER = None
+
+# checks the value of '--simplify' without importing simplify.py, see 'parse_spec' there
+SIMPLIFY_SPEC_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)(m|s)$')
+
+# per thread: URL of the last HTTP request (for describing failures)
+REQUEST_CONTEXT = threading.local()
+
+# serializes the CSV records when activities are processed concurrently
+CSV_LOCK = threading.Lock()
 
 SCRIPT_VERSION = '4.6.2'
 
@@ -90,6 +147,13 @@ USES_PACE = {1, 3, 9}  # running, hiking, walking
 
 HR_ZONES_EMPTY = [None, None, None, None, None]
 
+# the large members of the samples JSON, which are saved but not parsed
+# (the sample rows 'activityDetailMetrics' are parsed if the CSV template contains one of METRICS_COLUMNS)
+SAMPLES_SKIPPED = ('activityDetailMetrics', 'geoPolylineDTO', 'heartRateDTOs')
+
+# maximum number of custom heart rate zones, see '--hr-zones'
+MAX_HR_ZONES = 5
+
 # Maximum number of activities you can request at once.
 # Used to be 100 and enforced by Garmin for older endpoints; for the current endpoint 'URL_GC_LIST'
 # the limit is not known (I have less than 1000 activities and could get them all in one go)
@@ -97,6 +161,9 @@ LIMIT_MAXIMUM = 1000
 
 MAX_TRIES = 3
 
+# default maximum age (in hours) of the work queue of a previous run to be resumed, see '--resume'
+RESUME_MAX_AGE_HOURS = 24
+
 CSV_TEMPLATE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "csv_header_default.properties")
 
 GARMIN_BASE_URL = "https://connect.garmin.com"
@@ -119,21 +186,98 @@ class GarminException(Exception):
     """Exception for problems with Garmin Connect (connection, data consistency etc)."""
 
 
-def resolve_path(directory, subdir, time):
+def endpoint_category(url):
+    """Map a request URL to the name of its endpoint, used for the request statistics"""
+    if url.startswith(URL_GC_ACTIVITY):
+        if url.endswith('/hrTimeInZones'):
+            return 'zones'
+        if url.endswith('/details'):
+            return 'samples'
+        return 'details'
+    for category, prefix in (
+        ('user', URL_GC_USER),
+        ('userstats', URL_GC_USERSTATS),
+        ('list', URL_GC_LIST),
+        ('device', URL_GC_DEVICE),
+        ('gear', URL_GC_GEAR),
+        ('properties', URL_GC_ACT_PROPS),
+        ('properties', URL_GC_EVT_PROPS),
+        ('data_file', URL_GC_GPX_ACTIVITY),
+        ('data_file', URL_GC_TCX_ACTIVITY),
+        ('data_file', URL_GC_ORIGINAL_ACTIVITY),
+    ):
+        if url.startswith(prefix):
+            return category
+    return 'other'
+
+
+def _device_directory_name(device):
+    """Device name for '{DEVICE}': without the firmware version, so that an update doesn't start a new directory"""
+    return sanitize_filename(re.sub(r'\s+[\d.]+$', '', device)) if device else 'unknown'
+
+
+# placeholders of '--subdir', the functions get the start time (ISO format) and the dict of the other fields
+SUBDIR_PLACEHOLDERS = {
+    'YYYY': lambda time, fields: time[0:4],
+    'MM': lambda time, fields: time[5:7],
+    'DD': lambda time, fields: time[8:10],
+    'WW': lambda time, fields: f'{date(int(time[0:4]), int(time[5:7]), int(time[8:10])).isocalendar()[1]:02}',
+    'TYPE': lambda time, fields: sanitize_filename(fields.get('TYPE')) or 'unknown',
+    'DEVICE': lambda time, fields: _device_directory_name(fields.get('DEVICE')),
+}
+
+
+class PathTemplate:  # pylint: disable=too-few-public-methods
+    """A '--subdir' template, parsed once into literal parts and placeholder functions"""
+
+    def __init__(self, template, strict=False):
+        """
+        :param template: the template, e.g. '{YYYY}/{MM}'
+        :param strict:   raise a ValueError for unknown placeholders instead of keeping them literally
+        """
+        self.parts = []
+        # the odd parts of the split are the placeholder names
+        for index, part in enumerate(re.split(r'{([A-Z]+)}', template)):
+            if index % 2 == 1 and part in SUBDIR_PLACEHOLDERS:
+                self.parts.append(SUBDIR_PLACEHOLDERS[part])
+                continue
+            if index % 2 == 1:
+                if strict:
+                    supported = ', '.join(f'{{{name}}}' for name in SUBDIR_PLACEHOLDERS)
+                    raise ValueError(f'unknown placeholder {{{part}}}, supported are {supported}')
+                part = f'{{{part}}}'
+            if self.parts and isinstance(self.parts[-1], str):
+                self.parts[-1] += part
+            elif part:
+                self.parts.append(part)
+
+    def format(self, time, fields=None):
+        """
+        The path for an activity
+
+        :param time:   start time of the activity in ISO format, e.g. '2018-03-08 12:23:22'
+        :param fields: dict with the values for the other placeholders ('TYPE', 'DEVICE')
+        """
+        fields = fields or {}
+        return ''.join(part if isinstance(part, str) else part(time, fields) for part in self.parts)
+
+
+@lru_cache(maxsize=16)
+def compile_path_template(template):
+    """The PathTemplate for a template, parsed only once"""
+    return PathTemplate(template)
+
+
+def resolve_path(directory, subdir, time, fields=None):
     """
-    Replace time variables and returns changed path. Supported place holders are {YYYY} and {MM}
+    Replace the placeholders (see SUBDIR_PLACEHOLDERS) and return the changed path; unknown placeholders are kept
     :param directory: export root directory
     :param subdir: subdirectory, can have place holders.
     :param time: date-time-string
+    :param fields: dict with the values for the placeholders not derived from the time ('TYPE', 'DEVICE')
     :return: Updated dictionary string
     """
-    ret = os.path.join(directory, subdir)
-    if re.compile(".*{YYYY}.*").match(ret):
-        ret = ret.replace("{YYYY}", time[0:4])
-    if re.compile(".*{MM}.*").match(ret):
-        ret = ret.replace("{MM}", time[5:7])
-
-    return ret
+    return os.path.join(directory, compile_path_template(subdir).format(time, fields))
 
 
 def hhmmss_from_seconds(sec):
@@ -162,37 +306,124 @@ def sanitize_filename(name, max_length=0):
 
 def write_to_file(filename, content, mode='w', file_time=None):
     """
-    Helper function that persists content to a file.
+    Helper function that persists content to a file (atomically, see fileio.py),
+    or appends it to the pack files with option '--pack'.
 
     :param filename:     name of the file to write
     :param content:      content to write; can be 'bytes' or 'str'.
-                         If it's 'bytes' and the mode 'w', it will be converted/decoded
+                         'bytes' are written unchanged (no decoding), 'str' is encoded as UTF-8
     :param mode:         'w' or 'wb'
-    :param file_time:    if given use as timestamp for the file written (in seconds since 1970-01-01)
-    """
-    if mode == 'w':
-        if isinstance(content, bytes):
-            content = content.decode('utf-8')
-        with io.open(filename, mode, encoding='utf-8') as text_file:
-            text_file.write(content)
-    elif mode == 'wb':
-        with io.open(filename, 'wb') as binary_file:
-            binary_file.write(content)
+    :param file_time:    if given use as timestamp for the file written (in seconds since 1970-01-01);
+                         set in the background, see METADATA
+    """
+    if mode not in ('w', 'wb'):
+        raise ValueError('Unsupported file mode: ', mode)
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    if packs_active():
+        PACKS.add(filename, content, file_time)
     else:
+        write_atomic(filename, content, sync=FILE_SYNC)
+        if file_time:
+            METADATA.utime(filename, file_time)
+    FILE_INDEX.add(filename)
+
+
+def packs_active():
+    """True if the files are written to pack files, see '--pack'"""
+    return PACKS is not None and PACKS.active
+
+
+def finish_background_work():
+    """Write the simplified GPX files, apply the file times and renames still pending and close the packs"""
+    if SIMPLIFIER is not None:
+        SIMPLIFIER.wait()
+    METADATA.flush()
+    if PACKS is not None:
+        PACKS.close()
+
+
+def write_artifact(filename, content, mode='w', file_time=None):
+    """
+    Persist a JSON artifact, in the form chosen with '--compress-json' (see artifacts.py);
+    same parameters as 'write_to_file'
+
+    :param filename: name of the artifact (ending with '.json', the stored file may get another extension)
+    """
+    if mode not in ('w', 'wb'):
         raise ValueError('Unsupported file mode: ', mode)
-    if file_time:
-        os.utime(filename, (file_time, file_time))
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    with artifact_writer(filename, file_time) as artifact_file:
+        artifact_file.write(content)
 
 
-def http_req(url, post=None, headers=None):
+@contextlib.contextmanager
+def artifact_writer(filename, file_time=None):
     """
-    Helper function that makes the HTTP requests.
+    Binary file for writing a JSON artifact (uncompressed data), see 'write_artifact'; the artifact is
+    stored when the block completes
 
-    :param url:          URL for the request
-    :param post:         dictionary of POST parameters
-    :param headers:      dictionary of headers
-    :return: response body (type 'bytes')
+    :param filename:  name of the artifact (ending with '.json', the stored file may get another extension)
+    :param file_time: if given use as timestamp for the file written (in seconds since 1970-01-01)
     """
+    stored_name = ARTIFACTS.stored_name(filename)
+    if packs_active():
+        buffer = io.BytesIO()
+        yield buffer
+        PACKS.add(stored_name, ARTIFACTS.encode(buffer.getvalue()), file_time)
+    else:
+        # ArtifactStore.writer removes the temporary file if the block fails
+        # pylint: disable-next=contextmanager-generator-missing-cleanup
+        with ARTIFACTS.writer(filename, sync=FILE_SYNC) as artifact_file:
+            yield artifact_file
+        if file_time:
+            METADATA.utime(stored_name, file_time)
+    FILE_INDEX.add(stored_name)
+
+
+def get_opener():
+    """Return the URL opener (with a cookie jar) used for all HTTP requests, building it on first use"""
+    global OPENER  # pylint: disable=global-statement
+    with OPENER_LOCK:
+        if OPENER is None:
+            import http.cookiejar  # pylint: disable=import-outside-toplevel
+            import urllib.request  # pylint: disable=import-outside-toplevel
+
+            OPENER = urllib.request.build_opener(
+                urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), urllib.request.HTTPSHandler(debuglevel=0)
+            )
+        return OPENER
+
+
+class _CountingReader:  # pylint: disable=too-few-public-methods
+    """Wraps the response of a request, counting the bytes read"""
+
+    def __init__(self, response):
+        self.response = response
+        self.count = 0
+
+    def read(self, size=-1):
+        """Read from the response"""
+        data = self.response.read(size)
+        self.count += len(data)
+        return data
+
+
+@contextlib.contextmanager
+def http_response(url, post=None, headers=None, response_headers=None):
+    """
+    Make an HTTP request, for reading the response body (e.g. incrementally) in the 'with' block
+
+    :param url:              URL for the request
+    :param post:             dictionary of POST parameters
+    :param headers:          dictionary of headers
+    :param response_headers: if given, a dict that receives the headers of the response
+    :return: binary file-like object with the response body, None for a conditional request answered with 304
+    """
+    import garth  # pylint: disable=import-outside-toplevel
+    from urllib.request import Request  # pylint: disable=import-outside-toplevel
+
     request = Request(url)
     # Tell Garmin we're some supported browser.
     request.add_header(
@@ -208,32 +439,72 @@ def http_req(url, post=None, headers=None):
     if post:
         post = urlencode(post)  # Convert dictionary to POST parameter string.
         post = post.encode("utf-8")
+    REQUEST_CONTEXT.url = url
+    if RATE_LIMITER is not None:
+        RATE_LIMITER.wait()
     start_time = timer()
     try:
-        response = OPENER.open(request, data=post)
+        response = get_opener().open(request, data=post)
     except HTTPError as ex:
-        if hasattr(ex, 'code'):
-            logging.error('Server couldn\'t fulfill the request, url %s, code %s, error: %s', url, ex.code, ex)
-            logging.info('Headers returned:\n%s', ex.info())
-        raise
+        STATS.record_request(endpoint_category(url), timer() - start_time, 0, ex.code)
+        if ex.code != 304:
+            if hasattr(ex, 'code'):
+                logging.error('Server couldn\'t fulfill the request, url %s, code %s, error: %s', url, ex.code, ex)
+                logging.info('Headers returned:\n%s', ex.info())
+            raise
+        logging.debug('Got 304 (not modified) for %s', url)
+        response = None
     except URLError as ex:
+        STATS.record_request(endpoint_category(url), timer() - start_time, 0, 'error')
         if hasattr(ex, 'reason'):
             logging.error('Failed to reach url %s, error: %s', url, ex)
         raise
-    logging.debug('Got %s in %s s from %s', response.getcode(), timer() - start_time, url)
-    logging.debug('Headers returned:\n%s', response.info())
+    if response is None:
+        yield None
+        return
+    with response:
+        logging.debug('Got %s in %s s from %s', response.getcode(), timer() - start_time, url)
+        logging.debug('Headers returned:\n%s', response.info())
+        if response_headers is not None:
+            response_headers.update(response.info().items())
+
+        # N.B. urllib2 will follow any 302 redirects.
+        # print(response.getcode())
+        if response.getcode() == 204:
+            # 204 = no content, e.g. for activities without GPS coordinates there is no GPX download.
+            # Write an empty file to prevent redownloading it.
+            STATS.record_request(endpoint_category(url), timer() - start_time, 0, 204)
+            logging.info('Got 204 for %s, returning empty response', url)
+            yield io.BytesIO(b'')
+            return
+        if response.getcode() != 200:
+            STATS.record_request(endpoint_category(url), timer() - start_time, 0, response.getcode())
+            raise GarminException(f'Bad return code ({response.getcode()}) for: {url}')
+
+        reader = _CountingReader(response)
+        try:
+            yield reader
+        finally:
+            STATS.record_request(endpoint_category(url), timer() - start_time, reader.count, 200)
 
-    # N.B. urllib2 will follow any 302 redirects.
-    # print(response.getcode())
-    if response.getcode() == 204:
-        # 204 = no content, e.g. for activities without GPS coordinates there is no GPX download.
-        # Write an empty file to prevent redownloading it.
-        logging.info('Got 204 for %s, returning empty response', url)
-        return b''
-    if response.getcode() != 200:
-        raise GarminException(f'Bad return code ({response.getcode()}) for: {url}')
 
-    return response.read()
+def http_req(url, post=None, headers=None, response_headers=None):
+    """
+    Helper function that makes the HTTP requests.
+
+    :param url:              URL for the request
+    :param post:             dictionary of POST parameters
+    :param headers:          dictionary of headers
+    :param response_headers: if given, a dict that receives the headers of the response
+    :return: response body (type 'bytes'), None for a conditional request answered with 304 (not modified)
+    """
+    with http_response(url, post, headers, response_headers) as response:
+        return None if response is None else response.read()
+
+
+def last_request_url():
+    """URL of the last HTTP request made by the current thread"""
+    return getattr(REQUEST_CONTEXT, 'url', None)
 
 
 def http_req_as_string(url, post=None, headers=None):
@@ -241,6 +512,17 @@ def http_req_as_string(url, post=None, headers=None):
     return http_req(url, post, headers).decode()
 
 
+def http_req_conditional(url, headers):
+    """
+    Conditional GET for the PropertyCache
+
+    :return: tuple (response body as string or None if not modified, dict of response headers)
+    """
+    response_headers = {}
+    data = http_req(url, headers=headers, response_headers=response_headers)
+    return (data.decode() if data is not None else None), response_headers
+
+
 # idea stolen from https://stackoverflow.com/a/31852401/3686
 def load_properties(multiline, separator='=', comment_char='#', keys=None):
     """
@@ -256,10 +538,9 @@ def load_properties(multiline, separator='=', comment_char='#', keys=None):
     for line in multiline.splitlines():
         stripped_line = line.strip()
         if stripped_line and not stripped_line.startswith(comment_char):
-            key_value = stripped_line.split(separator)
-            key = key_value[0].strip()
-            value = separator.join(key_value[1:]).strip().strip('"')
-            props[key] = value
+            key, _, value = stripped_line.partition(separator)
+            key = key.strip()
+            props[key] = value.strip().strip('"')
             if keys is not None:
                 keys.append(key)
     return props
@@ -302,6 +583,12 @@ def trunc6(some_float):
     return f'{floor(some_float * 1000000) / 1000000:12.6f}'.lstrip()
 
 
+@lru_cache(maxsize=None)
+def _offset_timezone(minutes):
+    """The (shared) timezone for an offset; there are only a few distinct offsets"""
+    return timezone(timedelta(minutes=minutes), "LCL")
+
+
 def offset_date_time(time_local, time_gmt):
     """
     Build an 'aware' datetime from two 'naive' datetime objects (that is timestamps
@@ -310,25 +597,35 @@ def offset_date_time(time_local, time_gmt):
     local_dt = datetime_from_iso(time_local)
     gmt_dt = datetime_from_iso(time_gmt)
     offset = local_dt - gmt_dt
-    offset_tz = timezone(timedelta(minutes=offset.seconds // 60), "LCL")
-    return local_dt.replace(tzinfo=offset_tz)
+    return local_dt.replace(tzinfo=_offset_timezone(offset.seconds // 60))
+
+
+# the ISO timestamps 'datetime.fromisoformat' doesn't parse (like '.0' before Python 3.11) or would parse differently
+ISO_TIMESTAMP_PATTERN = re.compile(r"(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?")
 
 
 def datetime_from_iso(iso_date_time):
     """
-    Call 'datetime.strptime' supporting different ISO time formats
+    Parse different ISO time formats
     (with or without 'T' between date and time, with or without microseconds,
     but without offset)
     :param iso_date_time: timestamp string in ISO format
     :return: a 'naive` datetime
     """
-    pattern = re.compile(r"(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})(\.\d+)?")
-    match = pattern.match(iso_date_time)
+    # fast path for the usual timestamps, 'fromisoformat' also accepts other separators, offsets or dates only
+    if len(iso_date_time) >= 19 and iso_date_time[10] in 'T ':
+        try:
+            date_time = datetime.fromisoformat(iso_date_time)
+            if date_time.tzinfo is None:
+                return date_time
+        except ValueError:
+            pass
+    match = ISO_TIMESTAMP_PATTERN.match(iso_date_time)
     if not match:
         raise GarminException(f'Invalid ISO timestamp {iso_date_time}.')
-    micros = match.group(3) if match.group(3) else ".0"
-    iso_with_micros = f'{match.group(1)} {match.group(2)}{micros}'
-    return datetime.strptime(iso_with_micros, "%Y-%m-%d %H:%M:%S.%f")
+    year, month, day, hour, minute, second, fraction = match.groups()
+    micros = int(fraction[:6].ljust(6, '0')) if fraction else 0
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), micros)
 
 
 def epoch_seconds_from_summary(summary):
@@ -387,6 +684,14 @@ class CsvFilter:
         """Write the active column names as CSV header"""
         self.__writer.writeheader()
 
+    def match_header(self, header):
+        """
+        Keep the columns appended to the header of the existing CSV file (e.g. the column of routes.py) in the
+        rows appended to it, empty; other headers (e.g. of another template) are left alone
+        """
+        if len(header) > len(self.__csv_field_names) and header[: len(self.__csv_field_names)] == self.__csv_field_names:
+            self.__writer = csv.DictWriter(self.__csv_file, fieldnames=header, quoting=csv.QUOTE_ALL)
+
     def write_row(self):
         """Write the prepared CSV record"""
         self.__writer.writerow(self.__current_row)
@@ -405,6 +710,36 @@ class CsvFilter:
         return name in self.__csv_columns
 
 
+def hr_zone_boundaries(value):
+    """
+    Parse the value of option '--hr-zones': comma-separated, increasing lower boundaries (bpm)
+
+    :return: list of the boundaries (int)
+    :raise argparse.ArgumentTypeError: for an invalid value
+    """
+    try:
+        boundaries = [int(boundary) for boundary in value.split(',')]
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(f'not a comma-separated list of heart rates: {value}') from ex
+    if len(boundaries) > MAX_HR_ZONES:
+        raise argparse.ArgumentTypeError(f'at most {MAX_HR_ZONES} zones are supported')
+    if any(low >= high for low, high in zip(boundaries, boundaries[1:])) or boundaries[0] <= 0:
+        raise argparse.ArgumentTypeError(f'the boundaries must be positive and increasing: {value}')
+    return boundaries
+
+
+def simplify_spec(value):
+    """
+    Check the value of option '--simplify', see simplify.py
+
+    :raise argparse.ArgumentTypeError: for an invalid value
+    """
+    match = SIMPLIFY_SPEC_PATTERN.match(value.strip())
+    if not match or float(match.group(1)) <= 0:
+        raise argparse.ArgumentTypeError(f"Expected a tolerance like '5m' or an interval like '10s', not '{value}'")
+    return value
+
+
 def parse_arguments(argv):
     """
     Setup the argument parser and parse the command line arguments.
@@ -423,7 +758,8 @@ def parse_arguments(argv):
         help='your Garmin Connect username or email address (otherwise, you will be prompted)')
     parser.add_argument('--password',
         help='your Garmin Connect password (otherwise, you will be prompted)')
-    parser.add_argument('-c', '--count', default='1',
+    # the default ('1') is set after the checks, '--shards' must know whether '--count' was given
+    parser.add_argument('-c', '--count',
         help='number of recent activities to download, or \'all\' (default: 1)')
     parser.add_argument('-sd', '--start_date', default='',
         help='the start date to get activities from (inclusive). Format example: 2023-07-31')
@@ -438,17 +774,24 @@ def parse_arguments(argv):
     parser.add_argument('-d', '--directory', default=activities_directory,
         help='the directory to export to (default: \'./YYYY-MM-DD_garmin_connect_export\')')
     parser.add_argument('-s', '--subdir',
-        help='the subdirectory for activity files (tcx, gpx etc.), supported placeholders are {YYYY} and {MM} (default: export directory)')
+        help='the subdirectory for activity files (tcx, gpx etc.), supported placeholders are {YYYY}, {MM}, {DD}, {WW} (ISO week), '
+             '{TYPE} (activity type) and {DEVICE} (default: export directory)')
     parser.add_argument('-lp', '--logpath',
         help='the directory to store logfiles (default: same as for --directory)')
     parser.add_argument('-u', '--unzip', action='store_true',
         help='if downloading ZIP files (format: \'original\'), unzip the file and remove the ZIP file')
+    parser.add_argument('--simplify', type=simplify_spec, metavar='SPEC',
+        help="write a simplified copy (.simplified.gpx) of every new GPX file (format 'gpx'): Douglas-Peucker with a "
+             "tolerance like '5m' or one point per interval like '10s'")
     parser.add_argument('-ot', '--originaltime', action='store_true',
         help='will set downloaded (and possibly unzipped) file time to the activity start time')
     parser.add_argument('--desc', type=int, nargs='?', const=0, default=None,
         help='append the activity\'s description to the file name of the download; limit size if number is given')
     parser.add_argument('-t', '--template', default=CSV_TEMPLATE,
         help='template file with desired columns for CSV output')
+    parser.add_argument('--hr-zones', type=hr_zone_boundaries, metavar='BPM[,BPM...]',
+        help=f'lower boundaries of up to {MAX_HR_ZONES} custom heart rate zones for the CSV columns customHrZone1Seconds etc., '
+             'e.g. 120,140,155,170')
     parser.add_argument('-fp', '--fileprefix', action='count', default=0,
         help='set the local time as activity file name prefix')
     parser.add_argument('-sa', '--start_activity_no', type=int, default=1,
@@ -459,18 +802,115 @@ def parse_arguments(argv):
         help='comma-separated list of activity type IDs to allow. Format example: 3,9')
     parser.add_argument('-ss', '--session', metavar='DIRECTORY',
         help='enable loading and storing SSO information from/to given directory')
+    parser.add_argument('--resume', type=float, nargs='?', const=RESUME_MAX_AGE_HOURS, default=None, metavar='HOURS',
+        help='keep a work queue in the export directory and resume an interrupted run with the same arguments from it, '
+             f'if it is not older than HOURS (default: {RESUME_MAX_AGE_HOURS})')
+    parser.add_argument('--device-ttl', type=float, default=DEVICE_TTL_DAYS, metavar='DAYS',
+        help=f'remember device names between runs for DAYS days, 0 to always download the device details (default: {DEVICE_TTL_DAYS})')
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default='none',
+        help="when to fsync the written files: 'none' (leave it to the OS), 'batch' (in batches and at the end) "
+             "or 'file' (every file) (default: 'none')")
+    parser.add_argument('--compress-json', choices=list(COMPRESSIONS), default='none',
+        help="store the saved JSON files (user stats, activity lists, devices, zones, samples, ...) compressed: "
+             "'gzip' or 'zstd' (needs the zstandard package) (default: 'none')")
+    parser.add_argument('--bundle-json', action='store_true',
+        help='at the end of the run move the saved JSON files of the activities (zones, samples, gear) into '
+             'one ZIP archive per month')
+    parser.add_argument('--pack', action='store_true',
+        help='append the activity files and the saved JSON files to a few pack files (export-NNNN.pack) in the export '
+             'directory instead of writing separate files; see packfile.py for listing and unpacking them')
+    parser.add_argument('--agent', action='store_true',
+        help='run the export in the session agent (see session_agent.py) if one is running, skipping the login')
+    parser.add_argument('--shards', type=int, metavar='N',
+        help='split the date range of --start_date and --end_date into N shards, exported in parallel by worker processes '
+             'into the export directory (all activities of the range, see sharding.py)')
+    parser.add_argument('--rate-limit', type=float, metavar='REQUESTS',
+        help='send at most REQUESTS HTTP requests per second, with --shards for all worker processes together (default: no limit)')
+    parser.add_argument('--refresh-changed', action='store_true',
+        help='export the activities changed in Garmin Connect (name, description, type, ...) since their export again, '
+             'replacing their data files and CSV rows (see changes.py)')
+    parser.add_argument('--keep-going', action='store_true',
+        help='do not abort on a failing activity, but record it in quarantine.jsonl and retry it at the end')
+    parser.add_argument('--stats-json', metavar='FILE',
+        help='write the request and timing statistics of the run as JSON to the given file')
+    parser.add_argument('--profile', action='store_true',
+        help='profile the run with a sampling profiler, writing folded stacks (for flame graphs) and a summary to the log directory')
+    parser.add_argument('--fix-times', action='store_true',
+        help='set the file times of the activity files in the export directory to the activity start times, '
+             'taken from the cached activity lists, and exit')
+    parser.add_argument('--compact-csv', action='store_true',
+        help='remove duplicate rows (keeping the newest) from the CSV file in the export directory, sort it by start time and exit')
     # fmt: on
+    # the shard exported by a worker process, see 'sharded_export'
+    parser.set_defaults(shard=None)
 
-    return parser.parse_args(argv[1:])
+    args = parser.parse_args(argv[1:])
+    if args.subdir is not None:
+        try:
+            PathTemplate(args.subdir, strict=True)
+        except ValueError as ex:
+            parser.error(f'argument -s/--subdir: {ex}')
+    if args.compress_json == 'zstd' and not zstd_available():
+        parser.error("argument --compress-json: 'zstd' needs the zstandard package (pip install zstandard)")
+    if args.simplify and args.format != 'gpx':
+        parser.error("argument --simplify: only allowed with format 'gpx'")
+    if args.simplify and not numpy_available():
+        parser.error('argument --simplify: needs the numpy package (pip install numpy)')
+    if args.pack and args.bundle_json:
+        parser.error('argument --bundle-json: not allowed with argument --pack')
+    if args.pack and args.refresh_changed:
+        parser.error('argument --refresh-changed: not allowed with argument --pack')
+    if args.rate_limit is not None and args.rate_limit <= 0:
+        parser.error('argument --rate-limit: must be positive')
+    if args.shards is not None:
+        check_shards_arguments(parser, args)
+    if args.count is None:
+        args.count = '1'
+    return args
+
+
+def check_shards_arguments(parser, args):
+    """Check the arguments combined with option '--shards' (exits through 'parser.error')"""
+    if args.shards < 1:
+        parser.error('argument --shards: must be positive')
+    if not args.start_date or not args.end_date:
+        parser.error('argument --shards: needs --start_date and --end_date')
+    from sharding import shard_ranges  # pylint: disable=import-outside-toplevel
+
+    try:
+        shard_ranges(args.start_date, args.end_date, args.shards)
+    except ValueError as ex:
+        parser.error(f'argument --shards: {ex}')
+    if args.count not in (None, 'all'):
+        parser.error('argument --shards: exports all activities of the date range, not allowed with argument --count')
+    for name, used in (('--resume', args.resume is not None), ('--pack', args.pack), ('--bundle-json', args.bundle_json),
+                       ('--start_activity_no', args.start_activity_no != 1), ('--agent', args.agent),
+                       ('--refresh-changed', args.refresh_changed)):  # fmt: skip
+        if used:
+            parser.error(f'argument --shards: not allowed with argument {name}')
+    import multiprocessing  # pylint: disable=import-outside-toplevel
+
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        parser.error('argument --shards: needs worker processes started with fork, not available on this platform')
 
 
 def login_to_garmin_connect(args):
     """
     Perform all HTTP requests to login to Garmin Connect.
     """
+    import garth  # pylint: disable=import-outside-toplevel
+    from garth.exc import GarthException  # pylint: disable=import-outside-toplevel
+
     garth_session_directory = args.session if args.session else None
 
     print('Authenticating...', end='')
+    token = garth.client.oauth2_token
+    if token and not token.expired:
+        # e.g. a job run by the session agent, which keeps the session alive
+        logging.info("Reusing the OAuth token of this process, valid until %s", datetime.fromtimestamp(token.expires_at))
+        print(' Done.')
+        return
+
     try:
         login_required = False
 
@@ -632,6 +1072,8 @@ def csv_write_record(csv_filter, extract, actvty, details, activity_type_name, e
     csv_filter.set_column('endLongitude', trunc6(end_longitude) if end_longitude else None)
     csv_filter.set_column('sampleCount', str(extract['samples']['metricsCount']) if present('metricsCount', extract['samples']) else None)
     # fmt: on
+    for column in METRICS_COLUMNS:
+        csv_filter.set_column(column, extract.get('metrics', {}).get(column))
 
     csv_filter.write_row()
 
@@ -662,7 +1104,8 @@ def extract_device(device_dict, details, start_time_seconds, args, http_caller,
             # details['metadataDTO']['deviceMetaDataDTO']['deviceId'] == null -> device unknown
             # details['metadataDTO']['deviceMetaDataDTO']['deviceId'] == '0' -> device unknown
             # details['metadataDTO']['deviceMetaDataDTO']['deviceId'] == 'someid' -> device known
-            device_dict[device_app_inst_id] = None
+            # a device without a name is remembered for this run only (see DeviceRegistry), the next run tries again
+            device_name = None
             device_meta = metadata['deviceMetaDataDTO'] if present('deviceMetaDataDTO', metadata) else {}
             device_id = device_meta['deviceId'] if present('deviceId', device_meta) else None
             if 'deviceId' not in device_meta or device_id and device_id != '0':
@@ -670,15 +1113,15 @@ def extract_device(device_dict, details, start_time_seconds, args, http_caller,
                 file_writer(os.path.join(args.directory, f'device_{device_app_inst_id}.json'), device_json, 'w', start_time_seconds)
                 if not device_json:
                     logging.warning("Device Details %s are empty", device_app_inst_id)
-                    device_dict[device_app_inst_id] = "device-id:" + str(device_app_inst_id)
+                    device_name = "device-id:" + str(device_app_inst_id)
                 else:
                     device_details = json.loads(device_json)
                     if present('productDisplayName', device_details):
-                        device_dict[device_app_inst_id] = (
-                            device_details['productDisplayName'] + ' ' + device_details['versionString']
-                        )
+                        device_name = device_details['productDisplayName'] + ' ' + device_details['versionString']
                     else:
                         logging.warning("Device details %s incomplete", device_app_inst_id)
+            device_dict[device_app_inst_id] = device_name
+            return device_name
         return device_dict[device_app_inst_id]
     return None
 
@@ -694,7 +1137,7 @@ def load_zones(activity_id, start_time_seconds, args, http_caller, file_writer):
     :param file_writer:        callback that saves the device details in a file
     :return: array with the heart rate zones
     """
-    zones = HR_ZONES_EMPTY
+    zones = list(HR_ZONES_EMPTY)
     zones_json = http_caller(f'{URL_GC_ACTIVITY}{activity_id}/hrTimeInZones')
     file_writer(os.path.join(args.directory, f'activity_{activity_id}_zones.json'), zones_json, 'w', start_time_seconds)
     zones_raw = json.loads(zones_json)
@@ -713,11 +1156,11 @@ def load_zones(activity_id, start_time_seconds, args, http_caller, file_writer):
 def load_gear(activity_id, args):
     """Retrieve the gear/equipment for an activity"""
     try:
-        gear_json = http_req_as_string(URL_GC_GEAR + activity_id)
+        gear_json = http_req(URL_GC_GEAR + activity_id)
         gear = json.loads(gear_json)
         if gear:
             if args.verbosity > 0:
-                write_to_file(os.path.join(args.directory, f'activity_{activity_id}-gear.json'), gear_json, 'w')
+                write_artifact(os.path.join(args.directory, f'activity_{activity_id}-gear.json'), gear_json, 'w')
             gear_display_name = gear[0]['displayName'] if present('displayName', gear[0]) else None
             gear_model = gear[0]['customMakeModel'] if present('customMakeModel', gear[0]) else None
             logging.debug("Gear for %s = %s/%s", activity_id, gear_display_name, gear_model)
@@ -729,7 +1172,7 @@ def load_gear(activity_id, args):
         return None
 
 
-def export_data_file(activity_id, activity_details, args, file_time, append_desc, date_time):
+def export_data_file(activity_id, activity_details, args, file_time, append_desc, date_time, path_fields=None):
     """
     Write the data of the activity to a file, depending on the chosen data format
 
@@ -743,17 +1186,18 @@ def export_data_file(activity_id, activity_details, args, file_time, append_desc
     :param file_time:        if given the desired time stamp for the activity file (in seconds since 1970-01-01)
     :param append_desc:      suffix to the default filename
     :param date_time:        datetime in ISO format used for '--fileprefix' and '--subdir' options
+    :param path_fields:      dict with the values of the other '--subdir' placeholders ('TYPE', 'DEVICE')
     :return:                 True if the file was written, False if the file existed already
     """
     # Time dependent subdirectory for activity files, e.g. '{YYYY}'
     if args.subdir is not None:
-        directory = resolve_path(args.directory, args.subdir, date_time)
+        directory = resolve_path(args.directory, args.subdir, date_time, path_fields)
     # export activities to root directory
     else:
         directory = args.directory
 
-    if not os.path.isdir(directory):
-        os.makedirs(directory)
+    if not packs_active():
+        make_dirs(directory)
 
     # timestamp as prefix for filename
     if args.fileprefix > 0:
@@ -783,7 +1227,7 @@ def export_data_file(activity_id, activity_details, args, file_time, append_desc
     else:
         raise ValueError('Unrecognized format.')
 
-    if os.path.isfile(data_filename):
+    if FILE_INDEX.exists(data_filename):
         logging.debug('Data file for %s already exists', activity_id)
         print('\tData file already exists; skipping...')
         # Inform the main program that the file already exists
@@ -791,9 +1235,9 @@ def export_data_file(activity_id, activity_details, args, file_time, append_desc
 
     # Regardless of unzip setting, don't redownload if the ZIP or FIT/GPX/TCX original file exists.
     if args.format == 'original' and (
-        os.path.isfile(original_basename + '.fit')
-        or os.path.isfile(original_basename + '.gpx')
-        or os.path.isfile(original_basename + '.tcx')
+        FILE_INDEX.exists(original_basename + '.fit')
+        or FILE_INDEX.exists(original_basename + '.gpx')
+        or FILE_INDEX.exists(original_basename + '.tcx')
     ):
         logging.debug('Original data file for %s already exists', activity_id)
         print('\tOriginal data file already exists; skipping...')
@@ -801,73 +1245,254 @@ def export_data_file(activity_id, activity_details, args, file_time, append_desc
         return False
 
     if args.format != 'json':
-        # Download the data file from Garmin Connect. If the download fails (e.g., due to timeout),
-        # this script will die, but nothing will have been written to disk about this activity, so
-        # just running it again should pick up where it left off.
-
-        tries = MAX_TRIES
-        while tries > 0:
-            tries -= 1
-            try:
-                data = http_req(download_url)
-                break
-            except HTTPError as ex:
-                # Handle expected (though unfortunate) error codes; die on unexpected ones.
-                if ex.code == 500 and args.format == 'tcx':
-                    # Garmin will give an internal server error (HTTP 500) when downloading TCX files
-                    # if the original was a manual GPX upload. Writing an empty file prevents this file
-                    # from being redownloaded, similar to the way GPX files are saved even when there
-                    # are no tracks. One could be generated here, but that's a bit much. Use the GPX
-                    # format if you want actual data in every file, as I believe Garmin provides a GPX
-                    # file for every activity.
-                    logging.info('Writing empty file since Garmin did not generate a TCX file for this activity...')
-                    data = ''
-                    break
-                if ex.code == 404 and args.format == 'original':
-                    # For manual activities (i.e., entered in online without a file upload), there is
-                    # no original file. # Write an empty file to prevent redownloading it.
-                    logging.info('Writing empty file since there was no original activity data...')
-                    data = ''
+        with STATS.phase(activity_id, 'data_file'):
+            # Download the data file from Garmin Connect. If the download fails (e.g., due to timeout),
+            # this script will die, but nothing will have been written to disk about this activity, so
+            # just running it again should pick up where it left off.
+
+            tries = MAX_TRIES
+            while tries > 0:
+                tries -= 1
+                try:
+                    data = http_req(download_url)
                     break
-                logging.info('Got %s for %s, %s tries left', ex.code, download_url, tries)
-            if tries == 0:
-                raise GarminException(f'No tries left. Could not download {download_url}')
+                except HTTPError as ex:
+                    # Handle expected (though unfortunate) error codes; die on unexpected ones.
+                    if ex.code == 500 and args.format == 'tcx':
+                        # Garmin will give an internal server error (HTTP 500) when downloading TCX files
+                        # if the original was a manual GPX upload. Writing an empty file prevents this file
+                        # from being redownloaded, similar to the way GPX files are saved even when there
+                        # are no tracks. One could be generated here, but that's a bit much. Use the GPX
+                        # format if you want actual data in every file, as I believe Garmin provides a GPX
+                        # file for every activity.
+                        logging.info('Writing empty file since Garmin did not generate a TCX file for this activity...')
+                        data = b''
+                        break
+                    if ex.code == 404 and args.format == 'original':
+                        # For manual activities (i.e., entered in online without a file upload), there is
+                        # no original file. # Write an empty file to prevent redownloading it.
+                        logging.info('Writing empty file since there was no original activity data...')
+                        data = b''
+                        break
+                    logging.info('Got %s for %s, %s tries left', ex.code, download_url, tries)
+                    if tries > 0:
+                        STATS.record_retry('data_file')
+                if tries == 0:
+                    raise GarminException(f'No tries left. Could not download {download_url}')
     else:
         data = activity_details
 
     # Persist file
-    write_to_file(data_filename, data, file_mode, file_time)
-
-    # Success: Add activity ID to downloaded_ids.json
-    update_download_stats(activity_id, args.directory)
-
-    if args.format == 'original':
-        # Even manual upload of a GPX file is zipped, but we'll validate the extension.
-        if args.unzip and data_filename[-3:].lower() == 'zip':
-            logging.debug('Unzipping and removing original file, size is %s', os.stat(data_filename).st_size)
-            if os.stat(data_filename).st_size > 0:
-                with open(data_filename, 'rb') as zip_file, zipfile.ZipFile(zip_file) as zip_obj:
+    unzip = args.format == 'original' and args.unzip and data_filename[-3:].lower() == 'zip'
+
+    def unzipped_filename(name):
+        # prepend 'activity_' and append the description to the base name
+        name_base, name_ext = os.path.splitext(name)
+        # sometimes in 2020 Garmin added '_ACTIVITY' to the name in the ZIP. Remove it...
+        # note that the name should match 'original_basename' elsewhere in this script to
+        # avoid downloading the same files again
+        name_base = name_base.replace('_ACTIVITY', '')
+        return os.path.join(directory, f'{prefix}activity_{name_base}{append_desc}{name_ext}')
+
+    from sharding import shard_filename  # pylint: disable=import-outside-toplevel
+
+    with STATS.phase(activity_id, 'disk_write'):
+        if unzip and packs_active():
+            # the files of the ZIP archive go into the pack directly
+            if data:
+                import zipfile  # pylint: disable=import-outside-toplevel
+
+                with zipfile.ZipFile(io.BytesIO(data)) as zip_obj:
                     for name in zip_obj.namelist():
-                        unzipped_name = zip_obj.extract(name, directory)
-                        # prepend 'activity_' and append the description to the base name
-                        name_base, name_ext = os.path.splitext(name)
-                        # sometimes in 2020 Garmin added '_ACTIVITY' to the name in the ZIP. Remove it...
-                        # note that 'new_name' should match 'original_basename' elsewhere in this script to
-                        # avoid downloading the same files again
-                        name_base = name_base.replace('_ACTIVITY', '')
-                        new_name = os.path.join(directory, f'{prefix}activity_{name_base}{append_desc}{name_ext}')
-                        logging.debug('renaming %s to %s', unzipped_name, new_name)
-                        os.rename(unzipped_name, new_name)
-                        if file_time:
-                            os.utime(new_name, (file_time, file_time))
+                        write_to_file(unzipped_filename(name), zip_obj.read(name), 'wb', file_time)
             else:
                 print('\tSkipping 0Kb zip file.')
-            os.remove(data_filename)
+            update_download_stats(activity_id, args.directory, shard_filename(DOWNLOADED_IDS_FILE_NAME, args.shard))
+            return True
+
+        # no need to set the time of a ZIP file that gets removed after unzipping
+        write_to_file(data_filename, data, file_mode, None if unzip else file_time)
+        if args.simplify and data:
+            from simplify import simplified_filename  # pylint: disable=import-outside-toplevel
+
+            SIMPLIFIER.submit(
+                data,
+                args.simplify,
+                lambda simplified: write_to_file(simplified_filename(data_filename), simplified, 'wb', file_time),
+            )
+
+        # Success: Add activity ID to downloaded_ids.json
+        update_download_stats(activity_id, args.directory, shard_filename(DOWNLOADED_IDS_FILE_NAME, args.shard))
+
+        if args.format == 'original':
+            # Even manual upload of a GPX file is zipped, but we'll validate the extension.
+            if unzip:
+                logging.debug('Unzipping and removing original file, size is %s', os.stat(data_filename).st_size)
+                if os.stat(data_filename).st_size > 0:
+                    import zipfile  # pylint: disable=import-outside-toplevel
+
+                    with open(data_filename, 'rb') as zip_file, zipfile.ZipFile(zip_file) as zip_obj:
+                        for name in zip_obj.namelist():
+                            unzipped_name = zip_obj.extract(name, directory)
+                            new_name = unzipped_filename(name)
+                            logging.debug('renaming %s to %s', unzipped_name, new_name)
+                            METADATA.rename(unzipped_name, new_name)
+                            FILE_INDEX.add(new_name)
+                            if file_time:
+                                METADATA.utime(new_name, file_time)
+                else:
+                    print('\tSkipping 0Kb zip file.')
+                # after the renames, so that an interrupted run leaves the ZIP file behind rather than nothing
+                METADATA.remove(data_filename)
+                FILE_INDEX.discard(data_filename)
 
     # Inform the main program that the file is new
     return True
 
 
+def existing_data_files(activity_id, args):
+    """
+    The data files of an activity in the export directory, in any name (e.g. with '--desc') and
+    subdirectory, including the simplified copies, but not the saved JSON files
+
+    :param activity_id: ID of the activity (as string)
+    :param args:        command-line arguments (for args.format)
+    :return:            sorted list of paths
+    """
+    # not all 'original' files are in FIT format, see 'export_data_file'
+    extensions = ('.zip', '.fit', '.gpx', '.tcx') if args.format == 'original' else (f'.{args.format}',)
+    return [
+        path
+        for path in FILE_INDEX.find(activity_id)
+        if os.path.splitext(path)[1] in extensions and not BUNDLED_PATTERN.match(os.path.basename(path))
+    ]
+
+
+def remove_data_files(paths):
+    """
+    Remove data files of an activity, e.g. the ones written by a failed attempt to export it; from the packs
+    they are only forgotten (the next copy added replaces them)
+    """
+    for path in paths:
+        logging.info('Removing %s', path)
+        if not packs_active():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        FILE_INDEX.discard(path)
+
+
+def refresh_changed(actvty, args):
+    """
+    Compare the summary of an activity with the one of its export (option '--refresh-changed', see changes.py);
+    the data files of a changed activity are removed, so that it gets exported again
+
+    :param actvty: activity summary (from the activity list)
+    :param args:   command-line arguments
+    :return:       True if the activity was exported already and is unchanged
+    """
+    activity_id = str(actvty['activityId'])
+    data_files = existing_data_files(activity_id, args)
+    change = CHANGES.check(actvty, bool(data_files))
+    if change == CHANGED:
+        logging.info('Activity %s changed since its export, removing %s', activity_id, data_files)
+        print(f'Changed    : Garmin Connect activity [{activity_id}], exporting it again')
+        from simplify import SIMPLIFIED_EXTENSION  # pylint: disable=import-outside-toplevel
+
+        for path in data_files:
+            # without '--simplify' the simplified copy wouldn't be written again
+            if args.simplify or not path.endswith(SIMPLIFIED_EXTENSION):
+                os.remove(path)
+                FILE_INDEX.discard(path)
+    return change == UNCHANGED
+
+
+def replace_refreshed_rows(csv_filename, args):
+    """Put the CSV rows of the activities exported again in the place of their old rows (option '--refresh-changed')"""
+    from csv_compact import replace_rows  # pylint: disable=import-outside-toplevel
+
+    with open(args.template, 'r', encoding='utf-8') as prop:
+        csv_headers = load_properties(prop.read())
+    try:
+        removed = replace_rows(csv_filename, csv_headers.get('id', 'Activity ID'), CHANGES.refreshed)
+    except ValueError as ex:
+        logging.warning('Unable to replace the CSV rows of the changed activities: %s', ex)
+        return
+    print(f'{len(CHANGES.refreshed)} changed activities exported again, {removed} old CSV rows replaced')
+
+
+def compact_activities_csv(args):
+    """
+    Deduplicate and sort the 'activities.csv' file in the export directory (option '--compact-csv')
+
+    The column names for the activity ID and the start time are taken from the CSV template,
+    so the template should be the same that was used for writing the CSV file.
+    :param args: command-line arguments (for args.directory and args.template)
+    """
+    from csv_compact import TIME_COLUMN_PARSERS, compact_csv  # pylint: disable=import-outside-toplevel
+
+    csv_filename = os.path.join(args.directory, 'activities.csv')
+    if not os.path.isfile(csv_filename):
+        logging.warning('No CSV file %s to compact', csv_filename)
+        return
+
+    with open(args.template, 'r', encoding='utf-8') as prop:
+        csv_headers = load_properties(prop.read())
+    id_column = csv_headers.get('id', 'Activity ID')
+    time_columns = [(csv_headers[key], parser) for key, parser in TIME_COLUMN_PARSERS.items() if key in csv_headers]
+
+    print('Compacting ', csv_filename, '...', sep='', end='')
+    rows_read, rows_written = compact_csv(csv_filename, id_column, time_columns)
+    print(f' Done. {rows_read} rows read, {rows_read - rows_written} duplicates removed.')
+
+
+def activity_start_times(directory):
+    """
+    Start times of the activities, from the activity lists cached in the export directory
+
+    :param directory: export directory with the 'activities-*.json' files (in any form, see artifacts.py)
+    :return:          dict activity ID (as string) -> start time in seconds since 1970-01-01
+    """
+    start_times = {}
+    for filename in ARTIFACTS.names(directory, 'activities-*.json'):
+        try:
+            summaries = json.loads(ARTIFACTS.read(filename))
+        except (ValueError, OSError) as ex:
+            logging.warning('Skipping %s: %s', filename, ex)
+            continue
+        for summary in summaries if isinstance(summaries, list) else []:
+            if present('activityId', summary):
+                start_time = epoch_seconds_from_summary(summary)
+                if start_time:
+                    start_times[str(summary['activityId'])] = start_time
+    return start_times
+
+
+def fix_times(args):
+    """
+    Set the file times of the activity files in the export directory (and its subdirectories) to the
+    activity start times, taken from the cached activity lists (option '--fix-times'); no downloads
+    """
+    print('Reading cached activity lists...', end='')
+    start_times = activity_start_times(args.directory)
+    print(f' Done. {len(start_times)} activities.')
+    if not start_times:
+        logging.warning('No cached activity lists (activities-*.json) found in %s', args.directory)
+        return
+
+    checked = 0
+    stamped = 0
+    FILE_INDEX.scan(args.directory)
+    for activity_id, path in FILE_INDEX.files():
+        if activity_id not in start_times:
+            continue
+        checked += 1
+        if int(os.stat(path).st_mtime) != start_times[activity_id]:
+            METADATA.utime(path, start_times[activity_id])
+            stamped += 1
+    METADATA.flush()
+    print(f'{stamped} of {checked} activity files re-stamped' + (f', {METADATA.errors} errors' if METADATA.errors else ''))
+
+
 def setup_logging(args):
     """Setup logging"""
     logpath = args.logpath if args.logpath else args.directory
@@ -911,34 +1536,35 @@ def fetch_userstats(args):
     """
     print('Getting display name...', end='')
     logging.info('Profile page %s', URL_GC_USER)
-    profile_page = http_req_as_string(URL_GC_USER)
+    profile_page = http_req(URL_GC_USER)
     if args.verbosity > 0:
-        write_to_file(os.path.join(args.directory, 'user.json'), profile_page, 'w')
+        write_artifact(os.path.join(args.directory, 'user.json'), profile_page, 'w')
 
     display_name = json.loads(profile_page)['displayName']
     print(' Done. displayName=', display_name, sep='')
 
     print('Fetching user stats...', end='')
     logging.info('Userstats page %s', URL_GC_USERSTATS + display_name)
-    result = http_req_as_string(URL_GC_USERSTATS + display_name)
+    result = http_req(URL_GC_USERSTATS + display_name)
     print(' Done.')
 
     # Persist JSON
-    write_to_file(os.path.join(args.directory, 'userstats.json'), result, 'w')
+    write_artifact(os.path.join(args.directory, 'userstats.json'), result, 'w')
 
     return json.loads(result)
 
 
-def fetch_activity_list(args, total_to_download):
+def fetch_activity_pages(args, total_to_download):
     """
     Fetch the first 'total_to_download' activity summaries; as a side effect save them in json format.
+    A page is only fetched when the caller asks for it, so only one page is held in memory at a time.
     :param args:              command-line arguments (for args.directory etc)
     :param total_to_download: number of activities to download
-    :return:                  List of activity summaries
+    :return:                  iterator over the pages (lists of activity summaries), see 'fetch_activity_chunk'
     """
 
     # This while loop will download data from the server in multiple chunks, if necessary.
-    activities = []
+    activity_count = 0
 
     total_downloaded = 0
     while total_downloaded < total_to_download:
@@ -950,23 +1576,27 @@ def fetch_activity_list(args, total_to_download):
         else:
             num_to_download = total_to_download - total_downloaded
 
-        chunk = fetch_activity_chunk(args, num_to_download, total_downloaded)
-        activities.extend(chunk)
+        # the whole page before it is processed, the connection isn't kept open meanwhile
+        page = list(fetch_activity_chunk(args, num_to_download, total_downloaded))
+        activity_count += len(page)
+        yield page
         total_downloaded += num_to_download
+        # the userstats count all activities, with a date range a short chunk is the end of the list
+        if (args.start_date or args.end_date) and len(page) < num_to_download:
+            break
 
     # it seems that parent multisport activities are not counted in userstats
-    if len(activities) != total_to_download:
-        logging.info('Expected %s activities, got %s.', total_to_download, len(activities))
-    return activities
+    if activity_count != total_to_download:
+        logging.info('Expected %s activities, got %s.', total_to_download, activity_count)
 
 
-def annotate_activity_list(activities, start, exclude_list, type_filter):
+def annotate_activity_list(activities, start, exclude_list, type_filter, first_index=0):
     """
     Creates an action list with a tuple per activity summary
 
     The tuple per activity contains three values:
     - index:    the index of the activity summary in the activities argument
-                (the first gets index 0, the second index 1 etc)
+                (the first gets index 'first_index', the second index 'first_index' + 1 etc)
     - activity  the activity summary from the activites argument
     - action    the action to take for this activity (d=download, s=skip, e=exclude)
 
@@ -975,11 +1605,12 @@ def annotate_activity_list(activities, start, exclude_list, type_filter):
                           (i.e. with 1 no activity gets skipped, with 2 the first activity gets skipped etc)
     :param exclude_list:  List of activity ids that have to be skipped explicitly
     :param type_filter:   list of activity types to include in the output
+    :param first_index:   index of the first activity summary in the whole activity list (e.g. of a page)
     :return:              List of action tuples
     """
 
     action_list = []
-    for index, activity in enumerate(activities):
+    for index, activity in enumerate(activities, first_index):
         if index < (start - 1):
             action = 's'
         elif str(activity['activityId']) in exclude_list:
@@ -1000,13 +1631,74 @@ def annotate_activity_list(activities, start, exclude_list, type_filter):
     return action_list
 
 
+def fetch_action_pages(args, exclude_list, type_filter):
+    """
+    Query the number of activities (if needed), then fetch the activity summaries and annotate them page by page
+
+    :param args:         command-line arguments (for args.count etc)
+    :param exclude_list: List of activity ids that have to be skipped explicitly
+    :param type_filter:  list of activity types to include in the output
+    :return:             tuple (number of activities expected, None with a date range; iterator over the pages
+                         (lists of action tuples, see 'annotate_activity_list'), each fetched when it is asked for)
+    """
+    # Query the userstats (activities totals on the profile page). Needed for
+    # filtering and for downloading 'all' to know how many activities are available
+    userstats_json = fetch_userstats(args)
+
+    if args.count == 'all':
+        total_to_download = int(userstats_json['userMetrics'][0]['totalActivities'])
+    else:
+        total_to_download = int(args.count)
+
+    def action_pages():
+        first_index = 0
+        for activities in fetch_activity_pages(args, total_to_download):
+            yield annotate_activity_list(activities, args.start_activity_no, exclude_list, type_filter, first_index)
+            first_index += len(activities)
+
+    # the userstats count all activities, not only the ones of a date range
+    return (None if args.start_date or args.end_date else total_to_download), action_pages()
+
+
+def queued_pages(work_queue, fingerprint, action_pages):
+    """Pass on the pages of the action list (see 'fetch_action_pages'), adding them to a new work queue first"""
+    work_queue.start(fingerprint)
+    for page in action_pages:
+        work_queue.add(page)
+        yield page
+    work_queue.listed()
+
+
+def work_queue_fingerprint(args, exclude_list):
+    """
+    The arguments determining the action list and the files written for it;
+    the work queue of a previous run is only resumed if they are unchanged
+    """
+    return {
+        'count': args.count,
+        'start_date': args.start_date,
+        'end_date': args.end_date,
+        'start_activity_no': args.start_activity_no,
+        'exclude': sorted(exclude_list),
+        'type_filter': args.type_filter,
+        'format': args.format,
+        'subdir': args.subdir,
+        'unzip': args.unzip,
+        'desc': args.desc,
+        'fileprefix': args.fileprefix,
+        'template': os.path.abspath(args.template),
+    }
+
+
 def fetch_activity_chunk(args, num_to_download, total_downloaded):
     """
     Fetch a chunk of activity summaries; as a side effect save them in json format.
+    The summaries are parsed (and returned) while the response is read, see jsonstream.py;
+    the parts of a multisport activity follow the multisport activity.
     :param args:              command-line arguments (for args.directory etc)
     :param num_to_download:   number of summaries to download in this chunk
     :param total_downloaded:  number of already downloaded summaries in previous chunks
-    :return:                  List of activity summaries
+    :return:                  iterator over the activity summaries
     """
 
     search_params = {'start': total_downloaded, 'limit': num_to_download}
@@ -1018,45 +1710,73 @@ def fetch_activity_chunk(args, num_to_download, total_downloaded):
     # Query Garmin Connect
     print('Querying list of activities ', total_downloaded + 1, '..', total_downloaded + num_to_download, '...', sep='', end='')
     logging.info('Activity list URL %s', URL_GC_LIST + urlencode(search_params))
-    result = http_req_as_string(URL_GC_LIST + urlencode(search_params))
-    print(' Done.')
 
     # Persist JSON activities list
+    from sharding import shard_filename  # pylint: disable=import-outside-toplevel
+
     current_index = total_downloaded + 1
-    activities_list_filename = f'activities-{current_index}-{total_downloaded+num_to_download}.json'
-    write_to_file(os.path.join(args.directory, activities_list_filename), result, 'w')
-    activity_summaries = json.loads(result)
-    fetch_multisports(activity_summaries, http_req_as_string, args)
-    return activity_summaries
+    activities_list_filename = shard_filename(f'activities-{current_index}-{total_downloaded+num_to_download}.json', args.shard)
+    activity_summaries = fetch_json_stream(
+        URL_GC_LIST + urlencode(search_params), os.path.join(args.directory, activities_list_filename), iter_json_array
+    )
+    yield from iter_multisports(activity_summaries, http_req, args)
+    print(' Done.')
 
 
-def fetch_multisports(activity_summaries, http_caller, args):
+def fetch_json_stream(url, filename, parse, file_time=None):
     """
-    Search 'activity_summaries' for multisport activities and then
-    fetch the information for the activity parts (child activities)
-    and insert them into the 'activity_summaries' just after the multisport
-    activity
-    :param activity_summaries: list of activity summaries, will be modified in-place
+    Request JSON and parse it while it is read, saving the response unchanged (atomically) as artifact
+
+    :param url:       URL for the request
+    :param filename:  name of the artifact to write; it is complete once the iteration is done
+    :param parse:     function(stream, tee) returning an iterator, e.g. 'iter_json_array'
+    :param file_time: if given use as timestamp for the file written (in seconds since 1970-01-01)
+    :return:          iterator returned by 'parse'
+    """
+    # if the iteration is abandoned, closing the generator closes the response and discards the artifact
+    # pylint: disable-next=contextmanager-generator-missing-cleanup
+    with http_response(url) as response, artifact_writer(filename, file_time) as json_file:
+        yield from parse(response, json_file.write)
+
+
+def iter_multisports(activity_summaries, http_caller, args):
+    """
+    Pass on the activity summaries, fetching the information for the activity parts (child activities)
+    of multisport activities, which follow their multisport activity
+    :param activity_summaries: iterable of activity summaries
     :param http_caller:        callback to perform the HTTP call for downloading the activity details
     :param args:               command-line arguments (for args.directory etc)
+    :return:                   iterator over the activity summaries
     """
-    for idx, child_summary in enumerate(activity_summaries):
-        type_key = None if absent_or_null('activityType', child_summary) else child_summary['activityType']['typeKey']
+    for activity_summary in activity_summaries:
+        yield activity_summary
+        type_key = None if absent_or_null('activityType', activity_summary) else activity_summary['activityType']['typeKey']
         if type_key == 'multi_sport':
-            _, details = fetch_details(child_summary['activityId'], http_caller)
+            _, details = fetch_details(activity_summary['activityId'], http_caller)
 
             child_ids = (
                 details['metadataDTO']['childIds'] if 'metadataDTO' in details and 'childIds' in details['metadataDTO'] else None
             )
-            # insert the children in reversed order always at the same index to get
-            # the correct order in activity_summaries
-            for child_id in reversed(child_ids):
+            for child_id in child_ids:
                 child_string, child_details = fetch_details(child_id, http_caller)
                 if args.verbosity > 0:
-                    write_to_file(os.path.join(args.directory, f'child_{child_id}.json'), child_string, 'w')
+                    write_artifact(os.path.join(args.directory, f'child_{child_id}.json'), child_string, 'w')
                 child_summary = {}
                 copy_details_to_summary(child_summary, child_details)
-                activity_summaries.insert(idx + 1, child_summary)
+                yield child_summary
+
+
+def fetch_multisports(activity_summaries, http_caller, args):
+    """
+    Search 'activity_summaries' for multisport activities and then
+    fetch the information for the activity parts (child activities)
+    and insert them into the 'activity_summaries' just after the multisport
+    activity
+    :param activity_summaries: list of activity summaries, will be modified in-place
+    :param http_caller:        callback to perform the HTTP call for downloading the activity details
+    :param args:               command-line arguments (for args.directory etc)
+    """
+    activity_summaries[:] = list(iter_multisports(activity_summaries, http_caller, args))
 
 
 def fetch_details(activity_id, http_caller):
@@ -1083,9 +1803,11 @@ def fetch_details(activity_id, http_caller):
                 logging.info("Retrying activity details download %s", URL_GC_ACTIVITY + str(activity_id))
                 if tries == 0:
                     raise GarminException(f'Didn\'t get "summaryDTO" after {MAX_TRIES} tries for {activity_id}')
+                STATS.record_retry('details')
         except HTTPError as ex:
             if tries > 0:
                 logging.info("HTTP %s, retrying activity details download %s", ex.code, URL_GC_ACTIVITY + str(activity_id))
+                STATS.record_retry('details')
             else:
                 raise GarminException(f'No tries left. Could not download details for {activity_id}') from ex
     return activity_details, details
@@ -1129,7 +1851,7 @@ def process_activity_item(item, number_of_items, device_dict, type_filter, activ
     Process one activity item: download the data, parse it and write a line to the CSV file
 
     :param item:               activity item tuple, see `annotate_activity_list()`
-    :param number_of_items:    total number of items (for progress output)
+    :param number_of_items:    total number of items (for progress output), '?' if not known in advance
     :param device_dict:        cache (dict) of already known devices
     :param type_filter:        list of activity types to include in the output
     :param activity_type_name: lookup table for activity type descriptions
@@ -1140,6 +1862,9 @@ def process_activity_item(item, number_of_items, device_dict, type_filter, activ
     current_index = item['index'] + 1
     actvty = item['activity']
     action = item['action']
+    if present('startTimeLocal', actvty):
+        # for '--bundle-json', also the artifacts of earlier runs
+        ARTIFACTS.set_month(actvty['activityId'], actvty['startTimeLocal'])
 
     # Action: skipping
     if action == 's':
@@ -1166,6 +1891,12 @@ def process_activity_item(item, number_of_items, device_dict, type_filter, activ
         print(f"({current_index}/{number_of_items}) [{actvty['activityId']}]")
         return
 
+    # Exported already and unchanged in Garmin Connect: skipping without requesting the details
+    if args.refresh_changed and refresh_changed(actvty, args):
+        print('Unchanged  : Garmin Connect activity ', end='')
+        print(f"({current_index}/{number_of_items}) [{actvty['activityId']}]")
+        return
+
     # Action: download
     # Display which entry we're working on.
     print('Downloading: Garmin Connect activity ', end='')
@@ -1176,7 +1907,8 @@ def process_activity_item(item, number_of_items, device_dict, type_filter, activ
     # the https://connect.garmin.com/modern/activity/xxx page), because some
     # data are missing from 'actvty' (or are even different, e.g. for my activities
     # 86497297 or 86516281)
-    activity_details, details = fetch_details(actvty['activityId'], http_req_as_string)
+    with STATS.phase(actvty['activityId'], 'details'):
+        activity_details, details = fetch_details(actvty['activityId'], http_req)
 
     extract = {}
     extract['start_time_with_offset'] = offset_date_time(actvty['startTimeLocal'], actvty['startTimeGMT'])
@@ -1205,48 +1937,114 @@ def process_activity_item(item, number_of_items, device_dict, type_filter, activ
     else:
         start_time_seconds = None
 
-    extract['device'] = extract_device(device_dict, details, start_time_seconds, args, http_req_as_string, write_to_file)
+    with STATS.phase(actvty['activityId'], 'device'):
+        extract['device'] = extract_device(device_dict, details, start_time_seconds, args, http_req, write_artifact)
 
     # try to get the JSON with all the samples (not all activities have it...),
     # but only if it's really needed for the CSV output
     extract['samples'] = None
-    if csv_filter.is_column_active('sampleCount'):
+    extract['metrics'] = {}
+    with_metrics = any(csv_filter.is_column_active(column) for column in METRICS_COLUMNS)
+    if csv_filter.is_column_active('sampleCount') or with_metrics:
+        skipped = tuple(name for name in SAMPLES_SKIPPED if not (with_metrics and name == 'activityDetailMetrics'))
         try:
             # TODO implement retries here, I have observed temporary failures
-            activity_measurements = http_req_as_string(f"{URL_GC_ACTIVITY}{actvty['activityId']}/details")
-            write_to_file(
-                os.path.join(args.directory, f"activity_{actvty['activityId']}_samples.json"),
-                activity_measurements,
-                'w',
-                start_time_seconds,
-            )
-            samples = json.loads(activity_measurements)
+            with STATS.phase(actvty['activityId'], 'samples'):
+                members = fetch_json_stream(
+                    f"{URL_GC_ACTIVITY}{actvty['activityId']}/details",
+                    os.path.join(args.directory, f"activity_{actvty['activityId']}_samples.json"),
+                    lambda stream, tee: iter_json_object(stream, tee, skipped),
+                    start_time_seconds,
+                )
+                samples = dict(members)
             extract['samples'] = samples
         except HTTPError as ex:
             logging.info("Unable to get samples for %d", actvty['activityId'])
             logging.exception(ex)
+    if with_metrics and extract['samples']:
+        with STATS.phase(actvty['activityId'], 'metrics'):
+            extract['metrics'] = compute_metrics(extract['samples'], args.hr_zones)
+        # the sample rows aren't needed anymore
+        extract['samples'].pop('activityDetailMetrics', None)
 
     extract['gear'] = None
     if csv_filter.is_column_active('gear'):
-        extract['gear'] = load_gear(str(actvty['activityId']), args)
+        with STATS.phase(actvty['activityId'], 'gear'):
+            extract['gear'] = load_gear(str(actvty['activityId']), args)
 
     extract['hrZones'] = HR_ZONES_EMPTY
     if csv_filter.is_column_active('hrZone1Low') or csv_filter.is_column_active('hrZone1Seconds'):
-        extract['hrZones'] = load_zones(str(actvty['activityId']), start_time_seconds, args, http_req_as_string, write_to_file)
+        with STATS.phase(actvty['activityId'], 'zones'):
+            extract['hrZones'] = load_zones(str(actvty['activityId']), start_time_seconds, args, http_req, write_artifact)
+
+    # Index the start and end points, also of the activities exported before the index existed
+    if GEO_INDEX is not None:
+        GEO_INDEX.add(
+            actvty['activityId'],
+            tuple(
+                from_activities_or_detail(element, actvty, details, 'summaryDTO') for element in ('startLatitude', 'startLongitude')
+            ),
+            tuple(from_activities_or_detail(element, actvty, details, 'summaryDTO') for element in ('endLatitude', 'endLongitude')),
+            actvty['startTimeLocal'],
+            activity_name,
+        )
 
     # Save the file and inform if it already existed. If the file already existed, do not append the record to the csv
-    if export_data_file(
-        str(actvty['activityId']), activity_details, args, start_time_seconds, append_desc, actvty['startTimeLocal']
-    ):
-        # Write stats to CSV.
-        csv_write_record(csv_filter, extract, actvty, details, activity_type_name, event_type_name)
+    path_fields = {
+        'TYPE': actvty['activityType'].get('typeKey') if present('activityType', actvty) else None,
+        'DEVICE': extract['device'],
+    }
+    files_before = set(existing_data_files(str(actvty['activityId']), args))
+    try:
+        if export_data_file(
+            str(actvty['activityId']),
+            activity_details,
+            args,
+            start_time_seconds,
+            append_desc,
+            actvty['startTimeLocal'],
+            path_fields,
+        ):
+            # Write stats to CSV.
+            with CSV_LOCK:
+                csv_write_record(csv_filter, extract, actvty, details, activity_type_name, event_type_name)
+    except Exception:
+        # a retry ('--keep-going', '--resume') skips an activity whose data file exists, it would never get its CSV row
+        remove_data_files(sorted(set(existing_data_files(str(actvty['activityId']), args)) - files_before))
+        raise
+    # also for the activities exported before, so that '--refresh-changed' can compare them
+    CHANGES.record(actvty)
+
+
+def print_statistics(args):
+    """Print (and log) the request and timing statistics of the run, optionally dump them as JSON"""
+    summary = STATS.summary()
+    print()
+    print('\n'.join(summary))
+    logging.info('Request and timing statistics:\n%s', '\n'.join(summary))
+    if args.stats_json:
+        STATS.dump_json(args.stats_json)
+        logging.info('Statistics written to %s', args.stats_json)
 
 
 def main(argv):
     """
     Main entry point for gcexport.py
     """
+    global RATE_LIMITER  # pylint: disable=global-statement
+
     args = parse_arguments(argv)
+    if args.agent:
+        from session_agent import run_job  # pylint: disable=import-outside-toplevel
+
+        # the agent uses its own session, the credentials are not sent to it
+        exit_code = run_job(argv)
+        if exit_code is not None:
+            if exit_code:
+                sys.exit(exit_code)
+            return
+        print('No session agent running, exporting without it')
+
     setup_logging(args)
     logging.info("Starting %s version %s, using Python version %s", argv[0], SCRIPT_VERSION, python_version())
     logging_verbosity(args.verbosity)
@@ -1261,6 +2059,181 @@ def main(argv):
             MINIMUM_PYTHON_VERSION[1],
         )
 
+    if args.rate_limit:
+        from sharding import RateLimiter  # pylint: disable=import-outside-toplevel
+
+        RATE_LIMITER = RateLimiter()
+        RATE_LIMITER.configure(args.rate_limit, shared=args.shards is not None)
+    try:
+        if args.shards:
+            sharded_export(args)
+        elif args.profile:
+            profiled_export(args)
+        else:
+            export(args)
+    finally:
+        # also if the export failed
+        finish_background_work()
+
+
+def template_columns(template):
+    """Return the list of the column keys of a CSV header template"""
+    with open(template, 'r', encoding='utf-8') as prop:
+        csv_columns = []
+        load_properties(prop.read(), keys=csv_columns)
+    return csv_columns
+
+
+def load_property_table(property_cache, url, filename, args):
+    """
+    Return a lookup table (dict) from a properties file on Garmin Connect, using the cached table
+    while it is fresh or unchanged on the server
+
+    :param property_cache: PropertyCache of the export directory
+    :param url:            URL of the properties file
+    :param filename:       name for saving the downloaded properties file (with option '--verbosity')
+    :param args:           command-line arguments
+    """
+
+    def parse(props):
+        if args.verbosity > 0:
+            write_to_file(os.path.join(args.directory, filename), props, 'w')
+        return load_properties(props)
+
+    return property_cache.get(url, http_req_conditional, parse)
+
+
+def reset_state():
+    """
+    Start the next export in this process with fresh module state (statistics, file index, known directories,
+    pending file operations, ...), like a new process; used by the session agent, which runs many exports
+    """
+    global STATS, FILE_SYNC, METADATA, FILE_INDEX, ARTIFACTS, PACKS, SIMPLIFIER, GEO_INDEX, CHANGES, RATE_LIMITER  # pylint: disable=global-statement
+    # normally done at the end of 'main' already
+    finish_background_work()
+    STATS = ExportStats()
+    FILE_SYNC = FileSync()
+    METADATA = MetadataWriter()
+    FILE_INDEX = ActivityFileIndex()
+    ARTIFACTS = ArtifactStore()
+    PACKS = SIMPLIFIER = GEO_INDEX = RATE_LIMITER = None
+    CHANGES = ChangeDetector()
+    forget_dirs()
+    compile_path_template.cache_clear()
+
+
+def profiled_export(args):
+    """Run 'export' with the sampling profiler, writing the profile to the log directory (option '--profile')"""
+    from sampling_profiler import SamplingProfiler  # pylint: disable=import-outside-toplevel
+
+    profiler = SamplingProfiler()
+    profiler.start()
+    try:
+        export(args)
+    finally:
+        profiler.stop()
+        logpath = args.logpath if args.logpath else args.directory
+        folded_name, summary_name = profiler.write_results(logpath, f"gcexport-profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+        print(f'Profile written to {folded_name} and {summary_name}')
+
+
+def export_shard(args):
+    """Export one shard, in a worker process of 'sharded_export'"""
+    try:
+        export(args)
+    finally:
+        finish_background_work()
+
+
+def sharded_export(args):
+    """
+    Export the date range in shards, each by a worker process, and merge the files written per shard
+    (option '--shards', see sharding.py)
+    """
+    # pylint: disable=import-outside-toplevel
+    import multiprocessing
+
+    from sharding import merge_files, merge_id_files, shard_filename, shard_name, shard_ranges
+
+    if not os.path.isdir(args.directory):
+        os.makedirs(args.directory)
+    # the worker processes inherit the session
+    login_to_garmin_connect(args)
+
+    ranges = shard_ranges(args.start_date, args.end_date, args.shards)
+    print(f'Exporting {len(ranges)} shards in parallel: {", ".join(f"{first}..{last}" for first, last in ranges)}')
+    context = multiprocessing.get_context('fork')
+    workers = []
+    for first, last in ranges:
+        shard_args = argparse.Namespace(**vars(args))
+        shard_args.start_date, shard_args.end_date, shard_args.shard = first, last, shard_name(first, last)
+        # all activities of the range (see 'check_shards_arguments'); the CSV file is handed to the external program
+        # after the merge
+        shard_args.count, shard_args.shards, shard_args.external, shard_args.stats_json = 'all', None, None, None
+        worker = context.Process(target=export_shard, args=(shard_args,), name=f'shard-{shard_args.shard}')
+        worker.start()
+        workers.append((shard_args.shard, worker))
+    failed = []
+    for shard, worker in workers:
+        worker.join()
+        if worker.exitcode:
+            logging.error('Shard %s failed with exit code %s', shard, worker.exitcode)
+            failed.append(shard)
+
+    # the newest shard first, like the rows of a single run
+    shards = [shard for shard, _ in workers]
+    csv_filename = os.path.join(args.directory, 'activities.csv')
+    merge_files(
+        csv_filename, [os.path.join(args.directory, shard_filename('activities.csv', shard)) for shard in shards], header=True
+    )
+    merge_id_files(
+        os.path.join(args.directory, DOWNLOADED_IDS_FILE_NAME),
+        [os.path.join(args.directory, shard_filename(DOWNLOADED_IDS_FILE_NAME, shard)) for shard in shards],
+        KEY_IDS,
+    )
+    if args.keep_going:
+        from quarantine import QUARANTINE_FILE_NAME  # pylint: disable=import-outside-toplevel
+
+        quarantine_filename = os.path.join(args.directory, QUARANTINE_FILE_NAME)
+        # the file only describes the current run
+        with open(quarantine_filename, 'w', encoding='utf-8'):
+            pass
+        merge_files(
+            quarantine_filename, [os.path.join(args.directory, shard_filename(QUARANTINE_FILE_NAME, shard)) for shard in shards]
+        )
+    FILE_SYNC.policy = args.fsync
+    if FILE_SYNC.policy != 'none':
+        FILE_SYNC.add(csv_filename)
+    FILE_SYNC.flush()
+    logging.info('CSV files of %s shards merged', len(shards))
+
+    if failed:
+        raise GarminException(f'{len(failed)} of {len(shards)} shards failed: {", ".join(failed)}; see the log file')
+
+    if args.external:
+        print('Open CSV output.')
+        print(csv_filename)
+        call([args.external, "--" + args.args, csv_filename])
+
+    print(f'Done! {len(shards)} shards merged.')
+
+
+def export(args):
+    """
+    Perform the export (or the standalone operation) requested by the command-line arguments
+    """
+    global PACKS, SIMPLIFIER, GEO_INDEX  # pylint: disable=global-statement
+
+    if args.compact_csv:
+        compact_activities_csv(args)
+        return
+    if args.fix_times:
+        fix_times(args)
+        return
+
+    FILE_SYNC.policy = args.fsync
+    ARTIFACTS.compression = args.compress_json
+
     # Get filter list with IDs to exclude
     if args.exclude is not None:
         exclude_list = read_exclude(args.exclude)
@@ -1269,6 +2242,11 @@ def main(argv):
     else:
         exclude_list = []
 
+    csv_columns = template_columns(args.template)
+    if not numpy_available() and set(METRICS_COLUMNS).intersection(csv_columns):
+        print("The CSV template contains columns computed from the samples, which need the numpy package (pip install numpy)")
+        sys.exit(1)
+
     # Create directory for data files.
     if os.path.isdir(args.directory):
         logging.warning(
@@ -1276,68 +2254,160 @@ def main(argv):
         )
     else:
         os.mkdir(args.directory)
+    # one scan instead of probing for the files of every activity
+    FILE_INDEX.scan(args.directory)
+    if args.pack:
+        from packfile import PackWriter  # pylint: disable=import-outside-toplevel
 
-    login_to_garmin_connect(args)
+        PACKS = PackWriter()
+        PACKS.open(args.directory, FILE_SYNC)
+        for name in PACKS.names():
+            FILE_INDEX.add(os.path.join(args.directory, *name.split('/')))
 
-    # Query the userstats (activities totals on the profile page). Needed for
-    # filtering and for downloading 'all' to know how many activities are available
-    userstats_json = fetch_userstats(args)
-
-    if args.count == 'all':
-        total_to_download = int(userstats_json['userMetrics'][0]['totalActivities'])
-    else:
-        total_to_download = int(args.count)
-
-    # Load some dictionaries with lookup data from REST services
-    activity_type_props = http_req_as_string(URL_GC_ACT_PROPS)
-    if args.verbosity > 0:
-        write_to_file(os.path.join(args.directory, 'activity_types.properties'), activity_type_props, 'w')
-    activity_type_name = load_properties(activity_type_props)
-    event_type_props = http_req_as_string(URL_GC_EVT_PROPS)
-    if args.verbosity > 0:
-        write_to_file(os.path.join(args.directory, 'event_types.properties'), event_type_props, 'w')
-    event_type_name = load_properties(event_type_props)
-
-    activities = fetch_activity_list(args, total_to_download)
+    login_to_garmin_connect(args)
 
-    type_filter = args.type_filter.split(',') if args.type_filter is not None else None
+    # Persistent state of the export directory (device registry, property tables, work queue)
+    state_store = StateStore(os.path.join(args.directory, STATE_FILE_NAME))
+    try:
+        from geoindex import GeoIndex  # pylint: disable=import-outside-toplevel
+
+        GEO_INDEX = GeoIndex(state_store)
+        CHANGES.open(state_store)
+        if args.simplify:
+            from simplify import SimplifyPool  # pylint: disable=import-outside-toplevel
+
+            SIMPLIFIER = SimplifyPool()
+
+        # Load the lookup tables from REST services, if the CSV template uses them
+        property_cache = PropertyCache(state_store, PROPERTIES_TTL_DAYS * 86400)
+        activity_type_name = {}
+        if 'activityType' in csv_columns or 'activityParent' in csv_columns:
+            activity_type_name = load_property_table(property_cache, URL_GC_ACT_PROPS, 'activity_types.properties', args)
+        event_type_name = {}
+        if 'eventType' in csv_columns:
+            event_type_name = load_property_table(property_cache, URL_GC_EVT_PROPS, 'event_types.properties', args)
+
+        type_filter = args.type_filter.split(',') if args.type_filter is not None else None
+
+        # With '--resume' continue with the unfinished activities of an interrupted run, if there is one
+        work_queue = None
+        action_list = None
+        if args.resume is not None:
+            work_queue = WorkQueue(state_store)
+            queue_fingerprint = work_queue_fingerprint(args, exclude_list)
+            action_list = work_queue.resume(queue_fingerprint, args.resume * 3600)
+            if action_list is not None:
+                print(f'Resuming previous run, {len(action_list)} of {work_queue.total} activities left')
+                logging.info('Resuming work queue with %s of %s activities left', len(action_list), work_queue.total)
+
+        if action_list is None:
+            # each page of the activity list is processed before the next one is fetched
+            expected_items, action_pages = fetch_action_pages(args, exclude_list, type_filter)
+            number_of_items = expected_items or '?'
+            if work_queue:
+                action_pages = queued_pages(work_queue, queue_fingerprint, action_pages)
+        else:
+            action_pages = [action_list]
+            number_of_items = work_queue.total
 
-    action_list = annotate_activity_list(activities, args.start_activity_no, exclude_list, type_filter)
+        from sharding import shard_filename  # pylint: disable=import-outside-toplevel
 
-    csv_filename = os.path.join(args.directory, 'activities.csv')
-    csv_existed = os.path.isfile(csv_filename)
+        csv_filename = os.path.join(args.directory, shard_filename('activities.csv', args.shard))
+        csv_existed = os.path.isfile(csv_filename)
 
-    device_dict = {}
-    with open(csv_filename, mode='a', encoding='utf-8') as csv_file:
-        csv_filter = CsvFilter(csv_file, args.template)
+        quarantine = None
+        if args.keep_going:
+            from quarantine import QUARANTINE_FILE_NAME, Quarantine  # pylint: disable=import-outside-toplevel
 
-        # Write header to CSV file
-        if not csv_existed:
-            csv_filter.write_header()
+            quarantine = Quarantine(args.directory, last_request_url, shard_filename(QUARANTINE_FILE_NAME, args.shard))
 
-        # Process each activity.
-        for item in action_list:
-            try:
-                process_activity_item(
-                    item, len(action_list), device_dict, type_filter, activity_type_name, event_type_name, csv_filter, args
-                )
-            except Exception as ex_item:
-                activity_id = (
-                    item['activity']['activityId']
-                    if present('activity', item) and present('activityId', item['activity'])
-                    else "(unknown id)"
-                )
-                logging.error("Error during processing of activity '%s': %s/%s", activity_id, type(ex_item), ex_item)
-                raise
+        # Device names known from previous runs, see '--device-ttl'
+        device_dict = DeviceRegistry(state_store, args.device_ttl * 86400) if args.device_ttl > 0 else {}
+        with open(csv_filename, mode='a', encoding='utf-8') as csv_file:
+            csv_filter = CsvFilter(csv_file, args.template)
 
-    logging.info('CSV file written.')
+            # The rows keep the columns appended to the CSV file they go to (of a shard: the file it is merged into)
+            header_filename = csv_filename if args.shard is None else os.path.join(args.directory, 'activities.csv')
+            if os.path.isfile(header_filename):
+                with open(header_filename, 'r', encoding='utf-8', newline='') as csv_in:
+                    csv_filter.match_header(next(csv.reader(csv_in), []))
 
-    if args.external:
-        print('Open CSV output.')
-        print(csv_filename)
-        call([args.external, "--" + args.args, csv_filename])
+            # Write header to CSV file
+            if not csv_existed:
+                csv_filter.write_header()
 
-    print('Done!')
+            # Process each activity.
+            for item in itertools.chain.from_iterable(action_pages):
+                if work_queue:
+                    work_queue.mark(item['index'], IN_FLIGHT)
+                try:
+                    process_activity_item(
+                        item, number_of_items, device_dict, type_filter, activity_type_name, event_type_name, csv_filter, args
+                    )
+                except Exception as ex_item:  # pylint: disable=broad-except
+                    activity_id = (
+                        item['activity']['activityId']
+                        if present('activity', item) and present('activityId', item['activity'])
+                        else "(unknown id)"
+                    )
+                    logging.error("Error during processing of activity '%s': %s/%s", activity_id, type(ex_item), ex_item)
+                    if work_queue:
+                        work_queue.mark(item['index'], FAILED, f'{type(ex_item).__name__}: {ex_item}')
+                    if not quarantine:
+                        raise
+                    quarantine.add(item, ex_item)
+                    print(f'\tFailed: {type(ex_item).__name__}: {ex_item}; quarantined')
+                    continue
+                if work_queue:
+                    work_queue.mark(item['index'], DONE)
+
+            if quarantine and quarantine.records:
+                print(f'Retrying {len(quarantine.records)} quarantined activities...')
+
+                def retry_item(item):
+                    process_activity_item(
+                        item, number_of_items, device_dict, type_filter, activity_type_name, event_type_name, csv_filter, args
+                    )
+                    if work_queue:
+                        work_queue.mark(item['index'], DONE)
+
+                quarantine.retry(retry_item)
+
+        if CHANGES.refreshed:
+            replace_refreshed_rows(csv_filename, args)
+
+        if args.bundle_json:
+            # the file times of the artifacts must be set before they are bundled
+            METADATA.flush()
+            bundled = ARTIFACTS.bundle(args.directory, FILE_SYNC)
+            for filename in bundled:
+                FILE_INDEX.discard(filename)
+            logging.info('%s JSON files moved into the monthly bundles', len(bundled))
+
+        # the simplified GPX files must be written before the file times are applied and the packs are closed
+        # (which writes the index of the last pack)
+        finish_background_work()
+        if FILE_SYNC.policy != 'none':
+            FILE_SYNC.add(csv_filename)
+        FILE_SYNC.flush()
+        logging.info('CSV file written.')
+
+        print_statistics(args)
+
+        if quarantine:
+            for line in quarantine.summary():
+                print(line)
+                logging.warning(line)
+
+        if args.external:
+            print('Open CSV output.')
+            print(csv_filename)
+            call([args.external, "--" + args.args, csv_filename])
+
+        print('Done!')
+    finally:
+        # e.g. the session agent runs many exports in one process
+        state_store.close()
 
 
 if __name__ == "__main__":
@@ -7,6 +7,12 @@ py.test gcexport_test.py
 
 from gcexport import *
 from io import StringIO
+from packfile import PackReader, PackWriter
+import gzip
+import time
+
+import garth
+import pytest
 
 
 def test_pace_or_speed_raw_cycling():
@@ -51,6 +57,12 @@ def test_datetime_from_iso():
     assert datetime_from_iso("2018-03-08 12:23:22.0") == datetime(2018, 3, 8, 12, 23, 22, 0)
     assert datetime_from_iso("2018-03-08T12:23:22") == datetime(2018, 3, 8, 12, 23, 22, 0)
     assert datetime_from_iso("2018-03-08T12:23:22.0") == datetime(2018, 3, 8, 12, 23, 22, 0)
+    assert datetime_from_iso("2018-03-08 12:23:22.12") == datetime(2018, 3, 8, 12, 23, 22, 120000)
+    assert datetime_from_iso("2018-03-08 12:23:22.1234567") == datetime(2018, 3, 8, 12, 23, 22, 123456)
+    # an offset is ignored, the result is always 'naive'
+    assert datetime_from_iso("2018-03-08T12:23:22+01:00") == datetime(2018, 3, 8, 12, 23, 22, 0)
+    with pytest.raises(GarminException):
+        datetime_from_iso("2018-03-08")
 
 
 def test_epoch_seconds_from_summary():
@@ -101,6 +113,16 @@ def test_load_properties_keys():
     assert csv_headers['startTimeIso'] == "Start Time"
 
 
+def test_load_properties_values():
+    props = load_properties('# comment\n\nactivity_type_running = "Running"\nurl=http://x?a=b\n')
+    assert props == {'activity_type_running': 'Running', 'url': 'http://x?a=b'}
+
+
+def test_template_columns():
+    assert template_columns('csv_header_default.properties')[:3] == ['startTimeIso', 'endTimeIso', 'id']
+    assert 'activityType' not in template_columns('csv_header_moderation.properties')
+
+
 def test_csv_write_record():
     with open('json/activitylist-service.json') as json_data_1:
         activities = json.load(json_data_1)
@@ -131,6 +153,29 @@ def test_csv_write_record():
     assert csv_file.getvalue()[69 : 69 + len(expected)] == expected
 
 
+def test_csv_filter_match_header():
+    csv_file = StringIO()
+    csv_filter = CsvFilter(csv_file, 'csv_header_default.properties')
+    csv_filter.write_header()
+    header = next(csv.reader(StringIO(csv_file.getvalue())))
+
+    # a column added by routes.py is kept (empty) in the appended rows
+    csv_file = StringIO()
+    csv_filter = CsvFilter(csv_file, 'csv_header_default.properties')
+    csv_filter.match_header(header + ['Route Cluster'])
+    csv_filter.set_column('id', '2541953812')
+    csv_filter.write_row()
+    row = next(csv.reader(StringIO(csv_file.getvalue())))
+    assert len(row) == len(header) + 1 and row[-1] == ''
+
+    # the header of another template is left alone
+    csv_file = StringIO()
+    csv_filter = CsvFilter(csv_file, 'csv_header_default.properties')
+    csv_filter.match_header(['Activity ID', 'Route Cluster'])
+    csv_filter.write_row()
+    assert len(next(csv.reader(StringIO(csv_file.getvalue())))) == len(header)
+
+
 def write_to_file_mock(filename, content, mode, file_time=None):
     pass
 
@@ -140,6 +185,139 @@ def http_req_mock_device(url, post=None, headers=None):
         return json_device.read()
 
 
+def test_write_to_file(tmp_path):
+    # bytes are written unchanged, str as UTF-8
+    write_to_file(str(tmp_path / 'a.gpx'), 'Biel 🏛 Pavillon'.encode('utf-8'), 'w')
+    write_to_file(str(tmp_path / 'b.gpx'), 'Biel 🏛 Pavillon', 'w')
+    with open(tmp_path / 'a.gpx', 'rb') as file_a, open(tmp_path / 'b.gpx', 'rb') as file_b:
+        assert file_a.read() == file_b.read() == 'Biel 🏛 Pavillon'.encode('utf-8')
+
+
+def test_fix_times(tmp_path):
+    with open('json/activity_2541953812_overview.json') as json_timestamp:
+        summary = json.load(json_timestamp)
+    with open(tmp_path / 'activities-0-1.json', 'w') as activities:
+        json.dump([summary], activities)
+    os.makedirs(tmp_path / '2018')
+    for name in ['activity_2541953812.fit', 'activity_2541953812_zones.json', '2018/20180308-112322-activity_2541953812.gpx',
+                 'activity_1.gpx', 'activities.csv']:  # fmt: skip
+        write_to_file(str(tmp_path / name), b'', 'wb')
+
+    fix_times(parse_arguments(['', '--fix-times', '-d', str(tmp_path)]))
+    for name in ['activity_2541953812.fit', 'activity_2541953812_zones.json', '2018/20180308-112322-activity_2541953812.gpx']:
+        assert os.stat(tmp_path / name).st_mtime == 1520508202
+    for name in ['activity_1.gpx', 'activities.csv']:
+        assert os.stat(tmp_path / name).st_mtime != 1520508202
+
+
+def test_activity_start_times_compressed(tmp_path):
+    with open('json/activity_2541953812_overview.json', 'rb') as json_timestamp:
+        summary = json_timestamp.read()
+    ArtifactStore('gzip').write(str(tmp_path / 'activities-1-1.json'), b'[' + summary + b']')
+    assert activity_start_times(str(tmp_path)) == {'2541953812': 1520508202}
+
+
+def test_export_data_file_index(tmp_path):
+    args = parse_arguments(['', '-f', 'json', '-d', str(tmp_path), '-s', '{YYYY}'])
+    write_to_file(str(tmp_path / 'activity_2.json'), '{}', 'w')
+    FILE_INDEX.scan(str(tmp_path))
+
+    assert export_data_file('1', '{}', args, None, '', '2018-03-08 11:23:22')
+    assert FILE_INDEX.find('1') == [str(tmp_path / '2018' / 'activity_1.json')]
+    # already exists (looked up in the index)
+    assert not export_data_file('1', '{}', args, None, '', '2018-03-08 11:23:22')
+    # the index is per path, an activity file in another subdirectory doesn't count
+    assert export_data_file('2', '{}', args, None, '', '2018-03-08 11:23:22')
+
+
+def test_export_data_file_pack(tmp_path, monkeypatch):
+    args = parse_arguments(['', '-f', 'json', '-d', str(tmp_path), '-s', '{YYYY}', '--pack', '--compress-json', 'gzip'])
+    ARTIFACTS.compression = args.compress_json
+    FILE_INDEX.scan(str(tmp_path))
+    packs = PackWriter()
+    monkeypatch.setattr('gcexport.PACKS', packs)
+    packs.open(str(tmp_path))
+    try:
+        assert export_data_file('1', '{"a": 1}', args, 1520508202, '', '2018-03-08 11:23:22')
+        assert not export_data_file('1', '{"a": 1}', args, 1520508202, '', '2018-03-08 11:23:22')
+        write_artifact(str(tmp_path / 'activity_1_zones.json'), '[]')
+    finally:
+        packs.close()
+        ARTIFACTS.compression = 'none'
+    assert not os.path.exists(tmp_path / '2018')
+    with PackReader(str(tmp_path / 'export-0001.pack')) as pack:
+        assert pack.names() == ['2018/activity_1.json', 'activity_1_zones.json.gz']
+        assert pack.read('2018/activity_1.json') == b'{"a": 1}'
+        assert pack.file_time('2018/activity_1.json') == 1520508202
+        assert gzip.decompress(pack.read('activity_1_zones.json.gz')) == b'[]'
+
+    with pytest.raises(SystemExit):
+        parse_arguments(['', '--pack', '--bundle-json'])
+
+
+def test_failed_activity_exported_again(tmp_path, monkeypatch):
+    def http_req_mock(url, post=None, headers=None, response_headers=None):
+        if url.startswith(URL_GC_ACTIVITY):
+            with open('json/activity_2541953812.json', encoding='utf-8') as json_detail:
+                return json_detail.read()
+        return '{}'
+
+    def failing_csv_write_record(*arguments):
+        raise OSError('disk full')
+
+    monkeypatch.setattr('gcexport.http_req', http_req_mock)
+    args = parse_arguments(['', '-f', 'json', '-d', str(tmp_path)])
+    FILE_INDEX.scan(str(tmp_path))
+    with open('json/activities-list.json', encoding='utf-8') as json_list:
+        item = {'index': 0, 'action': 'd', 'activity': json.load(json_list)[0]}
+    csv_file = StringIO()
+    csv_filter = CsvFilter(csv_file, args.template)
+
+    # the data file written before the failure is removed, otherwise the retry would skip the activity without a CSV row
+    with monkeypatch.context() as patch:
+        patch.setattr('gcexport.csv_write_record', failing_csv_write_record)
+        with pytest.raises(OSError):
+            process_activity_item(item, 1, {}, None, {}, {}, csv_filter, args)
+    assert not os.path.exists(tmp_path / 'activity_6609987243.json')
+    assert FILE_INDEX.find('6609987243') == []
+
+    process_activity_item(item, 1, {}, None, {}, {}, csv_filter, args)
+    assert os.path.exists(tmp_path / 'activity_6609987243.json')
+    assert '6609987243' in csv_file.getvalue()
+
+
+def test_refresh_changed(tmp_path, monkeypatch):
+    args = parse_arguments(['', '-d', str(tmp_path), '--desc', '--refresh-changed'])
+    for name in ('activity_1_Old_name.gpx', 'activity_1_Old_name.simplified.gpx', 'activity_1_samples.json', 'activity_2.gpx'):
+        write_to_file(str(tmp_path / name), '', 'w')
+    FILE_INDEX.scan(str(tmp_path))
+    changes = ChangeDetector(StateStore(str(tmp_path / STATE_FILE_NAME)))
+    monkeypatch.setattr('gcexport.CHANGES', changes)
+    summary = {'activityId': 1, 'activityName': 'Old name'}
+    assert existing_data_files('1', args) == [
+        str(tmp_path / 'activity_1_Old_name.gpx'),
+        str(tmp_path / 'activity_1_Old_name.simplified.gpx'),
+    ]
+
+    # exported before the hashes were kept
+    assert not refresh_changed(summary, args)
+    changes.record(summary)
+    assert refresh_changed(summary, args)
+    # renamed: the data file is removed, the simplified copy (without '--simplify') and the samples are kept
+    assert not refresh_changed(dict(summary, activityName='New name'), args)
+    assert changes.refreshed == {'1'}
+    assert sorted(os.listdir(tmp_path))[:3] == ['activity_1_Old_name.simplified.gpx', 'activity_1_samples.json', 'activity_2.gpx']
+    assert not os.path.exists(tmp_path / 'activity_1_Old_name.gpx')
+    assert existing_data_files('1', args) == [str(tmp_path / 'activity_1_Old_name.simplified.gpx')]
+
+    for invalid in (
+        ['--refresh-changed', '--pack'],
+        ['--refresh-changed', '--shards', '2', '-sd', '2015-01-01', '-ed', '2015-12-31'],
+    ):
+        with pytest.raises(SystemExit):
+            parse_arguments([''] + invalid)
+
+
 def test_extract_device():
     args = parse_arguments([])
 
@@ -156,6 +334,36 @@ def test_extract_device():
     assert None == extract_device({}, details, None, args, http_req_mock_device, write_to_file_mock)
 
 
+def test_extract_device_registry(tmp_path):
+    args = parse_arguments([])
+    with open('json/activity_2541953812.json') as json_detail:
+        details = json.load(json_detail)
+    calls = []
+
+    def counting_http_req(url):
+        calls.append(url)
+        return http_req_mock_device(url)
+
+    registry = DeviceRegistry(StateStore(str(tmp_path / 'state.sqlite')), 3600)
+    assert u'fēnix 5 10.0.0.0' == extract_device(registry, details, None, args, counting_http_req, write_to_file_mock)
+    assert len(calls) == 1
+
+    # the next run knows the device without downloading its details
+    registry = DeviceRegistry(StateStore(str(tmp_path / 'state.sqlite')), 3600)
+    assert u'fēnix 5 10.0.0.0' == extract_device(registry, details, None, args, counting_http_req, write_to_file_mock)
+    assert len(calls) == 1
+
+    # incomplete device details are only remembered for the run, the next run tries again
+    details['metadataDTO']['deviceApplicationInstallationId'] += 1
+    incomplete = []
+    assert extract_device(registry, details, None, args, lambda url: incomplete.append(url) or '{}', write_to_file_mock) is None
+    assert extract_device(registry, details, None, args, lambda url: incomplete.append(url) or '{}', write_to_file_mock) is None
+    assert len(incomplete) == 1
+    registry = DeviceRegistry(StateStore(str(tmp_path / 'state.sqlite')), 3600)
+    assert str(details['metadataDTO']['deviceApplicationInstallationId']) not in registry
+    assert u'fēnix 5 10.0.0.0' == extract_device(registry, details, None, args, counting_http_req, write_to_file_mock)
+
+
 def http_req_mock_zones(url, post=None, headers=None):
     with open('json/activity_2541953812_zones.json') as json_zones:
         return json_zones.read()
@@ -181,6 +389,16 @@ def test_resolve_path():
     assert resolve_path('root', 'sub/{yyyy}', '2018-03-08 12:23:22') == 'root/sub/{yyyy}'
     assert resolve_path('root', 'sub/{YYYYMM}', '2018-03-08 12:23:22') == 'root/sub/{YYYYMM}'
     assert resolve_path('root', 'sub/all', '2018-03-08 12:23:22') == 'root/sub/all'
+    assert resolve_path('root', '{YYYY}/{WW}/{DD}', '2018-12-31 12:23:22') == 'root/2018/01/31'
+    fields = {'TYPE': 'trail_running', 'DEVICE': u'fēnix 5 10.0.0.0'}
+    assert resolve_path('root', '{TYPE}/{DEVICE}', '2018-03-08 12:23:22', fields) == 'root/trail_running/fenix_5'
+    assert resolve_path('root', '{TYPE}/{DEVICE}', '2018-03-08 12:23:22') == 'root/unknown/unknown'
+
+
+def test_subdir_validation():
+    assert parse_arguments(['', '-s', '{YYYY}/{TYPE}']).subdir == '{YYYY}/{TYPE}'
+    with pytest.raises(SystemExit):
+        parse_arguments(['', '-s', '{YYYY}/{YYYYMM}'])
 
 
 mock_details_multi_counter = 0
@@ -202,6 +420,65 @@ def http_req_mock_details_multi(url, post=None, headers=None):
         raise Exception('mock_details_multi_counter has invalid value ' + str(mock_details_multi_counter))
 
 
+def test_hr_zones_argument():
+    assert parse_arguments(['', '--hr-zones', '120,140,155']).hr_zones == [120, 140, 155]
+    assert parse_arguments([]).hr_zones is None
+    for invalid in ('120,x', '140,120', '0', '100,110,120,130,140,150'):
+        with pytest.raises(SystemExit):
+            parse_arguments(['', '--hr-zones', invalid])
+
+
+def test_simplify_argument():
+    assert parse_arguments(['', '--simplify', '5m']).simplify == '5m'
+    for invalid in (['--simplify', '5'], ['--simplify', '5m', '-f', 'tcx']):
+        with pytest.raises(SystemExit):
+            parse_arguments([''] + invalid)
+
+
+def test_shards_argument():
+    args = parse_arguments(['', '--shards', '4', '-sd', '2015-01-01', '-ed', '2019-12-31', '--rate-limit', '5'])
+    assert args.shards == 4 and args.rate_limit == 5 and args.shard is None
+    assert parse_arguments(['', '--shards', '4', '-sd', '2015-01-01', '-ed', '2019-12-31', '-c', 'all']).count == 'all'
+    assert parse_arguments([]).count == '1'
+    for invalid in (
+        ['--shards', '4'],
+        ['--shards', '0', '-sd', '2015-01-01', '-ed', '2019-12-31'],
+        ['--shards', '4', '-sd', '2019-12-31', '-ed', '2015-01-01'],
+        ['--shards', '4', '-sd', '2015-01-01', '-ed', '2019-12-31', '--resume'],
+        ['--shards', '4', '-sd', '2015-01-01', '-ed', '2019-12-31', '-c', '10'],
+        ['--rate-limit', '0'],
+    ):
+        with pytest.raises(SystemExit):
+            parse_arguments([''] + invalid)
+
+
+def test_fetch_action_pages(monkeypatch):
+    fetched = []
+
+    def fetch_activity_chunk_mock(args, num_to_download, total_downloaded):
+        fetched.append(total_downloaded)
+        return [
+            {'activityId': total_downloaded + i, 'activityType': {'typeId': 1, 'typeKey': 'running'}}
+            for i in range(num_to_download)
+        ]
+
+    monkeypatch.setattr('gcexport.fetch_activity_chunk', fetch_activity_chunk_mock)
+    monkeypatch.setattr('gcexport.fetch_userstats', lambda args: {'userMetrics': [{'totalActivities': 5}]})
+    monkeypatch.setattr('gcexport.LIMIT_MAXIMUM', 2)
+    expected, pages = fetch_action_pages(parse_arguments(['', '-c', 'all', '-sa', '2']), ['3'], None)
+    assert expected == 5
+
+    # a page is only fetched when the previous one is processed
+    assert fetched == []
+    assert [(item['index'], item['action']) for item in next(pages)] == [(0, 's'), (1, 'd')]
+    assert fetched == [0]
+    assert [[(item['index'], item['action']) for item in page] for page in pages] == [[(2, 'd'), (3, 'e')], [(4, 'd')]]
+    assert fetched == [0, 2, 4]
+
+    # the userstats don't tell the number of activities in a date range
+    assert fetch_action_pages(parse_arguments(['', '-c', 'all', '-sd', '2020-01-01']), [], None)[0] is None
+
+
 def test_fetch_multisports():
     args = parse_arguments([])
 
@@ -228,3 +505,10 @@ def test_fetch_multisports():
     assert activity_summaries[4]['activityId'] == 6588349076
     assert activity_summaries[5]['activityId'] == 6588349079
     assert activity_summaries[6]['activityId'] == 6588349081
+
+
+def test_login_skipped_with_valid_token(monkeypatch):
+    token = garth.auth_tokens.OAuth2Token('', '', 'Bearer', 'access', 'refresh', 3600, int(time.time()) + 3600, 0, 0)
+    monkeypatch.setattr(garth.client, 'oauth2_token', token)
+    # neither a session directory nor credentials are needed (input() would fail under pytest)
+    login_to_garmin_connect(parse_arguments([]))
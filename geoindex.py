@@ -0,0 +1,269 @@
+"""
+Spatial index over the start and end points of the activities.
+
+The coordinates are kept in the state store of the export directory (see state.py): the table
+'places' holds the start and end point, start time and name per activity, an SQLite R*Tree
+('place_index', one entry per start and per end point) finds the points within a bounding box
+without scanning. A search within a radius looks up the bounding box of the circle and filters
+the few candidates by their great circle distance. SQLite builds without the R*Tree module get an
+ordinary table with a B-tree index on the latitude instead (slower, but the same queries work).
+
+gcexport.py adds every downloaded activity; an existing export is indexed from its cached
+activity lists. Command line:
+
+    python geoindex.py build EXPORT_DIRECTORY
+    python geoindex.py near EXPORT_DIRECTORY LAT LON KM [--point {start,end,any}]
+    python geoindex.py box EXPORT_DIRECTORY MIN_LAT MIN_LON MAX_LAT MAX_LON [--point {start,end,any}]
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import sqlite3
+import sys
+
+from artifacts import ArtifactStore
+from state import STATE_FILE_NAME, StateStore
+
+# mean earth radius in km
+EARTH_RADIUS_KM = 6371.0088
+
+# the points of an activity; the ID of an index entry is activity ID * 2 + point number
+POINTS = {'start': 0, 'end': 1}
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great circle distance in km between two points given in decimal degrees"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GeoIndex:
+    """The start and end points of the activities, see the module documentation"""
+
+    def __init__(self, store=None):
+        """
+        :param store: StateStore to keep the index in; without one (see 'open') 'add' does nothing
+        """
+        self.store = None
+        if store is not None:
+            self.open(store)
+
+    def open(self, store):
+        """Use the index in 'store', creating the tables if needed"""
+        with store.transaction():
+            store.execute(
+                'CREATE TABLE IF NOT EXISTS places ('
+                ' activity_id INTEGER PRIMARY KEY, start_lat REAL, start_lon REAL, end_lat REAL, end_lon REAL,'
+                ' start_time TEXT, name TEXT)'
+            )
+            try:
+                store.execute('CREATE VIRTUAL TABLE IF NOT EXISTS place_index USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+            except sqlite3.OperationalError as ex:
+                logging.info('No R*Tree in this SQLite build (%s), using a B-tree index', ex)
+                store.execute(
+                    'CREATE TABLE IF NOT EXISTS place_index ('
+                    ' id INTEGER PRIMARY KEY, min_lat REAL, max_lat REAL, min_lon REAL, max_lon REAL)'
+                )
+                store.execute('CREATE INDEX IF NOT EXISTS place_index_lat ON place_index (min_lat)')
+        self.store = store
+
+    def add(self, activity_id, start, end, start_time=None, name=None):
+        """
+        Add or replace the points of an activity
+
+        :param activity_id: ID of the activity
+        :param start:       tuple (latitude, longitude) of the start point in decimal degrees, None if unknown
+        :param end:         tuple (latitude, longitude) of the end point, None if unknown
+        :param start_time:  local start time (ISO format)
+        :param name:        name of the activity
+        """
+        if self.store is None:
+            return
+        # deferred, committed with the writes for the next activities
+        for sql, params in self._statements(activity_id, start, end, start_time, name):
+            self.store.defer(sql, params)
+
+    def add_many(self, places):
+        """Add or replace the points of activities, 'places' are tuples of the parameters of 'add'"""
+        places = list(places)
+        with self.store.transaction():
+            for place in places:
+                for sql, params in self._statements(*place):
+                    self.store.execute(sql, params)
+        return len(places)
+
+    @staticmethod
+    def _statements(activity_id, start, end, start_time, name):
+        """The SQL statements (with their parameters) adding or replacing the points of an activity"""
+        activity_id = int(activity_id)
+        start = start if start and None not in start else (None, None)
+        end = end if end and None not in end else (None, None)
+        yield 'INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?, ?, ?, ?)', (activity_id, *start, *end, start_time, name)
+        for point, (latitude, longitude) in zip(POINTS.values(), (start, end)):
+            index_id = activity_id * 2 + point
+            if latitude is None:
+                yield 'DELETE FROM place_index WHERE id = ?', (index_id,)
+            else:
+                yield 'INSERT OR REPLACE INTO place_index VALUES (?, ?, ?, ?, ?)', (
+                    index_id,
+                    latitude,
+                    latitude,
+                    longitude,
+                    longitude,
+                )
+
+    def __len__(self):
+        return self.store.execute('SELECT COUNT(*) FROM places')[0][0]
+
+    def _box(self, min_lat, min_lon, max_lat, max_lon, point):
+        """Index entries (ID, latitude, longitude) in a bounding box; a box crossing the antimeridian has min_lon > max_lon"""
+        lon_ranges = [(min_lon, max_lon)] if min_lon <= max_lon else [(min_lon, 180.0), (-180.0, max_lon)]
+        entries = []
+        for low, high in lon_ranges:
+            # the R*Tree keeps the coordinates as float32 rounded outwards (about 1 m), the exact ones are in 'places'
+            rows = self.store.execute(
+                'SELECT i.id, CASE i.id % 2 WHEN 0 THEN p.start_lat ELSE p.end_lat END,'
+                ' CASE i.id % 2 WHEN 0 THEN p.start_lon ELSE p.end_lon END'
+                ' FROM place_index i JOIN places p ON p.activity_id = i.id / 2'
+                ' WHERE i.max_lat >= ? AND i.min_lat <= ? AND i.max_lon >= ? AND i.min_lon <= ?',
+                (min_lat, max_lat, low, high),
+            )
+            entries += [row for row in rows if min_lat <= row[1] <= max_lat and low <= row[2] <= high]
+        if point != 'any':
+            entries = [entry for entry in entries if entry[0] % 2 == POINTS[point]]
+        return entries
+
+    def _activities(self, matches):
+        """The matches (dict activity ID -> distance or None) with the data of the activities, sorted"""
+        if not matches:
+            return []
+        rows = []
+        ids = list(matches)
+        # in chunks, SQLite limits the number of parameters
+        for index in range(0, len(ids), 500):
+            chunk = ids[index : index + 500]
+            rows += self.store.execute(
+                f'SELECT activity_id, start_time, name FROM places WHERE activity_id IN ({",".join("?" * len(chunk))})', chunk
+            )
+        results = [
+            {'activityId': activity_id, 'startTime': start_time, 'name': name, 'distanceKm': matches[activity_id]}
+            for activity_id, start_time, name in rows
+        ]
+        if any(match is not None for match in matches.values()):
+            return sorted(results, key=lambda result: result['distanceKm'])
+        return sorted(results, key=lambda result: result['startTime'] or '', reverse=True)
+
+    def within(self, min_lat, min_lon, max_lat, max_lon, point='start'):
+        """
+        The activities with a point in a bounding box (min_lon > max_lon for a box crossing the antimeridian)
+
+        :param point: 'start', 'end' or 'any'
+        :return:      list of dicts (activityId, startTime, name, distanceKm = None), the newest first
+        """
+        return self._activities({entry_id // 2: None for entry_id, _, _ in self._box(min_lat, min_lon, max_lat, max_lon, point)})
+
+    def near(self, latitude, longitude, radius_km, point='start'):
+        """
+        The activities with a point within 'radius_km' of a point
+
+        :param point: 'start', 'end' or 'any'
+        :return:      list of dicts (activityId, startTime, name, distanceKm), the nearest first
+        """
+        delta_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+        min_lat, max_lat = max(-90.0, latitude - delta_lat), min(90.0, latitude + delta_lat)
+        cos_lat = min(math.cos(math.radians(min_lat)), math.cos(math.radians(max_lat)))
+        if cos_lat <= 0 or delta_lat / cos_lat >= 180:
+            # a pole is within the radius
+            min_lon, max_lon = -180.0, 180.0
+        else:
+            delta_lon = delta_lat / cos_lat
+            min_lon = (longitude - delta_lon + 180) % 360 - 180
+            max_lon = (longitude + delta_lon + 180) % 360 - 180
+        matches = {}
+        for entry_id, entry_lat, entry_lon in self._box(min_lat, min_lon, max_lat, max_lon, point):
+            distance = haversine_km(latitude, longitude, entry_lat, entry_lon)
+            if distance <= radius_km and distance < matches.get(entry_id // 2, math.inf):
+                matches[entry_id // 2] = distance
+        return self._activities(matches)
+
+
+def index_activity_lists(geo_index, directory):
+    """
+    Add the activities of the activity lists cached in an export directory ('activities-*.json',
+    in any form, see artifacts.py)
+
+    :return: number of activities added
+    """
+    artifacts = ArtifactStore()
+    places = {}
+    for filename in artifacts.names(directory, 'activities-*.json'):
+        try:
+            summaries = json.loads(artifacts.read(filename))
+        except (ValueError, OSError) as ex:
+            logging.warning('Skipping %s: %s', filename, ex)
+            continue
+        for summary in summaries if isinstance(summaries, list) else []:
+            if summary.get('activityId'):
+                places[summary['activityId']] = (
+                    summary['activityId'],
+                    (summary.get('startLatitude'), summary.get('startLongitude')),
+                    (summary.get('endLatitude'), summary.get('endLongitude')),
+                    summary.get('startTimeLocal'),
+                    summary.get('activityName'),
+                )
+    return geo_index.add_many(places.values())
+
+
+def parse_arguments(argv):
+    """
+    Setup the argument parser and parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Spatial index over the activities of the Garmin Connect Exporter')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build', help='index the activities of the activity lists cached in an export directory')
+    build_parser.add_argument('directory', help='export directory')
+    near_parser = commands.add_parser('near', help='activities within a distance of a point')
+    near_parser.add_argument('directory', help='export directory')
+    near_parser.add_argument('latitude', type=float, help='latitude in decimal degrees')
+    near_parser.add_argument('longitude', type=float, help='longitude in decimal degrees')
+    near_parser.add_argument('km', type=float, help='radius in km')
+    box_parser = commands.add_parser('box', help='activities inside a bounding box')
+    box_parser.add_argument('directory', help='export directory')
+    for name in ('min_lat', 'min_lon', 'max_lat', 'max_lon'):
+        box_parser.add_argument(name, type=float, help='decimal degrees')
+    for query_parser in (near_parser, box_parser):
+        query_parser.add_argument('--point', choices=['start', 'end', 'any'], default='start',
+            help="the point of the activities to look at (default: 'start')")  # fmt: skip
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    """
+    Main entry point for geoindex.py
+    """
+    args = parse_arguments(argv)
+    store = StateStore(os.path.join(args.directory, STATE_FILE_NAME))
+    try:
+        geo_index = GeoIndex(store)
+        if args.command == 'build':
+            print(f'{index_activity_lists(geo_index, args.directory)} activities indexed, {len(geo_index)} in total')
+            return 0
+        if args.command == 'near':
+            results = geo_index.near(args.latitude, args.longitude, args.km, args.point)
+        else:
+            results = geo_index.within(args.min_lat, args.min_lon, args.max_lat, args.max_lon, args.point)
+        for result in results:
+            distance = f"{result['distanceKm']:8.3f} km  " if result['distanceKm'] is not None else ''
+            print(f"{distance}{result['activityId']:>12}  {result['startTime'] or '':19}  {result['name'] or ''}")
+        print(f'{len(results)} activities')
+        return 0
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
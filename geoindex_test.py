@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for geoindex.py; Call them with this command line:
+
+py.test geoindex_test.py
+"""
+
+import json
+import random
+
+from geoindex import GeoIndex, haversine_km, index_activity_lists, main
+from state import STATE_FILE_NAME, StateStore
+
+
+def test_haversine_km():
+    assert haversine_km(47.0, 8.0, 47.0, 8.0) == 0
+    # one degree of latitude is about 111.2 km
+    assert abs(haversine_km(0.0, 0.0, 1.0, 0.0) - 111.195) < 0.01
+    assert abs(haversine_km(0.0, 179.5, 0.0, -179.5) - 111.195) < 0.01
+
+
+def test_near_and_within_match_a_scan(tmp_path):
+    store = StateStore(str(tmp_path / STATE_FILE_NAME))
+    geo_index = GeoIndex(store)
+    places = {}
+    generator = random.Random(4711)
+    for activity_id in range(1, 20001):
+        start = (generator.uniform(45.0, 48.0), generator.uniform(5.0, 11.0))
+        end = (start[0] + generator.uniform(-0.1, 0.1), start[1] + generator.uniform(-0.1, 0.1))
+        places[activity_id] = (start, end)
+    geo_index.add_many(
+        (activity_id, start, end, f'2020-01-01 00:00:{activity_id % 60:02d}', None) for activity_id, (start, end) in places.items()
+    )
+    geo_index.add(20001, (None, None), None, '2020-01-02 00:00:00', 'indoor')
+    assert len(geo_index) == 20001
+
+    center = (46.5, 8.0)
+    for point, index in (('start', 0), ('end', 1)):
+        expected = sorted(activity_id for activity_id, coords in places.items() if haversine_km(*center, *coords[index]) <= 10)
+        results = geo_index.near(*center, 10, point)
+        assert sorted(result['activityId'] for result in results) == expected
+        assert [result['distanceKm'] for result in results] == sorted(result['distanceKm'] for result in results)
+    results = geo_index.near(*center, 10, 'any')
+    assert {result['activityId'] for result in results} == {
+        activity_id for activity_id, coords in places.items() if min(haversine_km(*center, *point) for point in coords) <= 10
+    }
+
+    expected = {activity_id for activity_id, (start, _) in places.items() if 46.0 <= start[0] <= 46.2 and 7.0 <= start[1] <= 7.5}
+    assert {result['activityId'] for result in geo_index.within(46.0, 7.0, 46.2, 7.5)} == expected
+    store.close()
+
+
+def test_antimeridian_and_replace(tmp_path):
+    geo_index = GeoIndex(StateStore(str(tmp_path / STATE_FILE_NAME)))
+    geo_index.add(1, (-17.8, 179.9), (-17.8, -179.9), '2020-01-01 10:00:00', 'Fiji east')
+    geo_index.add(2, (-17.8, -179.95), (-17.8, -179.95), '2020-01-02 10:00:00', 'Fiji west')
+    geo_index.add(3, (-17.8, 170.0), (-17.8, 170.0), '2020-01-03 10:00:00', 'far away')
+    assert [result['activityId'] for result in geo_index.near(-17.8, 179.99, 10)] == [2, 1]
+    assert [result['activityId'] for result in geo_index.within(-18.0, 179.0, -17.0, -179.0)] == [2, 1]
+    assert [result['activityId'] for result in geo_index.within(-18.0, 179.0, -17.0, 179.95)] == [1]
+    assert geo_index.within(-18.0, 179.0, -17.0, 179.95, 'end') == []
+
+    # a new version of an activity replaces its points
+    geo_index.add(1, (10.0, 10.0), None, '2020-01-01 10:00:00', 'moved')
+    assert [result['activityId'] for result in geo_index.within(-18.0, 179.0, -17.0, -179.0, 'any')] == [2]
+    assert geo_index.near(10.0, 10.0, 1)[0]['name'] == 'moved'
+
+    # without a store nothing is indexed
+    GeoIndex().add(4, (0.0, 0.0), (0.0, 0.0))
+
+
+def test_exact_coordinates(tmp_path):
+    # the R*Tree rounds 46.1234567 to float32 (1 m), the matches and distances use the exact coordinates
+    geo_index = GeoIndex(StateStore(str(tmp_path / STATE_FILE_NAME)))
+    geo_index.add(1, (46.1234567, 7.1234567), None, '2020-01-01 10:00:00', 'exact')
+    assert geo_index.within(46.1234568, 7.0, 47.0, 8.0) == []
+    assert geo_index.within(46.0, 7.0, 46.1234566, 8.0) == []
+    assert [result['activityId'] for result in geo_index.within(46.1234567, 7.1234567, 46.1234567, 7.1234567)] == [1]
+    assert geo_index.near(46.1234567, 7.1234567, 0.001)[0]['distanceKm'] == 0
+
+
+def test_build_from_activity_lists(tmp_path, capsys):
+    summaries = [
+        {'activityId': 11, 'activityName': 'Run', 'startTimeLocal': '2021-05-01 08:00:00', 'startLatitude': 46.0,
+         'startLongitude': 7.0, 'endLatitude': 46.01, 'endLongitude': 7.01},
+        {'activityId': 12, 'activityName': 'Treadmill', 'startTimeLocal': '2021-05-02 08:00:00'},
+    ]  # fmt: skip
+    (tmp_path / 'activities-0-2.json').write_text(json.dumps(summaries), encoding='utf-8')
+
+    assert main(['geoindex.py', 'build', str(tmp_path)]) == 0
+    assert '2 activities indexed, 2 in total' in capsys.readouterr().out
+    assert main(['geoindex.py', 'near', str(tmp_path), '46.0', '7.0', '0.5']) == 0
+    output = capsys.readouterr().out
+    assert 'Run' in output and '1 activities' in output
+    assert main(['geoindex.py', 'box', str(tmp_path), '45', '6', '47', '8', '--point', 'end']) == 0
+    assert '1 activities' in capsys.readouterr().out
+
+    store = StateStore(str(tmp_path / STATE_FILE_NAME))
+    assert index_activity_lists(GeoIndex(store), str(tmp_path)) == 2
+    store.close()
@@ -0,0 +1,152 @@
+"""
+Request accounting and timing for gcexport.py.
+
+Collects per endpoint category a latency histogram, the number of bytes, the HTTP
+status codes and the retries, and per activity the time spent in each processing
+phase (details, device, zones, gear, samples, data file, disk write).
+"""
+
+import bisect
+import json
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+# upper bounds (in seconds) of the latency histogram buckets: 1 ms .. ~75 s, growing by 25% per bucket
+LATENCY_BUCKETS = [0.001 * 1.25**i for i in range(51)]
+
+# the processing phases of an activity, in the order they happen
+PHASES = ['details', 'device', 'samples', 'metrics', 'gear', 'zones', 'data_file', 'disk_write']
+
+
+class EndpointStats:
+    """Statistics of the requests to one endpoint category"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes = 0
+        self.retries = 0
+        self.status = Counter()
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, seconds, num_bytes, status):
+        """Add one request"""
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.bytes += num_bytes
+        self.status[str(status)] += 1
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def percentile(self, fraction):
+        """Estimate a latency percentile (in seconds) as the upper bound of its histogram bucket"""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.histogram):
+            seen += bucket_count
+            if seen >= rank:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else self.max_seconds
+        return self.max_seconds
+
+    def to_dict(self):
+        """JSON compatible representation"""
+        return {
+            'count': self.count,
+            'seconds': round(self.seconds, 6),
+            'max_seconds': round(self.max_seconds, 6),
+            'p50_seconds': self.percentile(0.5),
+            'p90_seconds': self.percentile(0.9),
+            'p99_seconds': self.percentile(0.99),
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'status': dict(self.status),
+            'histogram': {f'le_{bound:.4f}': n for bound, n in zip(LATENCY_BUCKETS + [float('inf')], self.histogram) if n},
+        }
+
+
+class ExportStats:
+    """Thread safe collector for the request and phase statistics of an export run"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = defaultdict(EndpointStats)
+        self.activities = defaultdict(lambda: defaultdict(float))
+
+    def record_request(self, category, seconds, num_bytes, status):
+        """Record a finished (or failed) HTTP request"""
+        with self._lock:
+            self.endpoints[category].record(seconds, num_bytes, status)
+
+    def record_retry(self, category):
+        """Record that a request to the given endpoint category is being retried"""
+        with self._lock:
+            self.endpoints[category].retries += 1
+
+    @contextmanager
+    def phase(self, activity_id, name):
+        """Context manager adding the time spent in the block to the phase 'name' of the activity"""
+        start = timer()
+        try:
+            yield
+        finally:
+            elapsed = timer() - start
+            with self._lock:
+                self.activities[str(activity_id)][name] += elapsed
+
+    def to_dict(self):
+        """JSON compatible representation of all statistics"""
+        with self._lock:
+            return {
+                'endpoints': {category: stats.to_dict() for category, stats in sorted(self.endpoints.items())},
+                'activities': {activity_id: dict(phases) for activity_id, phases in self.activities.items()},
+            }
+
+    def dump_json(self, filename):
+        """Write the statistics to a JSON file"""
+        with open(filename, 'w', encoding='utf-8') as json_file:
+            json.dump(self.to_dict(), json_file, indent=2)
+
+    def summary(self, slowest=5):
+        """
+        Human readable summary of the statistics
+
+        :param slowest: number of slowest activities to list
+        :return:        list of lines
+        """
+        with self._lock:
+            lines = [
+                f"{'endpoint':14} {'requests':>8} {'total s':>9} {'mean ms':>8} {'p50 ms':>8} {'p99 ms':>8} "
+                f"{'max ms':>8} {'kB':>10} {'retries':>7}  status"
+            ]
+            for category, stats in sorted(self.endpoints.items(), key=lambda item: -item[1].seconds):
+                mean = stats.seconds / stats.count if stats.count else 0
+                status = ', '.join(f'{code}:{n}' for code, n in sorted(stats.status.items()))
+                lines.append(
+                    f'{category:14} {stats.count:8} {stats.seconds:9.2f} {mean * 1000:8.1f} '
+                    f'{(stats.percentile(0.5) or 0) * 1000:8.1f} {(stats.percentile(0.99) or 0) * 1000:8.1f} '
+                    f'{stats.max_seconds * 1000:8.1f} {stats.bytes / 1024:10.1f} {stats.retries:7}  {status}'
+                )
+
+            if self.activities:
+                totals = defaultdict(float)
+                for phases in self.activities.values():
+                    for name, seconds in phases.items():
+                        totals[name] += seconds
+                count = len(self.activities)
+                lines.append('')
+                lines.append(f"{'phase':14} {'total s':>9} {'mean ms':>8}   ({count} activities)")
+                for name in sorted(totals, key=lambda n: PHASES.index(n) if n in PHASES else len(PHASES)):
+                    lines.append(f'{name:14} {totals[name]:9.2f} {totals[name] / count * 1000:8.1f}')
+
+                ranking = sorted(self.activities.items(), key=lambda item: -sum(item[1].values()))[:slowest]
+                lines.append('')
+                lines.append('slowest activities:')
+                for activity_id, phases in ranking:
+                    detail = ', '.join(f'{name} {seconds:.2f}' for name, seconds in phases.items())
+                    lines.append(f'  {activity_id}: {sum(phases.values()):.2f} s ({detail})')
+            return lines
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for instrumentation.py; Call them with this command line:
+
+py.test instrumentation_test.py
+"""
+
+from instrumentation import ExportStats
+
+
+def test_record_request():
+    stats = ExportStats()
+    for _ in range(98):
+        stats.record_request('details', 0.010, 1000, 200)
+    stats.record_request('details', 2.0, 0, 500)
+    stats.record_retry('details')
+    stats.record_request('device', 0.5, 10, 200)
+
+    details = stats.to_dict()['endpoints']['details']
+    assert details['count'] == 99
+    assert details['bytes'] == 98000
+    assert details['retries'] == 1
+    assert details['status'] == {'200': 98, '500': 1}
+    # the percentiles are estimated with the upper bound of the histogram bucket (+25%)
+    assert 0.010 <= details['p50_seconds'] < 0.0125
+    assert details['p99_seconds'] >= 2.0
+    assert details['max_seconds'] == 2.0
+
+
+def test_phase():
+    stats = ExportStats()
+    with stats.phase(2541953812, 'details'):
+        pass
+    with stats.phase('2541953812', 'details'):
+        pass
+    with stats.phase('2541953812', 'gear'):
+        pass
+
+    activities = stats.to_dict()['activities']
+    assert list(activities.keys()) == ['2541953812']
+    assert sorted(activities['2541953812'].keys()) == ['details', 'gear']
+    assert stats.summary()[-1].startswith('  2541953812: ')
@@ -0,0 +1,197 @@
+"""
+Incremental parsing of large JSON responses.
+
+The activity list pages (up to 1000 summaries) and the activity samples can be large; instead
+of reading the whole response, decoding it into one string and parsing it, the functions here
+read the response in chunks and return the elements of the top-level array (or the members of
+the top-level object) one by one as soon as they are complete. The raw bytes can be passed on
+as they are read ('tee'), e.g. to save the response unchanged.
+"""
+
+import codecs
+import json
+import re
+
+# bytes read from the stream at once
+CHUNK_SIZE = 64 * 1024
+
+# an incomplete value is parsed again once the text read has grown by this factor
+GROWTH_FACTOR = 4
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# the characters changing the nesting while skipping a value, outside and inside of strings
+_STRUCTURE = re.compile(r'["\[\]{}]')
+_STRING_END = re.compile(r'["\\]')
+
+
+class _Buffer:  # pylint: disable=too-many-instance-attributes
+    """The decoded text of a byte stream, read chunk by chunk; the consumed text is dropped"""
+
+    def __init__(self, stream, tee=None, chunk_size=CHUNK_SIZE):
+        """
+        :param stream:     binary file-like object
+        :param tee:        callback receiving the bytes read from the stream
+        :param chunk_size: number of bytes to read at once
+        """
+        self.stream = stream
+        self.tee = tee
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+        # each value is parsed on its own, so the names of the members are shared explicitly
+        # (like 'json.loads' does within one document), which saves much memory for lists of similar objects
+        self.names = {}
+        self.json_decoder = json.JSONDecoder(object_pairs_hook=self._object)
+        # for the values spanning several chunks, which share their names within themselves
+        self.large_decoder = json.JSONDecoder()
+
+    def _object(self, pairs):
+        return {self.names.setdefault(name, name): value for name, value in pairs}
+
+    def _read(self):
+        """Read and decode the next chunk ('' at the end of the stream)"""
+        data = self.stream.read(self.chunk_size)
+        if data and self.tee:
+            self.tee(data)
+        self.eof = not data
+        return self.decoder.decode(data, final=self.eof)
+
+    def fill(self):
+        """Read the next chunk, return False at the end of the stream"""
+        if self.eof:
+            return False
+        self.text = self.text[self.pos :] + self._read()
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        """The next character that isn't whitespace, '' at the end of the stream"""
+        while True:
+            self.pos = _WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text) or not self.fill():
+                return self.text[self.pos : self.pos + 1]
+
+    def expect(self, characters):
+        """Consume the next character that isn't whitespace, which must be one of 'characters'"""
+        character = self.peek()
+        if not character or character not in characters:
+            raise json.JSONDecodeError(f'Expecting one of {characters!r}', self.text, self.pos)
+        self.pos += 1
+        return character
+
+    def decode(self):
+        """
+        Parse the next value
+
+        An incomplete value is only parsed again once the text read has grown by GROWTH_FACTOR, so that the
+        text of a large value (spanning many chunks) is parsed about 1.3 times in total, not once per chunk.
+        """
+        self.peek()
+        chunks = [self.text[self.pos :]]
+        size = len(chunks[0])
+        tried = 0
+        while True:
+            if self.eof or size >= GROWTH_FACTOR * tried:
+                self.text = ''.join(chunks)
+                self.pos = 0
+                chunks = [self.text]
+                try:
+                    value, end = (self.large_decoder if tried else self.json_decoder).raw_decode(self.text)
+                    # a number at the end of the text may continue in the next chunk
+                    if end < size or self.eof:
+                        self.pos = end
+                        return value
+                except json.JSONDecodeError:
+                    # incomplete (or invalid, which shows at the end of the stream)
+                    if self.eof:
+                        raise
+                tried = size
+            chunk = self._read()
+            chunks.append(chunk)
+            size += len(chunk)
+
+    def skip(self):
+        """Skip the next value without parsing it (only its nesting is followed)"""
+        if self.peek() not in ('"', '[', '{'):
+            self.decode()
+            return
+        depth = 0
+        in_string = False
+        while True:
+            match = (_STRING_END if in_string else _STRUCTURE).search(self.text, self.pos)
+            if not match or (match.group() == '\\' and match.end() == len(self.text)):
+                # continue after reading more, an escape at the end is read again
+                self.pos = match.start() if match else len(self.text)
+                if not self.fill():
+                    raise json.JSONDecodeError('Unterminated value', self.text, self.pos)
+                continue
+            self.pos = match.end()
+            if match.group() == '\\':
+                self.pos += 1
+            elif match.group() == '"':
+                in_string = not in_string
+            elif match.group() in '[{':
+                depth += 1
+            else:
+                depth -= 1
+            if depth == 0 and not in_string:
+                return
+
+    def finish(self):
+        """Read the rest of the stream (for the tee), which may only contain whitespace"""
+        if self.peek():
+            raise json.JSONDecodeError('Extra data', self.text, self.pos)
+
+
+def iter_json_array(stream, tee=None, chunk_size=CHUNK_SIZE):
+    """
+    The elements of a JSON array, parsed while the stream is read
+
+    :param stream:     binary file-like object with a JSON array (UTF-8)
+    :param tee:        callback receiving the bytes read from the stream (all of them, once the iteration is done)
+    :param chunk_size: number of bytes to read at once
+    :return:           iterator over the elements
+    :raise json.JSONDecodeError: for invalid JSON or if the top-level value is no array
+    """
+    buffer = _Buffer(stream, tee, chunk_size)
+    buffer.expect('[')
+    if buffer.peek() == ']':
+        buffer.pos += 1
+    else:
+        while True:
+            yield buffer.decode()
+            if buffer.expect(',]') == ']':
+                break
+    buffer.finish()
+
+
+def iter_json_object(stream, tee=None, skip=(), chunk_size=CHUNK_SIZE):
+    """
+    The members of a JSON object, parsed while the stream is read
+
+    :param stream:     binary file-like object with a JSON object (UTF-8)
+    :param tee:        callback receiving the bytes read from the stream (all of them, once the iteration is done)
+    :param skip:       names of members that are skipped without parsing their values (e.g. large arrays)
+    :param chunk_size: number of bytes to read at once
+    :return:           iterator over tuples (name, value)
+    :raise json.JSONDecodeError: for invalid JSON or if the top-level value is no object
+    """
+    buffer = _Buffer(stream, tee, chunk_size)
+    buffer.expect('{')
+    if buffer.peek() == '}':
+        buffer.pos += 1
+    else:
+        while True:
+            if buffer.peek() != '"':
+                raise json.JSONDecodeError('Expecting property name enclosed in double quotes', buffer.text, buffer.pos)
+            name = buffer.decode()
+            buffer.expect(':')
+            if name in skip:
+                buffer.skip()
+            else:
+                yield name, buffer.decode()
+            if buffer.expect(',}') == '}':
+                break
+    buffer.finish()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for jsonstream.py; Call them with this command line:
+
+py.test jsonstream_test.py
+"""
+
+import io
+import json
+
+import pytest
+
+from jsonstream import iter_json_array, iter_json_object
+
+
+def test_iter_json_array():
+    with open('json/activitylist-service.json', 'rb') as json_file:
+        raw = json_file.read()
+    # small chunks split the elements, strings, numbers and UTF-8 sequences
+    for chunk_size in (1, 7, 1000, 100000):
+        received = []
+        elements = list(iter_json_array(io.BytesIO(raw), received.append, chunk_size))
+        assert elements == json.loads(raw)
+        assert b''.join(received) == raw
+
+    assert list(iter_json_array(io.BytesIO(b' [ ] \n'))) == []
+    assert list(iter_json_array(io.BytesIO('[1, 23.5e1, "fēnix \\"5\\"", null, {"a": [true]}]'.encode()), chunk_size=2)) == [
+        1,
+        235.0,
+        'fēnix "5"',
+        None,
+        {'a': [True]},
+    ]
+
+
+def test_iter_json_array_invalid():
+    for invalid in (b'{}', b'[1, 2', b'[1 2]', b'[1] x', b''):
+        with pytest.raises(json.JSONDecodeError):
+            list(iter_json_array(io.BytesIO(invalid), chunk_size=3))
+
+
+def test_iter_json_object():
+    with open('json/activity_2541953812_samples.json', 'rb') as json_file:
+        samples = json.load(json_file)['com.garmin.activity.details.json.ActivityDetails']
+    raw = json.dumps(samples, ensure_ascii=False).encode()
+    for chunk_size in (1, 5, 4096):
+        received = []
+        members = dict(iter_json_object(io.BytesIO(raw), received.append, ('metrics', 'measurements'), chunk_size))
+        assert members == {key: value for key, value in samples.items() if key not in ('metrics', 'measurements')}
+        assert b''.join(received) == raw
+
+    # skipped values with brackets and escapes in strings
+    raw = b'{"a": "x\\"]}", "b": [{"c": "\\\\"}, "]"], "d": 5, "e": {}}'
+    assert list(iter_json_object(io.BytesIO(raw), skip=('a', 'b', 'd'), chunk_size=1)) == [('e', {})]
+    assert list(iter_json_object(io.BytesIO(b'{}'))) == []
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_object(io.BytesIO(b'{"a": [1, 2}'), skip=('a',)))
+
+
+def test_iter_json_object_large_member(monkeypatch):
+    metrics = [{'metrics': [index, index * 0.5, None], 'startTime': index * 1000} for index in range(100000)]
+    raw = json.dumps({'measurementCount': 3, 'activityDetailMetrics': metrics, 'detailsAvailable': True}).encode()
+    assert len(raw) > 4000000
+
+    # the text parsed in total grows linearly with the size of the member, not with its square
+    parsed = []
+    raw_decode = json.JSONDecoder.raw_decode
+
+    def counting_raw_decode(self, text, idx=0):
+        parsed.append(len(text) - idx)
+        return raw_decode(self, text, idx)
+
+    monkeypatch.setattr(json.JSONDecoder, 'raw_decode', counting_raw_decode)
+    members = dict(iter_json_object(io.BytesIO(raw), chunk_size=64 * 1024))
+    assert members['activityDetailMetrics'] == metrics
+    assert members['detailsAvailable'] is True
+    assert sum(parsed) < 2 * len(raw)
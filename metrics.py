@@ -0,0 +1,245 @@
+"""
+Metrics derived from the samples of an activity.
+
+The samples ('/activity-service/activity/{id}/details') describe their columns in
+'metricDescriptors' (older responses: 'measurements') and hold the rows in 'activityDetailMetrics'
+(older: 'metrics'). The columns are turned into NumPy arrays, from which the metrics are computed
+with cumulative sums, interpolation and binning, without Python loops over the samples:
+
+- best time for 1 km and 5 km (the fastest stretch of the distance, anywhere in the activity)
+- heart rate drift: the decrease of the ratio speed / heart rate from the first to the second half
+  of the activity (aerobic decoupling), in percent
+- time in custom heart rate zones (option '--hr-zones' of gcexport.py)
+- normalized power: the fourth root of the mean of the fourth power of the 30 s rolling average
+  of the power, on a 1 s grid
+
+NumPy is an optional dependency (pip install numpy), needed if the CSV template contains one of
+METRICS_COLUMNS.
+"""
+
+import importlib.util
+import math
+
+# the CSV columns computed here
+METRICS_COLUMNS = (
+    'best1kmRaw',
+    'best1km',
+    'best5kmRaw',
+    'best5km',
+    'hrDrift',
+    'normalizedPower',
+    'customHrZone1Seconds',
+    'customHrZone2Seconds',
+    'customHrZone3Seconds',
+    'customHrZone4Seconds',
+    'customHrZone5Seconds',
+)
+
+# the distances of the best times, in meters
+BEST_DISTANCES = {'best1km': 1000, 'best5km': 5000}
+
+# the window of the rolling average for the normalized power, in seconds
+POWER_WINDOW = 30
+
+# a longer gap between two samples is a pause, which doesn't count for the time in the zones
+MAX_SAMPLE_GAP = 30
+
+# factors to meters, meters per second and seconds
+UNIT_FACTORS = {
+    'meter': 1,
+    'kilometer': 1000,
+    'centimeter': 0.01,
+    'mile': 1609.344,
+    'mps': 1,
+    'kph': 1 / 3.6,
+    'mph': 0.44704,
+    'second': 1,
+    'millisecond': 0.001,
+}
+
+
+def numpy_available():
+    """True if the 'numpy' package is installed"""
+    return importlib.util.find_spec('numpy') is not None
+
+
+def _numpy():
+    try:
+        import numpy  # pylint: disable=import-outside-toplevel
+    except ImportError as ex:
+        raise ImportError("The metrics need the 'numpy' package (pip install numpy)") from ex
+    return numpy
+
+
+def sample_arrays(samples):
+    """
+    The columns of the samples as arrays
+
+    :param samples: dict with the (top-level) members of the samples JSON, current or older format
+    :return:        dict metric key (e.g. 'directHeartRate') -> array (float64, NaN for missing values),
+                    converted to meters, meters per second or seconds if the unit is known
+    """
+    numpy = _numpy()
+    # older responses were wrapped in an object
+    samples = samples.get('com.garmin.activity.details.json.ActivityDetails', samples)
+    descriptors = samples.get('metricDescriptors') or samples.get('measurements') or []
+    rows = samples.get('activityDetailMetrics') or samples.get('metrics') or []
+    if not descriptors or not rows:
+        return {}
+    width = max(descriptor['metricsIndex'] for descriptor in descriptors) + 1
+    # rows with missing values at the end are padded, None becomes NaN
+    table = numpy.array([(row['metrics'] + [None] * width)[:width] for row in rows], dtype=numpy.float64)
+    arrays = {}
+    for descriptor in descriptors:
+        unit = descriptor['unit'] if isinstance(descriptor.get('unit'), str) else (descriptor.get('unit') or {}).get('key')
+        arrays[descriptor['key']] = table[:, descriptor['metricsIndex']] * UNIT_FACTORS.get(unit, 1)
+    return arrays
+
+
+def _elapsed_seconds(arrays):
+    """The time of the samples in seconds since the first one, None if unknown"""
+    if 'directTimestamp' in arrays:
+        # milliseconds since 1970-01-01 (unit 'gmt')
+        return (arrays['directTimestamp'] - arrays['directTimestamp'][0]) / 1000
+    for key in ('sumElapsedDuration', 'sumDuration'):
+        if key in arrays:
+            return arrays[key]
+    return None
+
+
+def _valid(*columns):
+    """Mask of the samples where all columns have values"""
+    numpy = _numpy()
+    mask = numpy.ones(len(columns[0]), dtype=bool)
+    for column in columns:
+        mask &= ~numpy.isnan(column)
+    return mask
+
+
+def best_time(time, distance, length):
+    """
+    The shortest time for covering 'length' meters (interpolating between the samples)
+
+    :param time:     seconds, increasing
+    :param distance: cumulative distance in meters, not decreasing
+    :param length:   meters
+    :return:         seconds, None if the distance is shorter than 'length'
+    """
+    numpy = _numpy()
+    if len(distance) < 2 or distance[-1] - distance[0] < length:
+        return None
+    starts = distance <= distance[-1] - length
+    # the time at which 'length' meters after each sample are reached
+    arrival = numpy.interp(distance[starts] + length, distance, time)
+    return float(numpy.min(arrival - time[starts]))
+
+
+def hr_drift(time, speed, heart_rate):
+    """
+    Heart rate drift (aerobic decoupling): the decrease of speed / heart rate from the first to the
+    second half (by time), in percent, using time weighted averages
+
+    :return: percent, None without speed or heart rate
+    """
+    numpy = _numpy()
+    if len(time) < 4 or time[-1] <= time[0]:
+        return None
+    duration = numpy.diff(time)
+    middle = time[:-1] < (time[0] + time[-1]) / 2
+    ratios = []
+    for half in (middle, ~middle):
+        weight = duration[half].sum()
+        mean_heart_rate = (heart_rate[:-1][half] * duration[half]).sum() / weight if weight else 0
+        if mean_heart_rate <= 0:
+            return None
+        ratios.append((speed[:-1][half] * duration[half]).sum() / weight / mean_heart_rate)
+    if ratios[0] <= 0:
+        return None
+    return float((ratios[0] - ratios[1]) / ratios[0] * 100)
+
+
+def time_in_zones(time, heart_rate, boundaries):
+    """
+    Seconds in heart rate zones; each sample counts until the next one, unless that is more than
+    MAX_SAMPLE_GAP seconds later
+
+    :param boundaries: increasing lower boundaries of the zones (bpm), the last zone is open
+    :return:           list of seconds per zone
+    """
+    numpy = _numpy()
+    if len(time) < 2 or not boundaries:
+        return [0.0] * len(boundaries)
+    duration = numpy.diff(time)
+    duration[duration > MAX_SAMPLE_GAP] = 0
+    # zone 0: below the first boundary
+    zones = numpy.digitize(heart_rate[:-1], boundaries)
+    seconds = numpy.bincount(zones, weights=duration, minlength=len(boundaries) + 1)
+    return [float(value) for value in seconds[1:]]
+
+
+def normalized_power(time, power, window=POWER_WINDOW):
+    """
+    Normalized power: the power is interpolated to 1 s steps and averaged over 'window' seconds
+    (cumulative sums), the result is the fourth root of the mean of the fourth powers
+
+    :return: watts, None if the activity is shorter than the window
+    """
+    numpy = _numpy()
+    if len(time) < 2 or time[-1] - time[0] < window:
+        return None
+    grid = numpy.arange(time[0], time[-1] + 1)
+    cumulative = numpy.concatenate(([0.0], numpy.cumsum(numpy.interp(grid, time, power))))
+    rolling = (cumulative[window:] - cumulative[:-window]) / window
+    return float(numpy.mean(rolling**4) ** 0.25)
+
+
+def _format_seconds(seconds):
+    """h:mm:ss like the other durations of the CSV file"""
+    hours, rest = divmod(int(round(seconds)), 3600)
+    return f'{hours:02d}:{rest // 60:02d}:{rest % 60:02d}'
+
+
+def compute_metrics(samples, hr_zones=None):
+    """
+    The metrics of an activity, as values of the CSV columns
+
+    :param samples:  dict with the (top-level) members of the samples JSON
+    :param hr_zones: lower boundaries of the custom heart rate zones (bpm), up to 5
+    :return:         dict column (see METRICS_COLUMNS) -> value (str), without the metrics that
+                     can't be computed
+    """
+    numpy = _numpy()
+    arrays = sample_arrays(samples)
+    time = _elapsed_seconds(arrays)
+    if time is None or len(time) < 2:
+        return {}
+    columns = {}
+
+    if 'sumDistance' in arrays:
+        mask = _valid(time, arrays['sumDistance'])
+        # the distance can't decrease (GPS corrections can make it), the time must increase for the interpolation
+        distance = numpy.maximum.accumulate(arrays['sumDistance'][mask])
+        for column, length in BEST_DISTANCES.items():
+            seconds = best_time(time[mask], distance, length)
+            if seconds is not None:
+                columns[f'{column}Raw'] = f'{seconds:.1f}'
+                columns[column] = _format_seconds(seconds)
+
+    heart_rate = arrays.get('directHeartRate')
+    if heart_rate is not None and 'directSpeed' in arrays:
+        mask = _valid(time, heart_rate, arrays['directSpeed'])
+        drift = hr_drift(time[mask], arrays['directSpeed'][mask], heart_rate[mask])
+        if drift is not None and not math.isnan(drift):
+            columns['hrDrift'] = f'{drift:.2f}'
+
+    if heart_rate is not None and hr_zones:
+        mask = _valid(time, heart_rate)
+        for number, seconds in enumerate(time_in_zones(time[mask], heart_rate[mask], list(hr_zones)), 1):
+            columns[f'customHrZone{number}Seconds'] = f'{seconds:.0f}'
+
+    if 'directPower' in arrays:
+        mask = _valid(time, arrays['directPower'])
+        power = normalized_power(time[mask], arrays['directPower'][mask])
+        if power is not None:
+            columns['normalizedPower'] = f'{power:.0f}'
+    return columns
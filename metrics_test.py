@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for metrics.py; Call them with this command line:
+
+py.test metrics_test.py
+"""
+
+import json
+
+import pytest
+
+from metrics import best_time, compute_metrics, hr_drift, normalized_power, sample_arrays, time_in_zones
+
+numpy = pytest.importorskip('numpy')
+
+
+def _samples():
+    with open('json/activity_2541953812_samples.json') as samples_file:
+        return json.load(samples_file)
+
+
+def test_sample_arrays():
+    legacy = _samples()
+    arrays = sample_arrays(legacy)
+    assert len(arrays['directHeartRate']) == 244
+    # kilometers and km/h are converted to meters and m/s
+    assert arrays['sumDistance'][-1] == pytest.approx(8225.53, abs=0.01)
+    assert arrays['directSpeed'][0] == pytest.approx(2.1276 / 3.6, abs=0.001)
+
+    # the current format of the endpoint, with the units as objects
+    legacy = legacy['com.garmin.activity.details.json.ActivityDetails']
+    current = {
+        'metricDescriptors': [
+            {'metricsIndex': m['metricsIndex'], 'key': m['key'], 'unit': {'key': m['unit']}} for m in legacy['measurements']
+        ],
+        'activityDetailMetrics': legacy['metrics'],
+    }
+    assert sample_arrays(current)['sumDistance'].tolist() == arrays['sumDistance'].tolist()
+    assert sample_arrays({'metricDescriptors': [], 'activityDetailMetrics': []}) == {}
+
+
+def test_best_time():
+    # 10 km, 5 m/s except 2 m/s between km 3 and 4
+    distance = numpy.arange(0, 10001, 10.0)
+    time = numpy.cumsum(numpy.where((distance > 3000) & (distance <= 4000), 5.0, 2.0)) - 2
+    assert best_time(time, distance, 1000) == pytest.approx(200)
+    assert best_time(time, distance, 5000) == pytest.approx(1000)
+    assert best_time(time, distance, 20000) is None
+
+
+def test_hr_drift_zones_power():
+    time = numpy.arange(0, 3600, 1.0)
+    speed = numpy.full(3600, 3.0)
+    heart_rate = numpy.where(time < 1800, 140.0, 154.0)
+    # the same speed with 10% higher heart rate in the second half
+    assert hr_drift(time, speed, heart_rate) == pytest.approx(100 / 11, abs=0.01)
+
+    assert time_in_zones(time, heart_rate, [130, 150]) == [1800, 1799]
+    assert time_in_zones(time, heart_rate, [145]) == [1799]
+    # a pause doesn't count
+    paused = numpy.concatenate((time[:1800], time[1800:] + 600))
+    assert time_in_zones(paused, heart_rate, [130, 150]) == [1799, 1799]
+
+    assert normalized_power(time, numpy.full(3600, 200.0)) == pytest.approx(200)
+    # alternating 0 and 400 W every minute weighs more than the average of 200 W
+    assert normalized_power(time, numpy.where(time // 60 % 2 == 0, 0.0, 400.0)) > 250
+    assert normalized_power(time[:20], numpy.full(20, 200.0)) is None
+
+
+def test_compute_metrics():
+    metrics = compute_metrics(_samples(), [100, 130, 150])
+    assert metrics['best1km'] == '00:04:21'
+    assert float(metrics['best5kmRaw']) == pytest.approx(1515.8, abs=0.1)
+    assert 'hrDrift' in metrics
+    assert [metrics[f'customHrZone{number}Seconds'] for number in (1, 2, 3)] == ['1221', '468', '0']
+    # no power meter
+    assert 'normalizedPower' not in metrics
+    assert compute_metrics({'metricsCount': 0}) == {}
@@ -0,0 +1,333 @@
+"""
+Pack files: all files of an export in a few large files.
+
+A full export consists of tens of thousands of small files (activity files, zones, devices,
+activity lists, ...), which are slow to back up, list and synchronize. With option '--pack'
+gcexport.py appends them to pack files in the export directory instead ('export-0001.pack';
+a new pack is started once the last one has grown to PACK_MAX_BYTES). A pack consists of
+
+- the header PACK_MAGIC
+- records: a RECORD header (magic, length of the name, length of the data, file time, CRC-32 of
+  the data), the name (UTF-8, relative to the export directory, '/' separated) and the data
+- the index (JSON object: name -> [offset of the data, length, file time]) and the FOOTER
+  (offset and length of the index)
+
+Records are only appended; a later record replaces an earlier one with the same name. The index
+is written when the pack is closed and removed when more records are appended. A pack is read
+by memory mapping it, looking up the names in the index; if the writing was interrupted, the
+index is rebuilt from the records (the incomplete last record is dropped).
+
+The packs can be listed and unpacked into the classic directory layout:
+
+    python packfile.py list EXPORT_DIRECTORY|PACK_FILE
+    python packfile.py unpack EXPORT_DIRECTORY|PACK_FILE [--target DIRECTORY]
+"""
+
+import argparse
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import zlib
+
+from fileio import ACTIVITY_FILE_PATTERN, make_dirs, write_atomic
+
+PACK_MAGIC = b'GCEPACK1'
+# magic, length of the name, length of the data, file time (0 for none), CRC-32 of the data
+RECORD = struct.Struct('<4sHQdI')
+RECORD_MAGIC = b'REC1'
+# offset and length of the index, magic
+FOOTER = struct.Struct('<QQ8s')
+FOOTER_MAGIC = b'GCEINDX1'
+
+# size from which on the next record goes into a new pack
+PACK_MAX_BYTES = 1 << 30
+
+PACK_NAME_PATTERN = re.compile(r'^export-(\d{4,})\.pack$')
+
+
+def pack_files(directory):
+    """The pack files in a directory, in the order they were written"""
+    names = [name for name in os.listdir(directory) if PACK_NAME_PATTERN.match(name)] if os.path.isdir(directory) else []
+    return [os.path.join(directory, name) for name in sorted(names, key=lambda name: int(PACK_NAME_PATTERN.match(name).group(1)))]
+
+
+def _scan_records(data, offset):
+    """
+    The records of a pack (or a prefix of it), for rebuilding the index
+
+    :param data:   content of the pack (bytes-like)
+    :param offset: position of the first record
+    :return:       tuple (index, end of the last complete record)
+    """
+    index = {}
+    while offset + RECORD.size <= len(data):
+        magic, name_length, data_length, file_time, crc = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size + name_length
+        if magic != RECORD_MAGIC or start + data_length > len(data):
+            break
+        if zlib.crc32(data[start : start + data_length]) != crc:
+            break
+        name = bytes(data[offset + RECORD.size : start]).decode('utf-8')
+        index[name] = [start, data_length, file_time or None]
+        offset = start + data_length
+    return index, offset
+
+
+def _read_index(data):
+    """
+    The index of a pack, from its end or rebuilt from the records
+
+    :param data: content of the pack (bytes-like)
+    :return:     tuple (index, end of the records, True if the index was written)
+    :raise ValueError: if the data isn't a pack
+    """
+    if bytes(data[: len(PACK_MAGIC)]) != PACK_MAGIC:
+        raise ValueError('Not a pack file')
+    if len(data) >= len(PACK_MAGIC) + FOOTER.size:
+        index_offset, index_length, magic = FOOTER.unpack_from(data, len(data) - FOOTER.size)
+        if magic == FOOTER_MAGIC and index_offset + index_length + FOOTER.size == len(data):
+            return json.loads(bytes(data[index_offset : index_offset + index_length])), index_offset, True
+    index, end = _scan_records(data, len(PACK_MAGIC))
+    return index, end, False
+
+
+class PackReader:
+    """Random access to the files in a pack, which is memory mapped"""
+
+    def __init__(self, filename):
+        """
+        :param filename: name of the pack file
+        :raise ValueError: if the file isn't a pack
+        """
+        self.filename = filename
+        with open(filename, 'rb') as pack_file:
+            self._map = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.index, self.end, self.complete = _read_index(self._map)
+        except ValueError:
+            self._map.close()
+            raise
+        self._by_activity = None
+
+    def close(self):
+        """Release the memory map"""
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def names(self):
+        """The names of the files in the pack, sorted"""
+        return sorted(self.index)
+
+    def read(self, name):
+        """
+        The content of a file
+
+        :param name: name relative to the export directory, '/' separated
+        :return:     content (bytes)
+        :raise KeyError: if there is no such file in the pack
+        """
+        offset, length, _ = self.index[name]
+        return self._map[offset : offset + length]
+
+    def file_time(self, name):
+        """The time stamp of a file (in seconds since 1970-01-01), None if it has none"""
+        return self.index[name][2]
+
+    def find(self, activity_id):
+        """The names of the files of an activity, sorted"""
+        if self._by_activity is None:
+            self._by_activity = {}
+            for name in self.index:
+                match = ACTIVITY_FILE_PATTERN.match(name.rsplit('/', 1)[-1])
+                if match:
+                    self._by_activity.setdefault(match.group(1), []).append(name)
+        return sorted(self._by_activity.get(str(activity_id), []))
+
+    def garbage(self):
+        """Number of bytes of the records replaced by later ones"""
+        used = sum(RECORD.size + len(name.encode('utf-8')) + length for name, (_, length, _) in self.index.items())
+        return self.end - len(PACK_MAGIC) - used
+
+
+class PackWriter:
+    """Appends files to the packs of an export directory (option '--pack')"""
+
+    def __init__(self, max_bytes=PACK_MAX_BYTES):
+        """
+        :param max_bytes: size from which on the next file goes into a new pack
+        """
+        self.max_bytes = max_bytes
+        self.directory = None
+        self.sync = None
+        self._names = set()
+        self._file = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        """True while the packs of a directory are open"""
+        return self.directory is not None
+
+    def open(self, directory, sync=None):
+        """
+        Start writing to the packs of 'directory', appending to the last one
+
+        :param directory: export directory
+        :param sync:      FileSync whose policy is applied to the packs, None for no syncing
+        """
+        self.close()
+        self.directory = directory
+        self.sync = sync
+        self._names = set()
+        for filename in pack_files(directory):
+            with PackReader(filename) as pack:
+                self._names.update(pack.index)
+        self._open_pack()
+
+    def _open_pack(self, new=False):
+        """Open the last pack (or a new one) for appending, removing its index"""
+        filenames = pack_files(self.directory)
+        if filenames and not new:
+            filename = filenames[-1]
+            with PackReader(filename) as pack:
+                self._index, end = pack.index, pack.end
+                if not pack.complete:
+                    logging.warning('Pack %s was not closed, its index is rebuilt (%s files)', filename, len(self._index))
+            pack_file = open(filename, 'r+b')  # pylint: disable=consider-using-with
+            pack_file.truncate(end)
+            pack_file.seek(end)
+        else:
+            number = int(PACK_NAME_PATTERN.match(os.path.basename(filenames[-1])).group(1)) + 1 if filenames else 1
+            filename = os.path.join(self.directory, f'export-{number:04d}.pack')
+            pack_file = open(filename, 'xb')  # pylint: disable=consider-using-with
+            pack_file.write(PACK_MAGIC)
+            self._index = {}
+        self._file = pack_file
+
+    def name(self, filename):
+        """The name of a file in the packs: relative to the export directory, '/' separated"""
+        return os.path.relpath(filename, self.directory).replace(os.sep, '/')
+
+    def add(self, filename, data, file_time=None):
+        """
+        Append a file
+
+        :param filename:  name of the file (in the export directory or a subdirectory of it)
+        :param data:      content (bytes-like)
+        :param file_time: if given the time stamp of the file (in seconds since 1970-01-01)
+        """
+        name = self.name(filename)
+        encoded_name = name.encode('utf-8')
+        with self._lock:
+            if self._file.tell() > len(PACK_MAGIC) and self._file.tell() + len(data) > self.max_bytes:
+                self._close_pack()
+                self._open_pack(new=True)
+            offset = self._file.tell()
+            self._file.write(RECORD.pack(RECORD_MAGIC, len(encoded_name), len(data), file_time or 0, zlib.crc32(data)))
+            self._file.write(encoded_name)
+            self._file.write(data)
+            self._index[name] = [offset + RECORD.size + len(encoded_name), len(data), file_time or None]
+            self._names.add(name)
+            if self.sync and self.sync.policy == 'file':
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def names(self):
+        """The names of the files in the packs (written before and since 'open')"""
+        with self._lock:
+            return set(self._names)
+
+    def _close_pack(self):
+        """Write the index of the pack and close it"""
+        index = json.dumps(self._index, separators=(',', ':')).encode('utf-8')
+        index_offset = self._file.tell()
+        self._file.write(index)
+        self._file.write(FOOTER.pack(index_offset, len(index), FOOTER_MAGIC))
+        self._file.flush()
+        if self.sync and self.sync.policy != 'none':
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def close(self):
+        """Write the index of the last pack and stop writing (does nothing if no packs are open)"""
+        with self._lock:
+            if self._file is not None:
+                self._close_pack()
+            self.directory = None
+
+
+def open_packs(path):
+    """The readers of a pack file or of the packs in a directory, in the order they were written"""
+    filenames = pack_files(path) if os.path.isdir(path) else [path]
+    return [PackReader(filename) for filename in filenames]
+
+
+def unpack(path, target):
+    """
+    Write the files of packs into the classic directory layout
+
+    :param path:   pack file or directory with packs
+    :param target: directory to write the files into
+    :return:       number of files written
+    """
+    packs = open_packs(path)
+    try:
+        # the latest version of every file
+        latest = {name: pack for pack in packs for name in pack.index}
+        for name, pack in sorted(latest.items()):
+            filename = os.path.join(target, *name.split('/'))
+            make_dirs(os.path.dirname(filename))
+            write_atomic(filename, pack.read(name), pack.file_time(name))
+        return len(latest)
+    finally:
+        for pack in packs:
+            pack.close()
+
+
+def parse_arguments(argv):
+    """
+    Setup the argument parser and parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Pack files of the Garmin Connect Exporter')
+    commands = parser.add_subparsers(dest='command', required=True)
+    list_parser = commands.add_parser('list', help='list the files in the packs')
+    list_parser.add_argument('path', help='pack file or export directory with pack files')
+    unpack_parser = commands.add_parser('unpack', help='write the files in the packs as separate files')
+    unpack_parser.add_argument('path', help='pack file or export directory with pack files')
+    unpack_parser.add_argument('--target',
+        help='directory to write the files into (default: the directory of the packs)')  # fmt: skip
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    """
+    Main entry point for packfile.py
+    """
+    args = parse_arguments(argv)
+    if args.command == 'unpack':
+        target = args.target or (args.path if os.path.isdir(args.path) else os.path.dirname(args.path) or '.')
+        print(f'{unpack(args.path, target)} files written to {target}')
+        return 0
+    for pack in open_packs(args.path):
+        with pack:
+            for name in pack.names():
+                print(f'{pack.index[name][1]:>12}  {name}')
+            state = '' if pack.complete else ', not closed'
+            print(f'{pack.filename}: {len(pack.index)} files, {pack.garbage()} bytes replaced{state}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
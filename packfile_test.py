@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for packfile.py; Call them with this command line:
+
+py.test packfile_test.py
+"""
+
+import os
+
+from fileio import FileSync
+from packfile import PackReader, PackWriter, main, open_packs, pack_files, unpack
+
+
+def test_pack_write_read(tmp_path):
+    writer = PackWriter()
+    writer.open(str(tmp_path), FileSync('batch'))
+    writer.add(str(tmp_path / 'activity_1.gpx'), b'<gpx/>', 1500000000)
+    writer.add(str(tmp_path / '2018' / 'activity_2.fit'), b'\x00fit')
+    writer.add(str(tmp_path / 'activity_1_zones.json.gz'), b'zones')
+    writer.close()
+    assert not writer.active
+    assert pack_files(str(tmp_path)) == [str(tmp_path / 'export-0001.pack')]
+
+    with PackReader(str(tmp_path / 'export-0001.pack')) as pack:
+        assert pack.complete
+        assert pack.names() == ['2018/activity_2.fit', 'activity_1.gpx', 'activity_1_zones.json.gz']
+        assert pack.read('activity_1.gpx') == b'<gpx/>'
+        assert pack.read('2018/activity_2.fit') == b'\x00fit'
+        assert pack.file_time('activity_1.gpx') == 1500000000
+        assert pack.file_time('2018/activity_2.fit') is None
+        assert pack.find('1') == ['activity_1.gpx', 'activity_1_zones.json.gz']
+        assert pack.garbage() == 0
+
+    # appending to the pack, a file written again replaces the old version
+    writer.open(str(tmp_path))
+    assert writer.names() == {'2018/activity_2.fit', 'activity_1.gpx', 'activity_1_zones.json.gz'}
+    writer.add(str(tmp_path / 'activity_1.gpx'), b'<gpx></gpx>')
+    writer.close()
+    with PackReader(str(tmp_path / 'export-0001.pack')) as pack:
+        assert len(pack.names()) == 3
+        assert pack.read('activity_1.gpx') == b'<gpx></gpx>'
+        assert pack.garbage() > 0
+
+
+def test_pack_interrupted(tmp_path):
+    (tmp_path / 'written').mkdir()
+    writer = PackWriter()
+    writer.open(str(tmp_path / 'written'))
+    writer.add(str(tmp_path / 'written' / 'activity_1.gpx'), b'one')
+    writer.add(str(tmp_path / 'written' / 'activity_2.gpx'), b'two')
+    writer._file.flush()
+    # the state of a run interrupted while writing the last record
+    (tmp_path / 'interrupted').mkdir()
+    pack_name = str(tmp_path / 'interrupted' / 'export-0001.pack')
+    with open(tmp_path / 'written' / 'export-0001.pack', 'rb') as written, open(pack_name, 'wb') as interrupted:
+        interrupted.write(written.read()[:-1])
+    writer.close()
+    with PackReader(pack_name) as pack:
+        assert not pack.complete
+        assert pack.names() == ['activity_1.gpx']
+
+    # the index is rebuilt and the incomplete record overwritten
+    writer.open(str(tmp_path / 'interrupted'))
+    writer.add(str(tmp_path / 'interrupted' / 'activity_3.gpx'), b'three')
+    writer.close()
+    with PackReader(pack_name) as pack:
+        assert pack.complete
+        assert pack.names() == ['activity_1.gpx', 'activity_3.gpx']
+        assert pack.read('activity_3.gpx') == b'three'
+
+
+def test_pack_rollover_unpack(tmp_path, capsys):
+    packs = tmp_path / 'packs'
+    packs.mkdir()
+    writer = PackWriter(max_bytes=100)
+    writer.open(str(packs))
+    for activity_id in range(1, 4):
+        writer.add(str(packs / f'activity_{activity_id}.gpx'), b'x' * 60, 1500000000 + activity_id)
+    writer.add(str(packs / 'sub' / 'activity_1.gpx'), b'y')
+    writer.close()
+    assert [os.path.basename(name) for name in pack_files(str(packs))] == [
+        'export-0001.pack',
+        'export-0002.pack',
+        'export-0003.pack',
+        'export-0004.pack',
+    ]
+    assert sum(len(pack.names()) for pack in open_packs(str(packs))) == 4
+
+    assert unpack(str(packs), str(tmp_path / 'unpacked')) == 4
+    with open(tmp_path / 'unpacked' / 'activity_2.gpx', 'rb') as unpacked:
+        assert unpacked.read() == b'x' * 60
+    assert os.path.getmtime(tmp_path / 'unpacked' / 'activity_2.gpx') == 1500000002
+    assert os.path.isfile(tmp_path / 'unpacked' / 'sub' / 'activity_1.gpx')
+
+    assert main(['packfile.py', 'list', str(packs / 'export-0004.pack')]) == 0
+    assert 'sub/activity_1.gpx' in capsys.readouterr().out
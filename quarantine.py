@@ -0,0 +1,148 @@
+"""
+Quarantine for activities failing during an export (option '--keep-going').
+
+Instead of aborting the whole export, a failing activity is recorded (with the exception
+and the HTTP request that was being made) in 'quarantine.jsonl' in the export directory,
+and the export continues. At the end the quarantined activities are retried concurrently;
+the activities still failing remain in the quarantine file.
+"""
+
+import json
+import logging
+import os
+import threading
+import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from http.client import HTTPException
+from json import JSONDecodeError
+from urllib.error import HTTPError, URLError
+
+QUARANTINE_FILE_NAME = 'quarantine.jsonl'
+
+# number of threads for retrying the quarantined activities
+RETRY_WORKERS = 4
+
+
+def failure_category(ex):
+    """Short description of the kind of failure, used to group the failures in the summary"""
+    if isinstance(ex, HTTPError):
+        return f'HTTP {ex.code}'
+    if isinstance(ex, (URLError, HTTPException, ConnectionError, TimeoutError)):
+        return 'network'
+    if isinstance(ex, JSONDecodeError):
+        return 'invalid JSON'
+    if isinstance(ex, (KeyError, IndexError, TypeError, AttributeError)):
+        return 'unexpected data'
+    if isinstance(ex, OSError):
+        return 'filesystem'
+    return type(ex).__name__
+
+
+class Quarantine:
+    """Failed activity items of the current run, persisted as JSON lines"""
+
+    def __init__(self, directory, last_url=lambda: None, file_name=QUARANTINE_FILE_NAME):
+        """
+        :param directory: export directory for the quarantine file
+        :param last_url:  callback returning the URL of the last HTTP request of the calling thread
+        :param file_name: name of the quarantine file (the shards of an export write their own, see sharding.py)
+        """
+        self.filename = os.path.join(directory, file_name)
+        self.last_url = last_url
+        self.records = {}
+        self.retried = 0
+        self._lock = threading.Lock()
+        # the file only describes the current run
+        with open(self.filename, 'w', encoding='utf-8'):
+            pass
+
+    def add(self, item, ex, url=None):
+        """
+        Quarantine an activity item
+
+        :param item: the action item (dict with 'index', 'action' and 'activity'), see 'annotate_activity_list'
+        :param ex:   the exception raised while processing the item
+        :param url:  the URL of the last HTTP request made while processing the item (default: from 'last_url')
+        """
+        url = url if url else self.last_url()
+        activity = item['activity']
+        http = {'url': url}
+        if isinstance(ex, HTTPError):
+            http = {'url': ex.filename or url, 'status': ex.code, 'reason': str(ex.reason)}
+        record = {
+            'activityId': activity.get('activityId'),
+            'activityName': activity.get('activityName'),
+            'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'category': failure_category(ex),
+            'exception': type(ex).__name__,
+            'message': str(ex),
+            'traceback': traceback.format_exception(type(ex), ex, ex.__traceback__)[-3:],
+            'http': http,
+            'item': item,
+        }
+        with self._lock:
+            attempts = self.records[item['index']]['attempts'] if item['index'] in self.records else 0
+            record['attempts'] = attempts + 1
+            self.records[item['index']] = record
+            with open(self.filename, 'a', encoding='utf-8') as quarantine_file:
+                quarantine_file.write(json.dumps(record) + '\n')
+
+    def release(self, item):
+        """Remove an item that has now been processed successfully"""
+        with self._lock:
+            self.records.pop(item['index'], None)
+
+    def save(self):
+        """Rewrite the quarantine file with the items that are still quarantined"""
+        with self._lock:
+            temp_name = self.filename + '.tmp'
+            with open(temp_name, 'w', encoding='utf-8') as quarantine_file:
+                for record in self.records.values():
+                    quarantine_file.write(json.dumps(record) + '\n')
+            os.replace(temp_name, self.filename)
+
+    def _attempt(self, process_item, item):
+        """Process an item in a worker thread, return None or a tuple (exception, URL of the last request)"""
+        try:
+            process_item(item)
+            return None
+        except Exception as ex:  # pylint: disable=broad-except
+            return ex, self.last_url()
+
+    def retry(self, process_item, workers=RETRY_WORKERS):
+        """
+        Retry all quarantined items concurrently; items processed successfully are released,
+        items failing again are quarantined with the new error
+
+        :param process_item: callback processing one action item (raising an exception on failure)
+        :param workers:      number of threads
+        """
+        items = [record['item'] for record in self.records.values()]
+        if not items:
+            return
+        logging.info('Retrying %s quarantined activities with %s threads', len(items), workers)
+        self.retried += len(items)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='retry') as pool:
+            futures = {pool.submit(self._attempt, process_item, item): item for item in items}
+            for future in as_completed(futures):
+                item = futures[future]
+                failure = future.result()
+                if failure is None:
+                    self.release(item)
+                else:
+                    ex, url = failure
+                    logging.error("Retry of activity '%s' failed: %s/%s", item['activity'].get('activityId'), type(ex), ex)
+                    self.add(item, ex, url)
+        self.save()
+
+    def summary(self):
+        """Lines describing the quarantined activities, grouped by failure category"""
+        if not self.records and not self.retried:
+            return []
+        recovered = self.retried - len(self.records)
+        lines = [f'{len(self.records)} activities quarantined in {self.filename} ({recovered} recovered by the retry pass)']
+        for category, count in Counter(record['category'] for record in self.records.values()).most_common():
+            lines.append(f'  {category:16} {count:5}')
+        return lines
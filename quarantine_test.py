@@ -0,0 +1,73 @@
+"""
+Tests for quarantine.py
+"""
+
+import json
+import os
+from urllib.error import HTTPError
+
+from quarantine import QUARANTINE_FILE_NAME, Quarantine, failure_category
+
+
+def item(index, activity_id):
+    return {'index': index, 'action': 'd', 'activity': {'activityId': activity_id, 'activityName': f'act {activity_id}'}}
+
+
+def read_records(directory):
+    with open(os.path.join(directory, QUARANTINE_FILE_NAME), encoding='utf-8') as quarantine_file:
+        return [json.loads(line) for line in quarantine_file]
+
+
+def test_failure_category():
+    assert failure_category(HTTPError('http://x', 503, 'Unavailable', {}, None)) == 'HTTP 503'
+    assert failure_category(ConnectionResetError()) == 'network'
+    assert failure_category(json.JSONDecodeError('bad', '', 0)) == 'invalid JSON'
+    assert failure_category(KeyError('summaryDTO')) == 'unexpected data'
+    assert failure_category(PermissionError()) == 'filesystem'
+    assert failure_category(RuntimeError()) == 'RuntimeError'
+
+
+def test_add_records_exception_and_url(tmp_path):
+    quarantine = Quarantine(str(tmp_path), last_url=lambda: 'http://gc/last')
+    try:
+        raise KeyError('summaryDTO')
+    except KeyError as ex:
+        quarantine.add(item(3, 42), ex)
+    quarantine.add(item(4, 43), HTTPError('http://gc/details/43', 500, 'Server Error', {}, None))
+
+    records = read_records(str(tmp_path))
+    assert [r['activityId'] for r in records] == [42, 43]
+    assert records[0]['http'] == {'url': 'http://gc/last'}
+    assert records[0]['category'] == 'unexpected data'
+    assert records[0]['traceback']
+    assert records[1]['http'] == {'url': 'http://gc/details/43', 'status': 500, 'reason': 'Server Error'}
+    assert records[1]['item'] == item(4, 43)
+
+
+def test_retry_releases_recovered_items(tmp_path):
+    quarantine = Quarantine(str(tmp_path))
+    for index in range(4):
+        quarantine.add(item(index, 100 + index), ConnectionResetError())
+    processed = []
+
+    def process(action_item):
+        if action_item['activity']['activityId'] % 2:
+            raise ValueError('still broken')
+        processed.append(action_item['index'])
+
+    quarantine.retry(process, workers=2)
+
+    assert sorted(processed) == [0, 2]
+    records = read_records(str(tmp_path))
+    assert sorted(r['activityId'] for r in records) == [101, 103]
+    assert all(r['attempts'] == 2 and r['category'] == 'ValueError' for r in records)
+    summary = quarantine.summary()
+    assert summary[0].startswith('2 activities quarantined')
+    assert '(2 recovered by the retry pass)' in summary[0]
+
+
+def test_new_run_truncates_file(tmp_path):
+    Quarantine(str(tmp_path)).add(item(0, 1), RuntimeError())
+    quarantine = Quarantine(str(tmp_path))
+    assert not read_records(str(tmp_path))
+    assert not quarantine.summary()
@@ -0,0 +1,339 @@
+"""
+Clustering of the activities on the same route.
+
+Each track (GPX or TCX file of the export, see tracks.py) gets a fingerprint: the set of the geohash
+cells (precision 7, about 150 x 150 m) it passes through, condensed into a MinHash signature of
+SIGNATURE_SIZE values. The share of equal values of two signatures estimates the Jaccard similarity
+of the cell sets, i.e. how much of the two routes is the same (the direction doesn't matter). The
+signatures are bucketed per band (locality-sensitive hashing, BANDS bands of SIGNATURE_SIZE / BANDS
+values), only tracks sharing a bucket are compared, so the time grows about linearly with the
+number of activities. Similar tracks are joined into clusters, the ID of a cluster is the smallest
+activity ID in it (an activity on a route of its own is its own cluster).
+
+The signatures are computed by worker processes and cached in the state store of the export
+directory (table 'route_signatures'), so a re-run only reads the new and changed track files. The
+cluster IDs are written into a column of 'activities.csv' (rewritten atomically); the rows gcexport.py
+appends later have the column too, but empty until the clustering is run again:
+
+    python routes.py cluster EXPORT_DIRECTORY [--threshold 0.5] [--column 'Route Cluster'] [--workers N]
+
+Only the GPX and TCX files outside of packs are read (FIT files aren't parsed). NumPy is needed
+(pip install numpy).
+"""
+
+import argparse
+import csv
+import io
+import logging
+import os
+import sys
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+from csv_compact import open_csv
+from fileio import ACTIVITY_FILE_PATTERN, atomic_writer
+from simplify import SIMPLIFIED_EXTENSION
+from state import STATE_FILE_NAME, StateStore
+from tracks import read_track, track_files
+
+# geohash precision of the cells (number of base 32 characters)
+GEOHASH_PRECISION = 7
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# the tracks are resampled to this distance between the points, so no cell is skipped
+SAMPLE_DISTANCE = 30.0
+
+# number of MinHash values of a signature, and number of bands for the locality-sensitive hashing
+SIGNATURE_SIZE = 64
+BANDS = 16
+
+# minimum estimated Jaccard similarity of the cells of two tracks in the same cluster
+DEFAULT_THRESHOLD = 0.5
+
+DEFAULT_COLUMN = 'Route Cluster'
+
+EARTH_RADIUS = 6371000.0
+
+# the file read for an activity with several track files, the simplified copy is the quickest to parse
+TRACK_PREFERENCE = (SIMPLIFIED_EXTENSION, '.gpx', '.tcx')
+
+
+def _numpy():
+    try:
+        import numpy  # pylint: disable=import-outside-toplevel
+    except ImportError as ex:
+        raise ImportError("Route clustering needs the 'numpy' package (pip install numpy)") from ex
+    return numpy
+
+
+def geohash_cells(latitude, longitude, precision=GEOHASH_PRECISION):
+    """
+    The geohash cells of points, as integers (the bits of the geohash)
+
+    :param latitude:  array of decimal degrees
+    :param longitude: array of decimal degrees
+    :return:          sorted array (uint64) of the distinct cells
+    """
+    numpy = _numpy()
+    bits = precision * 5
+    longitude_bits, latitude_bits = (bits + 1) // 2, bits // 2
+    latitude_index = numpy.clip(numpy.floor((latitude + 90) / 180 * 2**latitude_bits), 0, 2**latitude_bits - 1)
+    longitude_index = numpy.clip(numpy.floor((longitude + 180) / 360 * 2**longitude_bits), 0, 2**longitude_bits - 1)
+    latitude_index, longitude_index = latitude_index.astype(numpy.uint64), longitude_index.astype(numpy.uint64)
+    cells = numpy.zeros(len(latitude_index), dtype=numpy.uint64)
+    one = numpy.uint64(1)
+    # the bits alternate, starting with the most significant bit of the longitude
+    for bit in range(bits):
+        if bit % 2 == 0:
+            value = (longitude_index >> numpy.uint64(longitude_bits - 1 - bit // 2)) & one
+        else:
+            value = (latitude_index >> numpy.uint64(latitude_bits - 1 - bit // 2)) & one
+        cells = (cells << one) | value
+    return numpy.unique(cells)
+
+
+def geohash_string(cell, precision=GEOHASH_PRECISION):
+    """The geohash (base 32 text) of a cell of 'geohash_cells'"""
+    cell = int(cell)
+    return ''.join(GEOHASH_ALPHABET[(cell >> (5 * (precision - 1 - index))) & 31] for index in range(precision))
+
+
+def resample(latitude, longitude, distance=SAMPLE_DISTANCE):
+    """
+    Points along a track every 'distance' meters (linear interpolation), without the points
+    lacking a position
+
+    :return: tuple (latitude array, longitude array)
+    """
+    numpy = _numpy()
+    valid = ~(numpy.isnan(latitude) | numpy.isnan(longitude))
+    latitude, longitude = latitude[valid], longitude[valid]
+    if len(latitude) < 2:
+        return latitude, longitude
+    # equirectangular projection, precise enough between neighbouring points
+    step_x = numpy.radians(numpy.diff(longitude)) * numpy.cos(numpy.radians(latitude[:-1]))
+    step_y = numpy.radians(numpy.diff(latitude))
+    along = numpy.concatenate(([0.0], numpy.cumsum(numpy.hypot(step_x, step_y) * EARTH_RADIUS)))
+    grid = numpy.append(numpy.arange(0.0, along[-1], distance), along[-1])
+    return numpy.interp(grid, along, latitude), numpy.interp(grid, along, longitude)
+
+
+def _mix(values):
+    """splitmix64 finalizer, a well distributed hash of uint64 values (wrapping arithmetic)"""
+    numpy = _numpy()
+    values = values + numpy.uint64(0x9E3779B97F4A7C15)
+    values = (values ^ (values >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    return values ^ (values >> numpy.uint64(31))
+
+
+def minhash(cells, size=SIGNATURE_SIZE):
+    """
+    MinHash signature of a set of cells: per hash function (the mix of the cell with a seed) the
+    minimum over the cells
+
+    :param cells: array (uint64) of the cells, not empty
+    :return:      array (uint32) of 'size' values
+    """
+    numpy = _numpy()
+    seeds = _mix(numpy.arange(1, size + 1, dtype=numpy.uint64))
+    hashes = _mix(cells[numpy.newaxis, :] ^ seeds[:, numpy.newaxis])
+    return (hashes.min(axis=1) >> numpy.uint64(32)).astype(numpy.uint32)
+
+
+def track_signature(filename):
+    """The MinHash signature of the route of a GPX or TCX file, None if it has no positions"""
+    track = read_track(filename)
+    latitude, longitude = resample(track['lat'], track['lon'])
+    if len(latitude) == 0:
+        return None
+    return minhash(geohash_cells(latitude, longitude))
+
+
+def _track_signature(filename):
+    """'track_signature' for the process pool: tuple (file name, signature bytes (empty without positions), error or None)"""
+    try:
+        signature = track_signature(filename)
+        return filename, b'' if signature is None else signature.tobytes(), None
+    except (ET.ParseError, ValueError, OSError) as ex:
+        return filename, None, f'{type(ex).__name__}: {ex}'
+
+
+def activity_tracks(directory):
+    """
+    The track file to read per activity (see TRACK_PREFERENCE)
+
+    :return: dict activity ID (int) -> file name
+    """
+    tracks = {}
+    for filename in track_files(directory):
+        match = ACTIVITY_FILE_PATTERN.match(os.path.basename(filename))
+        if not match:
+            continue
+        rank = next(index for index, extension in enumerate(TRACK_PREFERENCE) if filename.lower().endswith(extension))
+        activity_id = int(match.group(1))
+        if activity_id not in tracks or rank < tracks[activity_id][0]:
+            tracks[activity_id] = (rank, filename)
+    return {activity_id: filename for activity_id, (_, filename) in tracks.items()}
+
+
+def cluster_signatures(signatures, threshold=DEFAULT_THRESHOLD, bands=BANDS):
+    """
+    Cluster the signatures with locality-sensitive hashing: tracks with equal values in a band
+    are compared with the first track of the bucket, and joined if the estimated similarity
+    reaches 'threshold'
+
+    :param signatures: dict activity ID (int) -> signature
+    :return:           dict activity ID -> cluster ID (the smallest activity ID of the cluster)
+    """
+    numpy = _numpy()
+    parent = {activity_id: activity_id for activity_id in signatures}
+
+    def find(activity_id):
+        while parent[activity_id] != activity_id:
+            parent[activity_id] = parent[parent[activity_id]]
+            activity_id = parent[activity_id]
+        return activity_id
+
+    ids = sorted(signatures)
+    rows = SIGNATURE_SIZE // bands
+    for band in range(bands):
+        buckets = {}
+        for activity_id in ids:
+            first = buckets.setdefault(signatures[activity_id][band * rows : (band + 1) * rows].tobytes(), activity_id)
+            if first == activity_id:
+                continue
+            root, other = find(first), find(activity_id)
+            if root != other and numpy.mean(signatures[first] == signatures[activity_id]) >= threshold:
+                parent[max(root, other)] = min(root, other)
+    return {activity_id: find(activity_id) for activity_id in ids}
+
+
+class SignatureCache:  # pylint: disable=too-few-public-methods
+    """The route signatures of an export directory, cached in its state store, see the module documentation"""
+
+    def __init__(self, store):
+        self.store = store
+        with store.transaction():
+            store.execute(
+                'CREATE TABLE IF NOT EXISTS route_signatures ('
+                ' activity_id INTEGER PRIMARY KEY, filename TEXT, mtime REAL, size INTEGER, signature BLOB)'
+            )
+
+    def signatures(self, directory, workers=None):
+        """
+        The signatures of the tracks in an export directory, computing those of new and changed files
+
+        :param workers: number of worker processes (default: number of CPUs)
+        :return:        tuple (dict activity ID -> signature for the tracks with positions, number of files read,
+                        number of failures)
+        """
+        numpy = _numpy()
+        tracks = activity_tracks(directory)
+        cached = {row[0]: row[1:] for row in self.store.execute('SELECT * FROM route_signatures')}
+        stale = {}
+        for activity_id, filename in tracks.items():
+            stat = os.stat(filename)
+            if cached.get(activity_id, (None,) * 4)[:3] != (filename, stat.st_mtime, stat.st_size):
+                stale[filename] = (activity_id, stat)
+        failed = 0
+        if stale:
+            updates = []
+            with ProcessPoolExecutor(workers) as executor:
+                for filename, signature, error in executor.map(_track_signature, sorted(stale), chunksize=16):
+                    if error:
+                        logging.warning('Unable to read the track of %s: %s', filename, error)
+                        failed += 1
+                        continue
+                    activity_id, stat = stale[filename]
+                    updates.append((activity_id, filename, stat.st_mtime, stat.st_size, signature))
+                    cached[activity_id] = updates[-1][1:]
+            with self.store.transaction():
+                self.store.executemany('INSERT OR REPLACE INTO route_signatures VALUES (?, ?, ?, ?, ?)', updates)
+        signatures = {
+            activity_id: numpy.frombuffer(cached[activity_id][3], dtype=numpy.uint32)
+            for activity_id in tracks
+            if activity_id in cached and cached[activity_id][3]
+        }
+        return signatures, len(stale), failed
+
+
+def write_cluster_column(csv_filename, clusters, id_column='Activity ID', column=DEFAULT_COLUMN):
+    """
+    Write the cluster IDs into a column of a CSV file (added if missing), replacing the file atomically;
+    the column is emptied for the activities without cluster
+
+    :param clusters: dict activity ID (int) -> cluster ID
+    :return:         number of rows with a cluster ID
+    """
+    with open_csv(csv_filename, id_column) as (header, id_index, reader):
+        if header is None:
+            return 0
+        if column not in header:
+            header.append(column)
+        column_index = header.index(column)
+        rows = 0
+        with atomic_writer(csv_filename) as csv_out:
+            text = io.TextIOWrapper(csv_out, encoding='utf-8', newline='')
+            writer = csv.writer(text, quoting=csv.QUOTE_ALL)
+            writer.writerow(header)
+            for row in reader:
+                row += [''] * (len(header) - len(row))
+                activity_id = row[id_index]
+                cluster = clusters.get(int(activity_id)) if activity_id.isdigit() else None
+                row[column_index] = '' if cluster is None else str(cluster)
+                rows += cluster is not None
+                writer.writerow(row)
+            text.flush()
+            text.detach()
+    return rows
+
+
+def parse_arguments(argv):
+    """
+    Setup the argument parser and parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Route clustering for the activities of the Garmin Connect Exporter')
+    commands = parser.add_subparsers(dest='command', required=True)
+    cluster_parser = commands.add_parser(
+        'cluster', help='cluster the tracks of an export directory and write the cluster IDs into activities.csv'
+    )
+    cluster_parser.add_argument('directory', help='export directory')
+    cluster_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help=f'minimum similarity (share of the same cells, 0..1) of the routes in a cluster (default: {DEFAULT_THRESHOLD})')  # fmt: skip
+    cluster_parser.add_argument('--column', default=DEFAULT_COLUMN,
+        help=f"name of the CSV column for the cluster IDs (default: '{DEFAULT_COLUMN}')")  # fmt: skip
+    cluster_parser.add_argument('--id-column', default='Activity ID',
+        help="name of the CSV column with the activity IDs (default: 'Activity ID')")  # fmt: skip
+    cluster_parser.add_argument('--workers', type=int,
+        help='number of worker processes (default: number of CPUs)')  # fmt: skip
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    """
+    Main entry point for routes.py
+    """
+    args = parse_arguments(argv)
+    store = StateStore(os.path.join(args.directory, STATE_FILE_NAME))
+    try:
+        signatures, read, failed = SignatureCache(store).signatures(args.directory, args.workers)
+    finally:
+        store.close()
+    clusters = cluster_signatures(signatures, args.threshold)
+    sizes = {}
+    for cluster in clusters.values():
+        sizes[cluster] = sizes.get(cluster, 0) + 1
+    repeated = sorted((size, cluster) for cluster, size in sizes.items() if size > 1)
+    print(f'{len(signatures)} tracks ({read} read, {failed} failed), {len(repeated)} routes with repeats')
+    for size, cluster in reversed(repeated[-10:]):
+        print(f'{size:6} activities on the route of activity {cluster}')
+    csv_filename = os.path.join(args.directory, 'activities.csv')
+    if os.path.isfile(csv_filename):
+        rows = write_cluster_column(csv_filename, clusters, args.id_column, args.column)
+        print(f'{rows} rows of {csv_filename} with a cluster ID')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for routes.py; Call them with this command line:
+
+py.test routes_test.py
+"""
+
+import csv
+import shutil
+
+import pytest
+
+from routes import cluster_signatures, geohash_cells, geohash_string, main, minhash, resample
+
+numpy = pytest.importorskip('numpy')
+
+
+def _route(generator, start, heading, noise=0.00004):
+    """A wiggly 5 km route (about 300 points), recorded with GPS noise (about 4 m)"""
+    steps = numpy.linspace(0, 0.045, 300)
+    latitude = start[0] + steps * numpy.cos(heading) + 0.002 * numpy.sin(steps * 300)
+    longitude = start[1] + steps * numpy.sin(heading)
+    return latitude + generator.normal(0, noise, 300), longitude + generator.normal(0, noise, 300)
+
+
+def _signature(latitude, longitude):
+    return minhash(geohash_cells(*resample(latitude, longitude)))
+
+
+def test_geohash():
+    cells = geohash_cells(numpy.array([57.64911, 57.64911]), numpy.array([10.40744, 10.40744]))
+    assert len(cells) == 1
+    assert geohash_string(cells[0]) == 'u4pruyd'
+    assert geohash_string(geohash_cells(numpy.array([-33.8688]), numpy.array([151.2093]), 5)[0], 5) == 'r3gx2'
+
+
+def test_resample():
+    # 0.01 degrees of latitude are about 1112 m
+    latitude, longitude = resample(numpy.array([47.0, numpy.nan, 47.01]), numpy.array([8.0, 8.0, 8.0]), 100)
+    assert len(latitude) == 13
+    assert latitude[0] == 47.0 and latitude[-1] == 47.01
+    assert numpy.all(longitude == 8.0)
+
+
+def test_cluster_repeated_routes():
+    generator = numpy.random.default_rng(1)
+    starts = [(46.0 + index * 0.1, 7.0 + index * 0.05) for index in range(20)]
+    signatures = {}
+    for route, start in enumerate(starts):
+        # five recordings per route, ID = route * 10 + recording
+        for recording in range(5):
+            signatures[route * 10 + recording + 1] = _signature(*_route(generator, start, route))
+    # a route starting at the same place, in another direction
+    signatures[1000] = _signature(*_route(generator, starts[0], 2.5))
+    # the same route the other way round
+    latitude, longitude = _route(generator, starts[1], 1)
+    signatures[1001] = _signature(latitude[::-1], longitude[::-1])
+
+    clusters = cluster_signatures(signatures)
+    for route in range(20):
+        assert {clusters[route * 10 + recording + 1] for recording in range(5)} == {route * 10 + 1}
+    assert clusters[1000] == 1000
+    assert clusters[1001] == 11
+
+
+def test_main(tmp_path, capsys):
+    for activity_id in ('20190519532', '20190519533'):
+        shutil.copy('test_output/activity_20190519532.gpx', tmp_path / f'activity_{activity_id}.gpx')
+    (tmp_path / 'activity_3.gpx').write_bytes(b'<gpx xmlns="http://www.topografix.com/GPX/1/1"/>')
+    with open(tmp_path / 'activities.csv', 'w', encoding='utf-8', newline='') as csv_file:
+        csv.writer(csv_file, quoting=csv.QUOTE_ALL).writerows(
+            [['Activity ID', 'Name'], ['20190519533', 'copy'], ['20190519532', 'paddling'], ['3', 'indoor'], ['4', 'no file']]
+        )
+
+    assert main(['routes.py', 'cluster', str(tmp_path), '--workers', '1']) == 0
+    output = capsys.readouterr().out
+    assert '2 tracks (3 read, 0 failed), 1 routes with repeats' in output
+    with open(tmp_path / 'activities.csv', encoding='utf-8', newline='') as csv_file:
+        rows = list(csv.reader(csv_file))
+    assert rows[0] == ['Activity ID', 'Name', 'Route Cluster']
+    assert [row[2] for row in rows[1:]] == ['20190519532', '20190519532', '', '']
+
+    # a re-run uses the cached signatures
+    assert main(['routes.py', 'cluster', str(tmp_path), '--column', 'Route Cluster']) == 0
+    assert '2 tracks (0 read, 0 failed)' in capsys.readouterr().out
@@ -0,0 +1,171 @@
+"""
+Low overhead sampling profiler for gcexport.py (option '--profile').
+
+A background thread takes a snapshot of the Python stacks of all other threads
+every few milliseconds (wall-clock time, so waiting for the network is visible too); threads
+parked in a wait primitive (idle pool and background threads) are left out.
+The result is written as "folded stacks" (one line per distinct stack with its sample
+count, the input format of flamegraph.pl, speedscope and similar tools) and as a
+summary with the time per category (network, JSON, CSV, filesystem) and the top functions.
+"""
+
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from timeit import default_timer as timer
+
+# seconds between two samples
+SAMPLE_INTERVAL = 0.005
+
+# (category, file name fragments, function names): the first rule matching a frame of the stack
+# (starting with the innermost frame) determines the category of a sample
+CATEGORY_RULES = [
+    ('network', ('socket.py', 'ssl.py', os.path.join('http', 'client.py'), os.path.join('urllib', 'request.py')), ()),
+    ('json', (os.path.join('json', ''),), ()),
+    ('csv', (), ('csv_write_record', 'write_row', 'compact_csv')),
+    ('filesystem', ('zipfile', 'shutil.py', 'tempfile.py'), ('write_to_file', 'update_download_stats', 'read_exclude')),
+]
+
+# innermost frames of threads waiting for work or for other threads, whose samples are skipped
+IDLE_FRAMES = frozenset(
+    (
+        'threading.py:wait',
+        'threading.py:_wait_for_tstate_lock',
+        'queue.py:get',
+        # idle thread of a ThreadPoolExecutor, blocked in SimpleQueue.get
+        'thread.py:_worker',
+        # management thread of a ProcessPoolExecutor
+        'connection.py:wait',
+    )
+)
+
+
+class SamplingProfiler:  # pylint: disable=too-many-instance-attributes
+    """Samples the stacks of all threads in a background thread, usable as context manager"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.categories = Counter()
+        self.samples = 0
+        self.idle_samples = 0
+        self.elapsed = 0.0
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_time = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Start sampling"""
+        self._stop.clear()
+        self._start_time = timer()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.elapsed = timer() - self._start_time
+
+    def _label(self, code):
+        """'file:function' label of a code object, cached as the same code objects are seen over and over"""
+        label = self._labels.get(code)
+        if label is None:
+            label = f'{os.path.basename(code.co_filename)}:{code.co_name}'
+            self._labels[code] = label
+        return label
+
+    @staticmethod
+    def _category(codes):
+        """Category of a sample, 'codes' are the code objects of the stack, innermost first"""
+        for code in codes:
+            for category, file_fragments, functions in CATEGORY_RULES:
+                if code.co_name in functions or any(fragment in code.co_filename for fragment in file_fragments):
+                    return category
+        return 'other'
+
+    def _run(self):
+        """Sampling loop of the background thread"""
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if thread_id == own_id:
+                    continue
+                if frame is not None and self._label(frame.f_code) in IDLE_FRAMES:
+                    self.idle_samples += 1
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                labels = [names.get(thread_id, str(thread_id))] + [self._label(code) for code in reversed(codes)]
+                self.stacks[';'.join(labels)] += 1
+                self.categories[self._category(codes)] += 1
+                self.samples += 1
+
+    def write_folded(self, filename):
+        """Write the samples as folded stacks (input format of flamegraph.pl)"""
+        with open(filename, 'w', encoding='utf-8') as folded:
+            for stack, count in self.stacks.most_common():
+                folded.write(f'{stack} {count}\n')
+
+    def summary(self, top=25):
+        """
+        Summary with the time per category and the functions with the most samples
+
+        :param top: number of functions to list
+        :return:    list of lines
+        """
+        total = self.samples or 1
+        inclusive = Counter()
+        own = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')[1:]
+            for label in set(frames):
+                inclusive[label] += count
+            if frames:
+                own[frames[-1]] += count
+
+        lines = [
+            f'{self.samples} samples in {self.elapsed:.1f} s (interval {self.interval * 1000:.0f} ms, all threads), '
+            f'{self.idle_samples} samples of waiting threads skipped',
+            '',
+        ]
+        lines.append(f"{'category':12} {'samples':>8} {'share':>7}")
+        for category, count in self.categories.most_common():
+            lines.append(f'{category:12} {count:8} {count / total:7.1%}')
+        for title, counter in (('self', own), ('inclusive', inclusive)):
+            lines.append('')
+            lines.append(f"{'top functions (' + title + ')':60} {'samples':>8} {'share':>7}")
+            for label, count in counter.most_common(top):
+                lines.append(f'{label[:60]:60} {count:8} {count / total:7.1%}')
+        return lines
+
+    def write_results(self, directory, basename):
+        """
+        Write '<basename>.folded' and '<basename>.txt' (the summary) to the given directory
+
+        :return: tuple with the two file names
+        """
+        folded_name = os.path.join(directory, basename + '.folded')
+        summary_name = os.path.join(directory, basename + '.txt')
+        self.write_folded(folded_name)
+        with open(summary_name, 'w', encoding='utf-8') as summary_file:
+            summary_file.write('\n'.join(self.summary()) + '\n')
+        logging.info('Profile written to %s and %s', folded_name, summary_name)
+        return folded_name, summary_name
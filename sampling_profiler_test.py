@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for sampling_profiler.py; Call them with this command line:
+
+py.test sampling_profiler_test.py
+"""
+
+import json
+import queue
+import threading
+import time
+
+from sampling_profiler import SamplingProfiler
+
+
+def busy_parsing(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        json.loads('{"a": [1, 2, 3], "b": "some text"}' * 1)
+
+
+def test_sampling_profiler(tmp_path):
+    with SamplingProfiler(interval=0.001) as profiler:
+        busy_parsing(0.2)
+
+    assert profiler.samples > 10
+    assert any('sampling_profiler_test.py:busy_parsing' in stack for stack in profiler.stacks)
+
+    folded_name, summary_name = profiler.write_results(tmp_path, 'profile')
+    with open(folded_name, encoding='utf-8') as folded:
+        for line in folded:
+            stack, count = line.rsplit(' ', 1)
+            assert stack.startswith('MainThread;')
+            assert int(count) > 0
+    with open(summary_name, encoding='utf-8') as summary:
+        assert 'busy_parsing' in summary.read()
+
+
+def test_sampling_profiler_skips_waiting_threads():
+    idle = queue.Queue()
+    waiter = threading.Thread(target=idle.get, name='idle-worker')
+    waiter.start()
+    with SamplingProfiler(interval=0.001) as profiler:
+        busy_parsing(0.1)
+    idle.put(None)
+    waiter.join()
+
+    assert profiler.idle_samples > 10
+    assert not any(stack.startswith('idle-worker;') for stack in profiler.stacks)
+    assert sum(profiler.categories.values()) == profiler.samples
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""
+Long-lived local agent holding the Garmin Connect session for gcexport.py.
+
+Start it once (it authenticates like gcexport.py, e.g. from a '--session' directory):
+
+    python session_agent.py serve --session ./session_data
+
+Afterwards 'gcexport.py --agent ...' sends the export job over a Unix domain socket to the
+agent instead of starting its own session; the agent runs the jobs one after the other with
+its authenticated session, streams the console output back and refreshes the OAuth token
+before it expires. Without a running agent, 'gcexport.py --agent' simply runs locally.
+"""
+
+# gcexport.py imports 'run_job' from here, the agent imports gcexport.py lazily to run the jobs
+# pylint: disable=cyclic-import
+import argparse
+import contextlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+# refresh the OAuth2 token this many seconds before it expires
+REFRESH_MARGIN = 300
+
+# environment variable overriding the default socket path
+SOCKET_ENV = 'GCEXPORT_AGENT_SOCKET'
+
+# options of gcexport.py not sent to the agent (with their values), it has its own session
+CREDENTIAL_OPTIONS = ('--username', '--password')
+
+# messages of the agent itself; the root logger belongs to the jobs (logfile of gcexport.py)
+LOG = logging.getLogger('session_agent')
+
+
+def default_socket_path():
+    """
+    Path of the agent socket: from the environment, else in the private runtime directory of the user
+    ($XDG_RUNTIME_DIR) or in a per-user directory in the temp directory (created with mode 0700, see 'serve')
+    """
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'gcexport-agent.sock')
+    user = os.getuid() if hasattr(os, 'getuid') else os.environ.get('USERNAME', 'user')
+    return os.path.join(tempfile.gettempdir(), f'gcexport-agent-{user}', 'agent.sock')
+
+
+def _check_private(path):
+    """
+    Make sure that no other user controls a path: it must belong to this user and not be writable by others
+
+    :raise PermissionError: if it belongs to another user or others can write it
+    """
+    status = os.stat(path)
+    if status.st_uid != os.getuid() or status.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f'{path} belongs to another user or is writable by others')
+
+
+def _private_socket_dir(socket_path):
+    """Create the directory of the socket for this user only (mode 0700) if missing, and check it"""
+    directory = os.path.dirname(os.path.abspath(socket_path))
+    with contextlib.suppress(FileExistsError):
+        os.mkdir(directory, 0o700)
+    _check_private(directory)
+
+
+def _check_peer(connection, socket_path):
+    """
+    Make sure that the agent listening on the socket runs as this user, before anything is sent to it
+
+    :raise PermissionError: if the agent (or without SO_PEERCRED the socket or its directory) belongs to another user
+    """
+    if hasattr(socket, 'SO_PEERCRED'):
+        _, uid, _ = struct.unpack('3i', connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+        if uid != os.getuid():
+            raise PermissionError(f'The agent at {socket_path} runs as another user (uid {uid})')
+    else:
+        _check_private(socket_path)
+        _check_private(os.path.dirname(os.path.abspath(socket_path)))
+
+
+def _send(connection, message):
+    connection.sendall(json.dumps(message).encode() + b'\n')
+
+
+def request(message, socket_path=None, on_output=None):
+    """
+    Send a request to the agent and collect the answer
+
+    :param message:     request dict, e.g. {'argv': [...], 'cwd': ...} or {'command': 'status'}
+    :param socket_path: path of the agent socket (default: 'default_socket_path()')
+    :param on_output:   callback receiving the console output of a job as it arrives
+    :return:            the final answer of the agent (dict)
+    :raise OSError:     if no agent is listening on the socket, the agent runs as another user (PermissionError)
+                        or the system has no Unix domain sockets (e.g. Windows)
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        raise OSError('Unix domain sockets are not supported on this system')
+    socket_path = socket_path or default_socket_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        _check_peer(connection, socket_path)
+        _send(connection, message)
+        with connection.makefile('r', encoding='utf-8') as answers:
+            for line in answers:
+                answer = json.loads(line)
+                if 'output' in answer:
+                    if on_output:
+                        on_output(answer['output'])
+                    continue
+                return answer
+    raise ConnectionError('The agent closed the connection without an answer')
+
+
+def job_argv(argv):
+    """The command line sent to the agent: without '--agent' and the CREDENTIAL_OPTIONS with their values"""
+    job, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in CREDENTIAL_OPTIONS:
+            skip = True
+        elif arg != '--agent' and not arg.startswith(tuple(option + '=' for option in CREDENTIAL_OPTIONS)):
+            job.append(arg)
+    return job
+
+
+def run_job(argv, socket_path=None):
+    """
+    Run gcexport.py with the given arguments in the agent, printing its console output
+
+    :param argv: command line (including the program name) for gcexport.py, see 'job_argv' for what is sent
+    :return:     exit code of the job, None if no agent is running (or it can't be trusted, see '_check_peer')
+    """
+    try:
+        answer = request({'argv': job_argv(argv), 'cwd': os.getcwd()}, socket_path, lambda text: print(text, end='', flush=True))
+    except PermissionError as ex:
+        LOG.warning('Not using the session agent: %s', ex)
+        return None
+    except OSError as ex:
+        LOG.debug('No session agent at %s: %s', socket_path or default_socket_path(), ex)
+        return None
+    return answer.get('exit', 1)
+
+
+def _remove_root_handlers(keep):
+    """Close the logging handlers installed by a job (gcexport.py sets up logging in 'main')"""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if handler not in keep:
+            root.removeHandler(handler)
+            handler.close()
+
+
+class _SocketWriter:
+    """File-like object forwarding the console output of a job to the client"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.closed = False
+
+    def write(self, text):
+        """Forward the text, dropping it if the client went away"""
+        if text and not self.closed:
+            try:
+                _send(self.connection, {'output': text})
+            except OSError:
+                self.closed = True
+        return len(text)
+
+    def flush(self):
+        """Nothing to do, every write is sent immediately"""
+
+
+class SessionAgent:
+    """The authenticated session and the job runner of the agent"""
+
+    def __init__(self, args):
+        """
+        :param args: parsed gcexport.py arguments used for the login ('--session', '--username', '--password')
+        """
+        self.args = args
+        self.jobs = 0
+        self.started = time.time()
+        self.stopping = threading.Event()
+
+    def login(self):
+        """Authenticate (or resume the session from the '--session' directory)"""
+        import gcexport  # pylint: disable=import-outside-toplevel
+
+        gcexport.login_to_garmin_connect(self.args)
+
+    def seconds_to_expiry(self):
+        """Seconds until the current OAuth2 token expires"""
+        import garth  # pylint: disable=import-outside-toplevel
+
+        token = garth.client.oauth2_token
+        return token.expires_at - time.time() if token else 0
+
+    def refresh_loop(self):
+        """Refresh the OAuth2 token shortly before it expires, until the agent stops"""
+        import garth  # pylint: disable=import-outside-toplevel
+
+        while not self.stopping.wait(max(self.seconds_to_expiry() - REFRESH_MARGIN, 0)):
+            try:
+                garth.client.refresh_oauth2()
+                LOG.info('Refreshed the OAuth2 token, valid for %.0f s', self.seconds_to_expiry())
+                if self.args.session:
+                    garth.save(self.args.session)
+            except Exception as ex:  # pylint: disable=broad-except
+                LOG.error('Could not refresh the OAuth2 token: %s', ex)
+                self.stopping.wait(60)
+
+    def run(self, argv, cwd, output):
+        """
+        Run one export job in this process, like 'gcexport.py' would when started from the command line
+
+        :param argv:   command line of the job
+        :param cwd:    working directory of the client
+        :param output: stream for the console output
+        :return:       exit code
+        """
+        import gcexport  # pylint: disable=import-outside-toplevel
+
+        self.jobs += 1
+        LOG.info('Job %s: %s', self.jobs, ' '.join(argv[1:]))
+        # each job starts with fresh module state (statistics, known directories, ...) and its own logfile
+        gcexport.reset_state()
+        handlers = list(logging.getLogger().handlers)
+
+        previous_cwd, previous_argv = os.getcwd(), sys.argv
+        exit_code = 0
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                os.chdir(cwd)
+                sys.argv = argv
+                gcexport.main(argv)
+            except SystemExit as ex:
+                exit_code = ex.code if isinstance(ex.code, int) else (0 if ex.code is None else 1)
+            except Exception as abort_exception:  # pylint: disable=broad-except
+                logging.error("Processing aborted.")
+                logging.exception(abort_exception)
+                exit_code = 1
+            finally:
+                os.chdir(previous_cwd)
+                sys.argv = previous_argv
+                _remove_root_handlers(handlers)
+        LOG.info('Job %s finished with exit code %s', self.jobs, exit_code)
+        return exit_code
+
+    def status(self):
+        """Description of the agent state"""
+        return {'pid': os.getpid(), 'uptime': round(time.time() - self.started), 'jobs': self.jobs,
+                'token_expires_in': round(self.seconds_to_expiry())}  # fmt: skip
+
+
+def make_handler(agent):
+    """Create the request handler class for the given agent"""
+
+    class Handler(socketserver.StreamRequestHandler):
+        """Handles one request: a job, 'status' or 'stop'"""
+
+        def handle(self):
+            message = json.loads(self.rfile.readline())
+            if message.get('command') == 'status':
+                _send(self.connection, agent.status())
+            elif message.get('command') == 'stop':
+                _send(self.connection, {'stopping': True})
+                agent.stopping.set()
+            else:
+                exit_code = agent.run(message['argv'], message.get('cwd', os.getcwd()), _SocketWriter(self.connection))
+                with contextlib.suppress(OSError):
+                    _send(self.connection, {'exit': exit_code})
+
+    return Handler
+
+
+def serve(args, socket_path):
+    """Authenticate, then serve jobs on the socket until a 'stop' request arrives"""
+    agent = SessionAgent(args)
+    agent.login()
+    # logging during the login may have configured the root logger, which must be left to the jobs
+    _remove_root_handlers(keep=())
+
+    _private_socket_dir(socket_path)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(socket_path)
+    # jobs are handled one after the other: gcexport.py keeps its state in module globals
+    # created without access for other users: whoever can connect runs jobs with the session
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.UnixStreamServer(socket_path, make_handler(agent))
+    finally:
+        os.umask(umask)
+    threading.Thread(target=agent.refresh_loop, name='token-refresh', daemon=True).start()
+    threading.Thread(target=lambda: (agent.stopping.wait(), server.shutdown()), daemon=True).start()
+    print(f'Session agent listening on {socket_path}, token valid for {agent.seconds_to_expiry():.0f} s')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(socket_path)
+
+
+def parse_arguments(argv):
+    """
+    Setup the argument parser and parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Session agent for the Garmin Connect Exporter')
+    parser.add_argument('--socket', default=default_socket_path(),
+        help=f'path of the agent socket (default: ${SOCKET_ENV}, else in $XDG_RUNTIME_DIR or a per-user directory in the temp directory)')  # fmt: skip
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help='authenticate and serve export jobs')
+    serve_parser.add_argument('--username', help='your Garmin Connect username or email address')
+    serve_parser.add_argument('--password', help='your Garmin Connect password')
+    serve_parser.add_argument('-ss', '--session', metavar='DIRECTORY',
+        help='load and store the SSO information from/to the given directory')  # fmt: skip
+    commands.add_parser('status', help='show the state of the running agent')
+    commands.add_parser('stop', help='stop the running agent')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    """
+    Main entry point for session_agent.py
+    """
+    args = parse_arguments(argv)
+    if args.command == 'serve':
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)-7.7s] %(message)s'))
+        LOG.addHandler(handler)
+        LOG.setLevel(logging.INFO)
+        LOG.propagate = False
+        serve(args, args.socket)
+        return 0
+    try:
+        answer = request({'command': args.command}, args.socket)
+    except OSError as ex:
+        print(f'No session agent running at {args.socket} ({ex})')
+        return 1
+    print(json.dumps(answer))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
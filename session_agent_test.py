@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for session_agent.py; Call them with this command line:
+
+py.test session_agent_test.py
+"""
+
+import multiprocessing
+import os
+import socket
+import socketserver
+import tempfile
+import time
+
+import pytest
+
+from session_agent import SessionAgent, _private_socket_dir, job_argv, make_handler, parse_arguments, request, run_job
+
+
+def serve(socket_path):
+    agent = SessionAgent(parse_arguments(['session_agent.py', 'serve']))
+    with socketserver.UnixStreamServer(socket_path, make_handler(agent)) as server:
+        server.serve_forever()
+
+
+@pytest.fixture
+def agent_socket():
+    # short path, the length of Unix socket paths is limited
+    directory = tempfile.mkdtemp(prefix='gca-')
+    socket_path = os.path.join(directory, 'agent.sock')
+    # a separate process, as the jobs redirect the standard output of the whole process
+    process = multiprocessing.Process(target=serve, args=(socket_path,), daemon=True)
+    process.start()
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.05)
+    yield socket_path
+    process.terminate()
+    process.join()
+    os.remove(socket_path)
+    os.rmdir(directory)
+
+
+def test_run_job_streams_output_and_exit_code(agent_socket, capsys):
+    assert run_job(['gcexport.py', '--version'], agent_socket) == 0
+    assert 'gcexport.py' in capsys.readouterr().out
+
+    assert run_job(['gcexport.py', '--no-such-option'], agent_socket) == 2
+    assert 'unrecognized arguments' in capsys.readouterr().out
+
+
+def test_status_and_stop(agent_socket):
+    status = request({'command': 'status'}, agent_socket)
+    assert status['jobs'] == 0
+    assert status['token_expires_in'] == 0
+    assert request({'command': 'stop'}, agent_socket) == {'stopping': True}
+
+
+def test_no_agent(tmp_path):
+    assert run_job(['gcexport.py', '--version'], str(tmp_path / 'missing.sock')) is None
+
+
+def test_job_argv_without_credentials():
+    argv = ['gcexport.py', '--agent', '--username', 'me', '--password=secret', '-c', '5', '--password', 'secret']
+    assert job_argv(argv) == ['gcexport.py', '-c', '5']
+
+
+def test_socket_dir_must_be_private(tmp_path):
+    _private_socket_dir(str(tmp_path / 'agent' / 'agent.sock'))
+    assert (tmp_path / 'agent').stat().st_mode & 0o777 == 0o700
+
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    shared.chmod(0o777)
+    with pytest.raises(PermissionError):
+        _private_socket_dir(str(shared / 'agent.sock'))
+
+
+def test_no_unix_sockets(monkeypatch, tmp_path):
+    # e.g. on Windows
+    monkeypatch.delattr(socket, 'AF_UNIX')
+    assert run_job(['gcexport.py', '--version'], str(tmp_path / 'agent.sock')) is None
@@ -0,0 +1,135 @@
+"""
+Date range shards of an export (option '--shards' of gcexport.py).
+
+The date range of '--start_date' and '--end_date' is split into shards of about the same number
+of days. Each shard is exported by a worker process of its own (with its own HTTP connections)
+into the same export directory: an activity belongs to exactly one shard, so the activity files
+don't collide, and the state store is shared (SQLite serializes the writes of the processes). The
+files every run rewrites (the CSV file, the quarantine file and the list of downloaded IDs) are
+written per shard, with the shard in their name (see 'shard_filename'), and merged into the usual
+files when all shards are done. The worker processes space their requests with one shared
+RateLimiter ('--rate-limit'), so together they don't send more requests than a single process may.
+"""
+
+import json
+import os
+import threading
+import time
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+
+def shard_ranges(start_date, end_date, shards):
+    """
+    Split a date range into shards of about the same number of days
+
+    :param start_date: first day (ISO format, e.g. '2015-01-01')
+    :param end_date:   last day (inclusive)
+    :param shards:     number of shards, limited to the number of days
+    :return:           list of tuples (first day, last day) in ISO format, the newest shard first
+    """
+    first, last = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    days = (last - first).days + 1
+    if days < 1:
+        raise ValueError(f'The end date {end_date} is before the start date {start_date}')
+    shards = min(shards, days)
+    bounds = [first + timedelta(days=days * index // shards) for index in range(shards + 1)]
+    return [(begin.isoformat(), (end - timedelta(days=1)).isoformat()) for begin, end in reversed(list(zip(bounds, bounds[1:])))]
+
+
+def shard_name(start_date, end_date):
+    """The name of a shard, used in the names of its files, e.g. '20150101-20151231'"""
+    return f"{start_date.replace('-', '')}-{end_date.replace('-', '')}"
+
+
+def shard_filename(filename, shard):
+    """The name of a file written per shard, e.g. 'activities-20150101-20151231.csv'; 'filename' without shard"""
+    if shard is None:
+        return filename
+    stem, extension = os.path.splitext(filename)
+    return f'{stem}-{shard}{extension}'
+
+
+class RateLimiter:
+    """
+    Spaces the HTTP requests to at most 'rate' per second; with 'shared' the limit holds for the
+    current process and the processes forked from it together
+    """
+
+    def __init__(self):
+        self.interval = 0
+        # time (seconds since 1970-01-01) from which the next request may be sent
+        self._next = SimpleNamespace(value=0.0)
+        self._lock = threading.Lock()
+
+    def configure(self, rate, shared=False):
+        """
+        :param rate:   requests per second, None or 0 for no limit
+        :param shared: share the limit with the processes forked later (see multiprocessing)
+        """
+        self.interval = 1 / rate if rate else 0
+        if shared:
+            import multiprocessing  # pylint: disable=import-outside-toplevel
+
+            context = multiprocessing.get_context('fork')
+            self._next = context.RawValue('d', 0.0)
+            self._lock = context.Lock()
+
+    def wait(self):
+        """Wait until the next request may be sent"""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next.value)
+            self._next.value = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def merge_files(target, sources, header=False):
+    """
+    Append files (e.g. the CSV files of the shards) to a file and remove them
+
+    :param target:  the file appended to, created if missing
+    :param sources: the files to append, missing files are skipped
+    :param header:  the files start with a header line (CSV), which is only written to a new target file
+    :return:        number of files appended
+    """
+    merged = 0
+    with open(target, 'ab') as target_file:
+        for source in sources:
+            if not os.path.isfile(source):
+                continue
+            with open(source, 'rb') as source_file:
+                first_line = source_file.readline() if header else b''
+                if target_file.tell() == 0:
+                    target_file.write(first_line)
+                while chunk := source_file.read(1 << 20):
+                    target_file.write(chunk)
+            os.remove(source)
+            merged += 1
+    return merged
+
+
+def merge_id_files(target, sources, key):
+    """
+    Merge JSON files with a list of IDs (see filtering.py) into one and remove them
+
+    :param key: the member with the list of IDs
+    :return:    number of IDs in the target file
+    """
+    ids = set()
+    for filename in [target] + [source for source in sources if os.path.isfile(source)]:
+        try:
+            with open(filename, 'r', encoding='utf-8') as json_file:
+                content = json.load(json_file)
+            ids.update(content.get(key, []) if isinstance(content, dict) else [])
+        except (OSError, ValueError):
+            pass
+    with open(target, 'w', encoding='utf-8') as json_file:
+        json.dump({key: sorted(ids)}, json_file)
+    for source in sources:
+        if os.path.isfile(source):
+            os.remove(source)
+    return len(ids)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for sharding.py; Call them with this command line:
+
+py.test sharding_test.py
+"""
+
+import json
+import multiprocessing
+import time
+
+import pytest
+
+from sharding import RateLimiter, merge_files, merge_id_files, shard_filename, shard_name, shard_ranges
+
+
+def test_shard_ranges():
+    assert shard_ranges('2015-01-01', '2015-01-10', 3) == [
+        ('2015-01-07', '2015-01-10'),
+        ('2015-01-04', '2015-01-06'),
+        ('2015-01-01', '2015-01-03'),
+    ]
+    # not more shards than days
+    assert shard_ranges('2015-01-01', '2015-01-02', 4) == [('2015-01-02', '2015-01-02'), ('2015-01-01', '2015-01-01')]
+    ranges = shard_ranges('2010-01-01', '2019-12-31', 8)
+    assert ranges[0][1] == '2019-12-31' and ranges[-1][0] == '2010-01-01'
+    with pytest.raises(ValueError):
+        shard_ranges('2015-01-02', '2015-01-01', 2)
+
+
+def test_shard_filename():
+    shard = shard_name('2015-01-01', '2015-12-31')
+    assert shard == '20150101-20151231'
+    assert shard_filename('activities.csv', shard) == 'activities-20150101-20151231.csv'
+    assert shard_filename('activities-1-100.json', shard) == 'activities-1-100-20150101-20151231.json'
+    assert shard_filename('activities.csv', None) == 'activities.csv'
+
+
+def test_merge_files(tmp_path):
+    (tmp_path / 'a.csv').write_bytes(b'"id","name"\r\n"3","c"\r\n')
+    (tmp_path / 'b.csv').write_bytes(b'"id","name"\r\n"2","b"\r\n"1","a"\r\n')
+    sources = [str(tmp_path / name) for name in ('a.csv', 'missing.csv', 'b.csv')]
+    assert merge_files(str(tmp_path / 'all.csv'), sources, header=True) == 2
+    assert (tmp_path / 'all.csv').read_bytes() == b'"id","name"\r\n"3","c"\r\n"2","b"\r\n"1","a"\r\n'
+    assert not (tmp_path / 'a.csv').exists()
+
+    # an existing file keeps its header
+    (tmp_path / 'c.csv').write_bytes(b'"id","name"\r\n"0","z"\r\n')
+    merge_files(str(tmp_path / 'all.csv'), [str(tmp_path / 'c.csv')], header=True)
+    assert (tmp_path / 'all.csv').read_bytes().count(b'"id"') == 1
+
+
+def test_merge_id_files(tmp_path):
+    (tmp_path / 'ids.json').write_text(json.dumps({'ids': ['1', '2']}), encoding='utf-8')
+    (tmp_path / 'ids-a.json').write_text(json.dumps({'ids': ['2', '3']}), encoding='utf-8')
+    (tmp_path / 'ids-b.json').write_text('not json', encoding='utf-8')
+    sources = [str(tmp_path / 'ids-a.json'), str(tmp_path / 'ids-b.json'), str(tmp_path / 'ids-c.json')]
+    assert merge_id_files(str(tmp_path / 'ids.json'), sources, 'ids') == 3
+    assert json.loads((tmp_path / 'ids.json').read_text(encoding='utf-8')) == {'ids': ['1', '2', '3']}
+    assert not (tmp_path / 'ids-a.json').exists()
+
+
+def _send_requests(limiter, count):
+    for _ in range(count):
+        limiter.wait()
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs fork')
+def test_rate_limiter_shared():
+    limiter = RateLimiter()
+    limiter.wait()
+    limiter.configure(50, shared=True)
+    start = time.time()
+    workers = [multiprocessing.get_context('fork').Process(target=_send_requests, args=(limiter, 5)) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    # 15 requests at 50 per second, the first one right away
+    assert time.time() - start >= 14 / 50
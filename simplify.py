@@ -0,0 +1,237 @@
+"""
+Simplified copies of the exported GPX tracks.
+
+GPX files downloaded with 'full=true' contain every recorded point, so multi-hour activities
+give files of several MB, which map tiles and web viewers load slowly. With option '--simplify'
+gcexport.py writes a smaller copy next to each new GPX file ('activity_1.simplified.gpx'), keeping
+the original. The method is given as a SPEC:
+
+- '5m':  Douglas-Peucker with a tolerance of 5 meters: a point is dropped if the track doesn't
+         deviate more than the tolerance from the line leaving it out
+- '10s': time based decimation: the first point of every 10 seconds is kept
+
+Each track segment is simplified on its own, its first and last points are always kept. The points
+are removed from the text of the GPX file, everything else (metadata, extensions, formatting)
+stays unchanged. The work is done by a pool of worker processes (SimplifyPool), so the downloads
+don't wait for it, unless the workers fall behind: only a few files per worker are queued at a time.
+
+NumPy is an optional dependency (pip install numpy), needed for '--simplify'.
+"""
+
+import logging
+import math
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from tracks import epoch_seconds
+
+# gcexport.py checks '--simplify' with a copy of this pattern (SIMPLIFY_SPEC_PATTERN), to start without this module
+SPEC_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)(m|s)$')
+
+# the name of the simplified copy is the name of the GPX file with this extension instead of '.gpx'
+SIMPLIFIED_EXTENSION = '.simplified.gpx'
+
+EARTH_RADIUS = 6371000.0
+
+_SEGMENT = re.compile(rb'(<trkseg\b[^>]*>)(.*?)(</trkseg>)', re.S)
+# a track point with the whitespace around it (on its lines)
+_POINT = re.compile(rb'[ \t]*<trkpt\b[^>]*?(?:/>|>.*?</trkpt>)[ \t]*(?:\r?\n)?', re.S)
+_LATITUDE = re.compile(rb'\blat\s*=\s*["\']([^"\']+)')
+_LONGITUDE = re.compile(rb'\blon\s*=\s*["\']([^"\']+)')
+_TIME = re.compile(rb'<time>([^<]+)</time>')
+
+
+def _numpy():
+    try:
+        import numpy  # pylint: disable=import-outside-toplevel
+    except ImportError as ex:
+        raise ImportError("Simplifying tracks needs the 'numpy' package (pip install numpy)") from ex
+    return numpy
+
+
+def parse_spec(spec):
+    """
+    Parse a simplification SPEC, see the module documentation
+
+    :return: tuple ('m', tolerance in meters) or ('s', interval in seconds)
+    :raise ValueError: for an invalid SPEC
+    """
+    match = SPEC_PATTERN.match(spec.strip())
+    if not match or float(match.group(1)) <= 0:
+        raise ValueError(f"Expected a tolerance like '5m' or an interval like '10s', not '{spec}'")
+    return match.group(2), float(match.group(1))
+
+
+def simplified_filename(filename):
+    """The name of the simplified copy of a GPX file"""
+    return os.path.splitext(filename)[0] + SIMPLIFIED_EXTENSION
+
+
+def douglas_peucker(x, y, tolerance):
+    """
+    The points kept by the Douglas-Peucker algorithm (iterative, the distances of a range are
+    computed at once)
+
+    :param x:         coordinates in meters (array)
+    :param y:         coordinates in meters (array)
+    :param tolerance: maximum distance in meters of a dropped point from the simplified line
+    :return:          boolean array, True for the points kept
+    """
+    numpy = _numpy()
+    keep = numpy.zeros(len(x), dtype=bool)
+    if len(x) == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    ranges = [(0, len(x) - 1)]
+    while ranges:
+        start, end = ranges.pop()
+        if end - start < 2:
+            continue
+        delta_x, delta_y = x[end] - x[start], y[end] - y[start]
+        length = math.hypot(delta_x, delta_y)
+        inner_x, inner_y = x[start + 1 : end] - x[start], y[start + 1 : end] - y[start]
+        if length > 0:
+            distances = numpy.abs(delta_x * inner_y - delta_y * inner_x) / length
+        else:
+            # a loop back to the start: the distance from the start
+            distances = numpy.hypot(inner_x, inner_y)
+        farthest = int(numpy.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = start + 1 + farthest
+            keep[middle] = True
+            ranges.append((start, middle))
+            ranges.append((middle, end))
+    return keep
+
+
+def decimate(time, interval):
+    """
+    The points kept by time based decimation: the first point of every 'interval' seconds (and
+    the last point); points without time are kept
+
+    :param time:     seconds (array, NaN for missing times)
+    :param interval: seconds
+    :return:         boolean array, True for the points kept
+    """
+    numpy = _numpy()
+    keep = numpy.isnan(time)
+    timed = numpy.flatnonzero(~keep)
+    if len(timed):
+        buckets = numpy.floor((time[timed] - time[timed[0]]) / interval)
+        keep[timed[numpy.concatenate(([True], buckets[1:] != buckets[:-1]))]] = True
+    if len(time):
+        keep[0] = keep[-1] = True
+    return keep
+
+
+def _keep_points(points, method, value):
+    """The points (regex matches) of a segment to keep"""
+    numpy = _numpy()
+    if method == 's':
+        times = [_TIME.search(point.group()) for point in points]
+        time = numpy.array([epoch_seconds(match.group(1).decode()) if match else math.nan for match in times])
+        return decimate(time, value)
+    latitude = numpy.radians([float(_LATITUDE.search(point.group()).group(1)) for point in points])
+    longitude = numpy.radians([float(_LONGITUDE.search(point.group()).group(1)) for point in points])
+    # equirectangular projection around the segment, precise enough for the distances within a track
+    x = EARTH_RADIUS * longitude * math.cos(float(numpy.mean(latitude)))
+    y = EARTH_RADIUS * latitude
+    return douglas_peucker(x, y, value)
+
+
+def simplify_gpx(data, spec):
+    """
+    Simplify the tracks of a GPX file
+
+    :param data: content of the GPX file (bytes)
+    :param spec: simplification SPEC, see 'parse_spec'
+    :return:     tuple (simplified GPX file (bytes), number of points before, number of points after)
+    """
+    method, value = parse_spec(spec)
+    counts = [0, 0]
+
+    def simplify_segment(segment):
+        body = segment.group(2)
+        points = list(_POINT.finditer(body))
+        if not points:
+            return segment.group()
+        keep = _keep_points(points, method, value)
+        counts[0] += len(points)
+        counts[1] += int(keep.sum())
+        kept = b''.join(point.group() for point, kept in zip(points, keep) if kept)
+        return segment.group(1) + body[: points[0].start()] + kept + body[points[-1].end() :] + segment.group(3)
+
+    simplified = _SEGMENT.sub(simplify_segment, data)
+    return simplified, counts[0], counts[1]
+
+
+# files queued per worker process at most, see 'SimplifyPool.submit'
+PENDING_PER_WORKER = 2
+
+
+class SimplifyPool:
+    """Simplifies GPX files in worker processes, see 'submit'"""
+
+    def __init__(self, workers=None):
+        """
+        :param workers: number of worker processes (default: one less than the number of CPUs)
+        """
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.errors = 0
+        self._executor = None
+        self._lock = threading.Lock()
+        # bounds the GPX files held in memory for the workers
+        self._pending = threading.BoundedSemaphore(self.workers * PENDING_PER_WORKER)
+
+    def _start(self):
+        """The executor, started on first use; the workers are started fresh (not forked from this process and its threads)"""
+        if self._executor is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(method))
+        return self._executor
+
+    def submit(self, data, spec, done):
+        """
+        Simplify the tracks of a GPX file in the background; waits while PENDING_PER_WORKER files per
+        worker are queued already
+
+        :param data: content of the GPX file (bytes)
+        :param spec: simplification SPEC, see 'parse_spec'
+        :param done: callback receiving the simplified GPX file (bytes), called in a background
+                     thread; not called if the file has no track points or the simplification fails
+        """
+        self._pending.acquire()  # pylint: disable=consider-using-with
+        try:
+            with self._lock:
+                future = self._start().submit(simplify_gpx, data, spec)
+        except BaseException:
+            self._pending.release()
+            raise
+
+        def finished(future):
+            try:
+                simplified, before, after = future.result()
+                if before:
+                    logging.debug('Track simplified from %s to %s points', before, after)
+                    done(simplified)
+            except Exception as ex:  # pylint: disable=broad-except
+                with self._lock:
+                    self.errors += 1
+                logging.error('Unable to simplify a track: %s', ex)
+            finally:
+                self._pending.release()
+
+        future.add_done_callback(finished)
+
+    def wait(self):
+        """
+        Wait until all submitted files are done (and their callbacks have returned) and stop the worker
+        processes (until the next 'submit')
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for simplify.py; Call them with this command line:
+
+py.test simplify_test.py
+"""
+
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from simplify import SimplifyPool, decimate, douglas_peucker, parse_spec, simplified_filename, simplify_gpx
+
+numpy = pytest.importorskip('numpy')
+
+
+def _gpx():
+    with open('test_output/activity_20190519532.gpx', 'rb') as gpx_file:
+        return gpx_file.read()
+
+
+def test_parse_spec():
+    assert parse_spec('5m') == ('m', 5)
+    assert parse_spec('2.5s') == ('s', 2.5)
+    for invalid in ('5', 'm', '0m', '-1s', '5km'):
+        with pytest.raises(ValueError):
+            parse_spec(invalid)
+    assert simplified_filename('/a/b/activity_1.gpx') == '/a/b/activity_1.simplified.gpx'
+
+
+def test_douglas_peucker():
+    # a straight line with a 10 m bump in the middle
+    x = numpy.arange(0, 101, 10.0)
+    y = numpy.zeros(11)
+    y[5] = 10
+    assert numpy.flatnonzero(douglas_peucker(x, y, 5)).tolist() == [0, 4, 5, 6, 10]
+    assert numpy.flatnonzero(douglas_peucker(x, y, 20)).tolist() == [0, 10]
+    # a loop back to the start
+    assert douglas_peucker(numpy.array([0.0, 50, 0]), numpy.array([0.0, 0, 0]), 5).tolist() == [True, True, True]
+
+
+def test_decimate():
+    time = numpy.array([0, 1, 2, 9, 10, 11, numpy.nan, 25, 26])
+    assert numpy.flatnonzero(decimate(time, 10)).tolist() == [0, 4, 6, 7, 8]
+
+
+def test_simplify_gpx():
+    data = _gpx()
+    simplified, before, after = simplify_gpx(data, '5m')
+    assert before == 4195 and 2 < after < 200
+    original = ET.fromstring(data)
+    result = ET.fromstring(simplified)
+    namespace = {'gpx': 'http://www.topografix.com/GPX/1/1'}
+    points = result.findall('.//gpx:trkpt', namespace)
+    assert len(points) == after
+    # first and last point kept, the metadata unchanged
+    assert points[0].attrib == original.find('.//gpx:trkpt', namespace).attrib
+    assert points[-1].attrib == original.findall('.//gpx:trkpt', namespace)[-1].attrib
+    assert simplified[: data.index(b'<trkpt')] == data[: data.index(b'<trkpt')]
+
+    simplified, before, after = simplify_gpx(data, '60s')
+    # 70 minutes
+    assert after == 71
+    assert simplify_gpx(b'<gpx></gpx>', '5m') == (b'<gpx></gpx>', 0, 0)
+
+
+def test_simplify_pool():
+    results = []
+    pool = SimplifyPool(workers=2)
+    pool.submit(_gpx(), '10m', results.append)
+    pool.submit(b'<gpx><trk><trkseg><trkpt lat="x" lon="1"></trkpt></trkseg></trk></gpx>', '10m', results.append)
+    pool.wait()
+    assert len(results) == 1 and pool.errors == 1
+
+
+def test_simplify_pool_bounds_pending_files(monkeypatch):
+    monkeypatch.setattr('simplify.PENDING_PER_WORKER', 1)
+    pool = SimplifyPool(workers=1)
+    results = []
+    for submitted in range(4):
+        pool.submit(_gpx(), '10m', results.append)
+        # the file is only queued when the ones before are done
+        assert len(results) >= submitted
+    pool.wait()
+    assert len(results) == 4 and pool.errors == 0
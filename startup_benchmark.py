@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark for gcexport.py.
+
+Measures the cold start cost that every cron invocation or container start pays: the time
+to import gcexport (with 'python -X importtime', in fresh interpreters) and the wall time of
+'gcexport.py --help'. It lists the most expensive imports and checks that the modules which
+gcexport.py imports lazily (garth and its dependencies, zipfile, ...) stay out of the startup.
+
+Usage example (fail if importing gcexport takes longer than 80 ms):
+
+    python startup_benchmark.py --runs 20 --budget 80 --json startup.json
+"""
+
+# Standard library imports
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# directory of gcexport.py
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# modules only needed by some code paths, which must not be imported at startup
+LAZY_MODULES = [
+    'garth', 'requests', 'pydantic', 'zipfile', 'http.cookiejar', 'urllib.request', 'quarantine', 'session_agent',
+    'simplify', 'tracks', 'geoindex', 'packfile', 'sharding', 'multiprocessing', 'concurrent.futures.process',
+    'xml.etree.ElementTree', 'mmap', 'hashlib',
+]  # fmt: skip
+
+
+def parse_importtime(stderr):
+    """
+    Parse the output of 'python -X importtime'
+
+    :param stderr: the standard error output of the interpreter
+    :return:       list of tuples (module name, nesting level, self microseconds, cumulative microseconds)
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:') :].split('|')
+        level = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), level, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def measure_import(module='gcexport'):
+    """Import 'module' in a fresh interpreter, return the list of imports (see 'parse_importtime')"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=SCRIPT_DIR, capture_output=True, text=True, check=True
+    )
+    return parse_importtime(result.stderr)
+
+
+def measure_help():
+    """Wall time in seconds of 'gcexport.py --help' in a fresh interpreter"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'gcexport.py', '--help'], cwd=SCRIPT_DIR, capture_output=True, check=True)
+    return time.perf_counter() - start
+
+
+def subtree(imports, module):
+    """
+    The imports caused by importing the top-level 'module' (excluding e.g. the ones of 'site');
+    importtime lists the nested imports before the importing module
+
+    :return: list of imports (see 'parse_importtime'), the last one is 'module' itself
+    """
+    end = next(index for index, (name, level, _, _) in enumerate(imports) if name == module and level == 0)
+    start = end
+    while start > 0 and imports[start - 1][1] > 0:
+        start -= 1
+    return imports[start : end + 1]
+
+
+def parse_arguments(argv):
+    """
+    Setup the argument parser and parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description='Measure the startup time of gcexport.py',
+        epilog='The first run only warms up the file system and bytecode caches and is not counted.',
+    )
+    # fmt: off
+    parser.add_argument('-n', '--runs', type=int, default=10,
+        help='number of measured runs (default: 10)')
+    parser.add_argument('--top', type=int, default=10,
+        help='number of most expensive imports to list (default: 10)')
+    parser.add_argument('--budget', type=float, metavar='MS',
+        help='exit with an error if the median import time of gcexport exceeds MS milliseconds')
+    parser.add_argument('--json', metavar='FILE',
+        help='also write the report as JSON to this file')
+    # fmt: on
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    """
+    Main entry point for startup_benchmark.py
+    """
+    options = parse_arguments(argv)
+
+    measure_import()
+    runs = [measure_import() for _ in range(options.runs)]
+    help_times = [measure_help() for _ in range(options.runs)]
+
+    runs = [subtree(imports, 'gcexport') for imports in runs]
+    import_times = [imports[-1][3] / 1000 for imports in runs]
+    median_run = runs[import_times.index(sorted(import_times)[len(import_times) // 2])]
+    imported = {name for name, _, _, _ in median_run}
+    # the direct imports of gcexport (modules already imported by the interpreter startup are not listed)
+    top = sorted((entry for entry in median_run if entry[1] == 1), key=lambda entry: -entry[3])[: options.top]
+
+    report = {
+        'python': sys.version.split()[0],
+        'runs': options.runs,
+        'import_ms_median': round(statistics.median(import_times), 1),
+        'import_ms_min': round(min(import_times), 1),
+        'help_ms_median': round(statistics.median(help_times) * 1000, 1),
+        'help_ms_min': round(min(help_times) * 1000, 1),
+        'modules_imported': len(imported),
+        'lazy_modules_imported': [name for name in LAZY_MODULES if name in imported],
+    }
+    for key, value in report.items():
+        print(f'{key:22} {value}')
+    print()
+    print(f"{'import':30} {'cumulative ms':>13} {'self ms':>8}")
+    for name, _, self_us, cumulative_us in top:
+        print(f'{name:30} {cumulative_us / 1000:13.1f} {self_us / 1000:8.1f}')
+    report['top_imports'] = [{'module': name, 'cumulative_ms': cum / 1000, 'self_ms': own / 1000} for name, _, own, cum in top]
+
+    if options.json:
+        with open(options.json, 'w', encoding='utf-8') as json_file:
+            json.dump(report, json_file, indent=2)
+
+    if report['lazy_modules_imported']:
+        print(f"\nImported at startup, but should be lazy: {', '.join(report['lazy_modules_imported'])}")
+        return 1
+    if options.budget is not None and report['import_ms_median'] > options.budget:
+        print(f"\nMedian import time {report['import_ms_median']} ms exceeds the budget of {options.budget} ms")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for startup_benchmark.py; Call them with this command line:
+
+py.test startup_benchmark_test.py
+"""
+
+from startup_benchmark import LAZY_MODULES, measure_import, parse_importtime, subtree
+
+IMPORTTIME = """import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   zipimport
+import time:       900 |       1020 | site
+import time:       300 |        300 |     _json
+import time:       400 |        700 |   json
+import time:      2000 |       2700 | gcexport
+"""
+
+
+def test_parse_importtime():
+    imports = parse_importtime(IMPORTTIME)
+    assert imports[0] == ('zipimport', 1, 120, 120)
+    assert imports[2] == ('_json', 2, 300, 300)
+    assert imports[-1] == ('gcexport', 0, 2000, 2700)
+
+
+def test_subtree():
+    assert [name for name, _, _, _ in subtree(parse_importtime(IMPORTTIME), 'gcexport')] == ['_json', 'json', 'gcexport']
+
+
+def test_startup_imports_no_lazy_modules():
+    imported = {name for name, _, _, _ in subtree(measure_import(), 'gcexport')}
+    assert not imported.intersection(LAZY_MODULES)
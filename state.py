@@ -0,0 +1,297 @@
+"""
+Persistent state of an export directory, kept in a SQLite database.
+
+The state survives between runs of gcexport.py (and is shared between concurrent
+workers); each feature keeps its data in its own tables.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+STATE_FILE_NAME = 'gcexport_state.sqlite'
+
+# states of the items in the work queue
+PENDING = 'pending'
+IN_FLIGHT = 'in-flight'
+DONE = 'done'
+FAILED = 'failed'
+
+# default time to live of the entries in the device registry
+DEVICE_TTL_DAYS = 30
+
+# time after which the cached property tables are revalidated with the server
+PROPERTIES_TTL_DAYS = 7
+
+# number of deferred writes committed together, see 'StateStore.defer'
+DEFERRED_MAX = 500
+
+
+class StateStore:
+    """Thread safe access to the SQLite database holding the persistent state"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.RLock()
+        # autocommit mode, transactions are started explicitly with 'transaction()'
+        self._conn = sqlite3.connect(filename, timeout=60, check_same_thread=False, isolation_level=None)
+        # writes not yet executed, see 'defer'
+        self._deferred = []
+
+    def close(self):
+        """Commit the deferred writes and close the database connection"""
+        with self._lock:
+            self.flush()
+            self._conn.close()
+
+    def execute(self, sql, params=()):
+        """Execute one SQL statement (after the deferred writes) and return all result rows"""
+        with self._lock:
+            self.flush()
+            return self._conn.execute(sql, params).fetchall()
+
+    def executemany(self, sql, seq_of_params):
+        """Execute one SQL statement for each parameter tuple"""
+        with self._lock:
+            self.flush()
+            self._conn.executemany(sql, seq_of_params)
+
+    def defer(self, sql, params=()):
+        """
+        Execute a write later, together with the other deferred writes in one transaction: once DEFERRED_MAX
+        writes are pending, before any other statement, and on 'flush' or 'close'. For the small writes made for
+        every activity, which would otherwise each be a transaction of their own (slow on network storage)
+        """
+        with self._lock:
+            self._deferred.append((sql, params))
+            if len(self._deferred) >= DEFERRED_MAX:
+                self.flush()
+
+    def flush(self):
+        """Commit the deferred writes"""
+        with self._lock:
+            deferred, self._deferred = self._deferred, []
+            if deferred:
+                with self.transaction():
+                    for sql, params in deferred:
+                        self._conn.execute(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        """Context manager grouping the statements of the block into one (committed or rolled back) transaction"""
+        with self._lock:
+            self.flush()
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+
+class WorkQueue:
+    """
+    The annotated activity list of a run (see 'annotate_activity_list' in gcexport.py),
+    persisted with a state per item, so that an interrupted run can be resumed
+    """
+
+    def __init__(self, store):
+        self.store = store
+        with store.transaction():
+            store.execute('CREATE TABLE IF NOT EXISTS queue_meta (key TEXT PRIMARY KEY, value TEXT)')
+            store.execute(
+                'CREATE TABLE IF NOT EXISTS queue_items ('
+                ' position INTEGER PRIMARY KEY, action TEXT, state TEXT, activity TEXT, error TEXT, updated REAL)'
+            )
+
+    def _meta(self, key):
+        rows = self.store.execute('SELECT value FROM queue_meta WHERE key = ?', (key,))
+        return json.loads(rows[0][0]) if rows else None
+
+    @property
+    def total(self):
+        """Number of items in the queue"""
+        return self.store.execute('SELECT COUNT(*) FROM queue_items')[0][0]
+
+    def counts(self):
+        """Dict with the number of items per state"""
+        return dict(self.store.execute('SELECT state, COUNT(*) FROM queue_items GROUP BY state'))
+
+    def replace(self, fingerprint, action_list):
+        """
+        Start a new queue for the given (complete) action list
+
+        :param fingerprint: JSON compatible description of the parameters that produced the action list
+        :param action_list: list of action items (dicts with 'index', 'action' and 'activity')
+        """
+        self.start(fingerprint)
+        self.add(action_list)
+        self.listed()
+
+    def start(self, fingerprint):
+        """
+        Start a new, empty queue; the action items are added page by page as the activity list is fetched
+        (see 'add'), and the queue can only be resumed once 'listed' is called
+
+        :param fingerprint: JSON compatible description of the parameters that produce the action list
+        """
+        with self.store.transaction():
+            self.store.execute('DELETE FROM queue_items')
+            self.store.execute('DELETE FROM queue_meta')
+            self.store.executemany(
+                'INSERT INTO queue_meta VALUES (?, ?)',
+                (('fingerprint', json.dumps(fingerprint, sort_keys=True)), ('created', json.dumps(time.time()))),
+            )
+
+    def add(self, action_items):
+        """Add action items (dicts with 'index', 'action' and 'activity') to the queue, e.g. of one page"""
+        now = time.time()
+        self.store.executemany(
+            'INSERT INTO queue_items VALUES (?, ?, ?, ?, NULL, ?)',
+            ((item['index'], item['action'], PENDING, json.dumps(item['activity']), now) for item in action_items),
+        )
+
+    def listed(self):
+        """Record that all the action items are in the queue"""
+        self.store.execute('INSERT OR REPLACE INTO queue_meta VALUES (?, ?)', ('listed', json.dumps(True)))
+
+    def resume(self, fingerprint, max_age):
+        """
+        Return the unfinished items of a previous run, if the queue was created with the
+        same parameters at most 'max_age' seconds ago and the whole action list was added (see
+        'listed'). Interrupted ('in-flight') and failed items are pending again.
+
+        :param fingerprint: JSON compatible description of the parameters of the current run
+        :param max_age:     maximum age of the queue in seconds
+        :return:            list of action items to process, None if there is nothing to resume
+        """
+        created = self._meta('created')
+        if created is None or self._meta('fingerprint') != json.loads(json.dumps(fingerprint, sort_keys=True)):
+            return None
+        # interrupted while the activity list was fetched: the activities of the later pages are missing
+        if not self._meta('listed'):
+            return None
+        if time.time() - created > max_age:
+            return None
+        with self.store.transaction():
+            self.store.execute('UPDATE queue_items SET state = ? WHERE state IN (?, ?)', (PENDING, IN_FLIGHT, FAILED))
+            rows = self.store.execute(
+                'SELECT position, action, activity FROM queue_items WHERE state = ? ORDER BY position', (PENDING,)
+            )
+        if not rows:
+            return None
+        return [{'index': position, 'action': action, 'activity': json.loads(activity)} for position, action, activity in rows]
+
+    def mark(self, index, state, error=None):
+        """Set the state (and error description for failed items) of the item with the given index (a deferred write)"""
+        self.store.defer(
+            'UPDATE queue_items SET state = ?, error = ?, updated = ? WHERE position = ?', (state, error, time.time(), index)
+        )
+
+
+class DeviceRegistry(MutableMapping):
+    """
+    Names of the devices (keyed by 'deviceApplicationInstallationId'), persisted so that
+    the device details are only downloaded again when an entry is older than 'ttl' seconds.
+
+    Usable as the 'device_dict' of gcexport.py; the fresh entries are loaded at startup,
+    entries added by concurrent workers sharing the database are found on lookup. A device
+    without a name (None, e.g. incomplete details) is only remembered by this instance, so the
+    next run tries again.
+    """
+
+    def __init__(self, store, ttl):
+        """
+        :param store: the StateStore holding the registry
+        :param ttl:   time to live of an entry in seconds
+        """
+        self.store = store
+        self.ttl = ttl
+        store.execute('CREATE TABLE IF NOT EXISTS devices (id TEXT PRIMARY KEY, name TEXT, updated REAL)')
+        rows = store.execute('SELECT id, name FROM devices WHERE updated >= ?', (time.time() - ttl,))
+        self._cache = dict(rows)
+
+    def __getitem__(self, key):
+        key = str(key)
+        if key in self._cache:
+            return self._cache[key]
+        rows = self.store.execute('SELECT name FROM devices WHERE id = ? AND updated >= ?', (key, time.time() - self.ttl))
+        if not rows:
+            raise KeyError(key)
+        self._cache[key] = rows[0][0]
+        return rows[0][0]
+
+    def __setitem__(self, key, name):
+        key = str(key)
+        if name is None:
+            self._cache[key] = None
+            return
+        self.store.execute('INSERT OR REPLACE INTO devices VALUES (?, ?, ?)', (key, name, time.time()))
+        self._cache[key] = name
+
+    def __delitem__(self, key):
+        key = str(key)
+        if key not in self:
+            raise KeyError(key)
+        self.store.execute('DELETE FROM devices WHERE id = ?', (key,))
+        self._cache.pop(key, None)
+
+    def __iter__(self):
+        rows = self.store.execute('SELECT id FROM devices WHERE updated >= ? ORDER BY id', (time.time() - self.ttl,))
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        return self.store.execute('SELECT COUNT(*) FROM devices WHERE updated >= ?', (time.time() - self.ttl,))[0][0]
+
+
+class PropertyCache:  # pylint: disable=too-few-public-methods
+    """
+    Lookup tables downloaded from Garmin Connect (e.g. the activity type names), stored
+    parsed, and revalidated with a conditional request (ETag / Last-Modified) once stale
+    """
+
+    def __init__(self, store, ttl):
+        """
+        :param store: the StateStore holding the cache
+        :param ttl:   time in seconds after which a table is revalidated
+        """
+        self.store = store
+        self.ttl = ttl
+        store.execute(
+            'CREATE TABLE IF NOT EXISTS properties (url TEXT PRIMARY KEY, tbl TEXT, etag TEXT, last_modified TEXT, fetched REAL)'
+        )
+
+    def get(self, url, fetch, parse):
+        """
+        Return the table for the given URL, downloading it only if it is unknown or stale (and changed)
+
+        :param url:   URL of the table
+        :param fetch: callback(url, headers) performing the (conditional) request, returning a tuple
+                      (body as string or None if not modified, dict of response headers)
+        :param parse: callback converting the body to a JSON compatible table
+        :return:      the parsed table
+        """
+        rows = self.store.execute('SELECT tbl, etag, last_modified, fetched FROM properties WHERE url = ?', (url,))
+        if rows and time.time() - rows[0][3] < self.ttl:
+            return json.loads(rows[0][0])
+
+        headers = {}
+        if rows and rows[0][1]:
+            headers['If-None-Match'] = rows[0][1]
+        if rows and rows[0][2]:
+            headers['If-Modified-Since'] = rows[0][2]
+        body, response_headers = fetch(url, headers)
+        if body is None and rows:
+            self.store.execute('UPDATE properties SET fetched = ? WHERE url = ?', (time.time(), url))
+            return json.loads(rows[0][0])
+
+        table = parse(body)
+        self.store.execute(
+            'INSERT OR REPLACE INTO properties VALUES (?, ?, ?, ?, ?)',
+            (url, json.dumps(table), response_headers.get('ETag'), response_headers.get('Last-Modified'), time.time()),
+        )
+        return table
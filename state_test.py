@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for state.py; Call them with this command line:
+
+py.test state_test.py
+"""
+
+import time
+
+from state import DEFERRED_MAX, DONE, FAILED, IN_FLIGHT, DeviceRegistry, PropertyCache, StateStore, WorkQueue
+
+FINGERPRINT = {'count': '5', 'format': 'gpx'}
+
+
+def action_list(count):
+    return [{'index': i, 'action': 'd', 'activity': {'activityId': 1000 + i}} for i in range(count)]
+
+
+def test_work_queue_resume(tmp_path):
+    queue = WorkQueue(StateStore(str(tmp_path / 'state.sqlite')))
+    assert queue.resume(FINGERPRINT, 3600) is None
+
+    queue.replace(FINGERPRINT, action_list(5))
+    queue.mark(0, DONE)
+    queue.mark(1, DONE)
+    queue.mark(2, FAILED, 'GarminException: No tries left')
+    queue.mark(3, IN_FLIGHT)
+    assert queue.counts() == {'done': 2, 'failed': 1, 'in-flight': 1, 'pending': 1}
+
+    # a new process opening the same database resumes with the failed, interrupted and pending items
+    resumed = WorkQueue(StateStore(str(tmp_path / 'state.sqlite'))).resume(FINGERPRINT, 3600)
+    assert [item['index'] for item in resumed] == [2, 3, 4]
+    assert resumed[0]['activity'] == {'activityId': 1002}
+    assert queue.total == 5
+
+
+def test_work_queue_not_resumed(tmp_path):
+    queue = WorkQueue(StateStore(str(tmp_path / 'state.sqlite')))
+    queue.replace(FINGERPRINT, action_list(2))
+
+    # other arguments
+    assert queue.resume({'count': '5', 'format': 'tcx'}, 3600) is None
+    # too old
+    assert queue.resume(FINGERPRINT, -1) is None
+
+    # nothing left to do
+    queue.mark(0, DONE)
+    queue.mark(1, DONE)
+    assert queue.resume(FINGERPRINT, 3600) is None
+
+
+def test_work_queue_by_pages(tmp_path):
+    queue = WorkQueue(StateStore(str(tmp_path / 'state.sqlite')))
+    queue.start(FINGERPRINT)
+    items = action_list(5)
+    queue.add(items[:3])
+    queue.mark(0, DONE)
+    # interrupted before the whole activity list was fetched
+    assert queue.resume(FINGERPRINT, 3600) is None
+
+    queue.add(items[3:])
+    queue.listed()
+    assert [item['index'] for item in queue.resume(FINGERPRINT, 3600)] == [1, 2, 3, 4]
+
+
+def test_deferred_writes(tmp_path):
+    store = StateStore(str(tmp_path / 'state.sqlite'))
+    other = StateStore(str(tmp_path / 'state.sqlite'))
+    store.execute('CREATE TABLE t (x INTEGER)')
+    for x in range(3):
+        store.defer('INSERT INTO t VALUES (?)', (x,))
+    # not committed yet, but executed before the next statement of the same store
+    assert other.execute('SELECT COUNT(*) FROM t') == [(0,)]
+    assert store.execute('SELECT COUNT(*) FROM t') == [(3,)]
+    assert other.execute('SELECT COUNT(*) FROM t') == [(3,)]
+
+    for x in range(DEFERRED_MAX + 1):
+        store.defer('INSERT INTO t VALUES (?)', (x,))
+    assert other.execute('SELECT COUNT(*) FROM t') == [(3 + DEFERRED_MAX,)]
+    store.close()
+    assert other.execute('SELECT COUNT(*) FROM t') == [(4 + DEFERRED_MAX,)]
+
+
+def test_device_registry_persists(tmp_path):
+    registry = DeviceRegistry(StateStore(str(tmp_path / 'state.sqlite')), 3600)
+    registry[3914387464] = 'fenix 5 10.0.0.0'
+    registry[12345] = 'Edge 1030'
+    # a device without a name is only known to this registry
+    registry[555] = None
+    assert registry['3914387464'] == 'fenix 5 10.0.0.0'
+    assert registry[555] is None
+
+    # a second process (or a concurrent worker) sees the entries with a name
+    other = DeviceRegistry(StateStore(str(tmp_path / 'state.sqlite')), 3600)
+    assert 3914387464 in other
+    assert 555 not in other
+    assert sorted(other) == ['12345', '3914387464']
+    registry[777] = 'Edge 530'
+    assert other[777] == 'Edge 530'
+
+    del other[12345]
+    assert len(other) == 2
+    assert 12345 not in DeviceRegistry(StateStore(str(tmp_path / 'state.sqlite')), 3600)
+
+
+def test_device_registry_ttl(tmp_path):
+    store = StateStore(str(tmp_path / 'state.sqlite'))
+    DeviceRegistry(store, 3600)[1] = 'old device'
+    store.execute('UPDATE devices SET updated = ?', (time.time() - 7200,))
+    registry = DeviceRegistry(store, 3600)
+    assert 1 not in registry
+    assert len(registry) == 0
+
+
+def test_property_cache_conditional_refresh(tmp_path):
+    store = StateStore(str(tmp_path / 'state.sqlite'))
+    requests = []
+
+    def fetch(url, headers):
+        requests.append(headers)
+        if headers.get('If-None-Match') == '"v1"':
+            return None, {}
+        return 'a=1\nb=2', {'ETag': '"v1"'}
+
+    def parse(body):
+        return dict(line.split('=') for line in body.splitlines())
+
+    assert PropertyCache(store, 3600).get('http://gc/props', fetch, parse) == {'a': '1', 'b': '2'}
+    assert requests == [{}]
+
+    # fresh: no request at all
+    assert PropertyCache(store, 3600).get('http://gc/props', fetch, parse) == {'a': '1', 'b': '2'}
+    assert len(requests) == 1
+
+    # stale: revalidated, the server answers 'not modified'
+    store.execute('UPDATE properties SET fetched = ?', (time.time() - 7200,))
+    assert PropertyCache(store, 3600).get('http://gc/props', fetch, parse) == {'a': '1', 'b': '2'}
+    assert requests[1] == {'If-None-Match': '"v1"'}
+    assert PropertyCache(store, 3600).get('http://gc/props', fetch, parse) == {'a': '1', 'b': '2'}
+    assert len(requests) == 2
@@ -45,6 +45,7 @@ def download_activities(count=200, start_date='2024-07-01'):
     
     cmd = [
         'python', 'gcexport.py',
+        '--agent',  # use the session agent if one is running (see session_agent.py)
         '-c', str(count),
         '-f', 'original',
         '-u',  # unzip files
@@ -0,0 +1,231 @@
+"""
+Reading the track points of the exported GPX and TCX files.
+
+The track points are read with 'iterparse', dropping every point once it has been read, so the
+memory used for the XML doesn't grow with the size of the file; the values are collected in typed
+arrays, one per field (see FIELDS), which are returned as NumPy arrays. Missing values (e.g. no
+elevation in the GPX file of a paddling activity, no heart rate without a sensor) are NaN.
+
+The arrays of all GPX and TCX files of an export directory can be saved next to the files, as
+'.npz' files (see numpy.load), using a process pool, so that analyses don't have to parse XML:
+
+    python tracks.py convert EXPORT_DIRECTORY [--workers N] [--force]
+    python tracks.py show ACTIVITY_FILE
+
+NumPy is an optional dependency (pip install numpy), it is only needed for the arrays.
+"""
+
+import argparse
+import array
+import logging
+import math
+import os
+import sys
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from fileio import atomic_writer
+
+# field -> type code of the array collecting it
+FIELDS = {'time': 'd', 'lat': 'd', 'lon': 'd', 'ele': 'f', 'hr': 'f', 'cad': 'f'}
+
+# the elements of a track point
+POINT_TAGS = {'trkpt', 'Trackpoint'}
+
+# local name of an element in a track point -> field (GPX with the Garmin TrackPointExtension, and TCX)
+FIELD_TAGS = {
+    'time': 'time',
+    'ele': 'ele',
+    'hr': 'hr',
+    'cad': 'cad',
+    'Time': 'time',
+    'LatitudeDegrees': 'lat',
+    'LongitudeDegrees': 'lon',
+    'AltitudeMeters': 'ele',
+    # the only 'Value' of a track point is the one of 'HeartRateBpm'
+    'Value': 'hr',
+    'Cadence': 'cad',
+    'RunCadence': 'cad',
+}
+
+TRACK_EXTENSIONS = ('.gpx', '.tcx')
+
+
+def _numpy():
+    try:
+        import numpy  # pylint: disable=import-outside-toplevel
+    except ImportError as ex:
+        raise ImportError("Track arrays need the 'numpy' package (pip install numpy)") from ex
+    return numpy
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def epoch_seconds(text):
+    """Seconds since 1970-01-01 of an ISO timestamp (times without offset are taken as UTC)"""
+    time = datetime.fromisoformat(text.strip().replace('Z', '+00:00'))
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return time.timestamp()
+
+
+def iter_trackpoints(source):
+    """
+    The track points of a GPX or TCX file, read incrementally
+
+    :param source: file name or binary file object
+    :return:       iterator over dicts field -> value (float), containing only the fields present
+    :raise xml.etree.ElementTree.ParseError: for invalid XML
+    """
+    stack = []
+    point = None
+    for event, element in ET.iterparse(source, events=('start', 'end')):
+        name = _local_name(element.tag)
+        if event == 'start':
+            stack.append(element)
+            if name in POINT_TAGS:
+                point = {}
+            continue
+        stack.pop()
+        if point is None:
+            continue
+        if name in POINT_TAGS:
+            for field in ('lat', 'lon'):
+                if field in element.attrib:
+                    point[field] = float(element.attrib[field])
+            yield point
+            point = None
+            # drop the point, the parent (track segment) keeps no children
+            element.clear()
+            if stack:
+                stack[-1].remove(element)
+        elif name in FIELD_TAGS and element.text and element.text.strip():
+            field = FIELD_TAGS[name]
+            point[field] = epoch_seconds(element.text) if field == 'time' else float(element.text)
+
+
+def read_track(source):
+    """
+    The track points of a GPX or TCX file as arrays
+
+    :param source: file name or binary file object; an empty file is an empty track
+    :return:       dict field (see FIELDS) -> NumPy array, with NaN for missing values
+    """
+    numpy = _numpy()
+    columns = {field: array.array(type_code) for field, type_code in FIELDS.items()}
+    if not isinstance(source, str) or os.path.getsize(source) > 0:
+        for point in iter_trackpoints(source):
+            for field, column in columns.items():
+                column.append(point.get(field, math.nan))
+    return {
+        field: numpy.frombuffer(column, dtype=numpy.float64 if column.typecode == 'd' else numpy.float32)
+        for field, column in columns.items()
+    }
+
+
+def array_filename(track_filename):
+    """The name of the '.npz' file with the arrays of a track file"""
+    return os.path.splitext(track_filename)[0] + '.npz'
+
+
+def convert_file(track_filename, force=False):
+    """
+    Save the arrays of a track file as '.npz' file next to it (unless it is newer than the track file)
+
+    :param track_filename: GPX or TCX file
+    :param force:          also convert if the '.npz' file is up to date
+    :return:               True if the file was converted
+    """
+    target = array_filename(track_filename)
+    if not force and os.path.isfile(target) and os.path.getmtime(target) >= os.path.getmtime(track_filename):
+        return False
+    arrays = read_track(track_filename)
+    with atomic_writer(target) as target_file:
+        _numpy().savez(target_file, **arrays)
+    return True
+
+
+def _convert_file(arguments):
+    """'convert_file' for the process pool: tuple (file name, True if converted, error or None)"""
+    track_filename, force = arguments
+    try:
+        return track_filename, convert_file(track_filename, force), None
+    except (ET.ParseError, ValueError, OSError) as ex:
+        return track_filename, False, f'{type(ex).__name__}: {ex}'
+
+
+def track_files(directory):
+    """The GPX and TCX files in a directory and its subdirectories, sorted"""
+    return sorted(
+        os.path.join(path, filename)
+        for path, _, filenames in os.walk(directory)
+        for filename in filenames
+        if os.path.splitext(filename)[1].lower() in TRACK_EXTENSIONS
+    )
+
+
+def convert_directory(directory, workers=None, force=False):
+    """
+    Save the arrays of all track files in a directory (and its subdirectories), see 'convert_file'
+
+    :param directory: export directory
+    :param workers:   number of worker processes (default: number of CPUs)
+    :param force:     also convert the files whose '.npz' file is up to date
+    :return:          tuple (number of files converted, number of files up to date, number of failures)
+    """
+    _numpy()
+    filenames = track_files(directory)
+    converted = current = failed = 0
+    with ProcessPoolExecutor(workers) as executor:
+        for filename, done, error in executor.map(_convert_file, [(name, force) for name in filenames], chunksize=16):
+            if error:
+                logging.warning('Unable to convert %s: %s', filename, error)
+                failed += 1
+            elif done:
+                converted += 1
+            else:
+                current += 1
+    return converted, current, failed
+
+
+def parse_arguments(argv):
+    """
+    Setup the argument parser and parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Track arrays from the GPX and TCX files of the Garmin Connect Exporter')
+    commands = parser.add_subparsers(dest='command', required=True)
+    convert_parser = commands.add_parser('convert', help='save the arrays of the track files in a directory as .npz files')
+    convert_parser.add_argument('directory', help='export directory')
+    convert_parser.add_argument('--workers', type=int,
+        help='number of worker processes (default: number of CPUs)')  # fmt: skip
+    convert_parser.add_argument('--force', action='store_true',
+        help='also convert the files whose .npz file is up to date')  # fmt: skip
+    show_parser = commands.add_parser('show', help='show a summary of the track of a GPX or TCX file')
+    show_parser.add_argument('file', help='GPX or TCX file')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    """
+    Main entry point for tracks.py
+    """
+    args = parse_arguments(argv)
+    if args.command == 'convert':
+        converted, current, failed = convert_directory(args.directory, args.workers, args.force)
+        print(f'{converted} track files converted, {current} up to date, {failed} failed')
+        return 1 if failed else 0
+    numpy = _numpy()
+    track = read_track(args.file)
+    print(f'{len(track["time"])} track points')
+    for field, values in track.items():
+        present = values[~numpy.isnan(values)]
+        if len(present):
+            print(f'{field:>5}: {len(present)} values, {present.min()} .. {present.max()}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
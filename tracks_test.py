@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for tracks.py; Call them with this command line:
+
+py.test tracks_test.py
+"""
+
+import io
+import os
+import shutil
+
+import pytest
+
+from tracks import convert_directory, iter_trackpoints, main, read_track
+
+numpy = pytest.importorskip('numpy')
+
+TCX = b'''<?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"
+    xmlns:ns3="http://www.garmin.com/xmlschemas/ActivityExtension/v2">
+  <Activities><Activity Sport="Running"><Id>2018-03-08T10:23:22.000Z</Id>
+    <Lap StartTime="2018-03-08T10:23:22.000Z">
+      <AverageHeartRateBpm><Value>140</Value></AverageHeartRateBpm>
+      <Track>
+        <Trackpoint>
+          <Time>2018-03-08T10:23:22.000Z</Time>
+          <Position><LatitudeDegrees>47.1</LatitudeDegrees><LongitudeDegrees>7.2</LongitudeDegrees></Position>
+          <AltitudeMeters>432.5</AltitudeMeters>
+          <HeartRateBpm><Value>120</Value></HeartRateBpm>
+          <Extensions><ns3:TPX><ns3:RunCadence>85</ns3:RunCadence></ns3:TPX></Extensions>
+        </Trackpoint>
+        <Trackpoint>
+          <Time>2018-03-08T10:23:23.000Z</Time>
+          <AltitudeMeters>433</AltitudeMeters>
+        </Trackpoint>
+      </Track>
+    </Lap>
+  </Activity></Activities>
+</TrainingCenterDatabase>'''
+
+
+def test_read_track_gpx():
+    track = read_track('test_output/activity_20190519532.gpx')
+    assert set(track) == {'time', 'lat', 'lon', 'ele', 'hr', 'cad'}
+    assert all(len(values) == 4195 for values in track.values())
+    assert track['time'].dtype == numpy.float64 and track['hr'].dtype == numpy.float32
+    # 2025-08-27T02:45:12.000Z
+    assert track['time'][0] == 1756262712
+    assert track['lat'][0] == pytest.approx(-31.92128213)
+    assert track['lon'][0] == pytest.approx(115.94252441)
+    assert track['hr'][:2].tolist() == [99, 100]
+    # no elevation and cadence in this file
+    assert numpy.isnan(track['ele']).all() and numpy.isnan(track['cad']).all()
+
+
+def test_read_track_tcx():
+    points = list(iter_trackpoints(io.BytesIO(TCX)))
+    assert points == [
+        {'time': 1520504602.0, 'lat': 47.1, 'lon': 7.2, 'ele': 432.5, 'hr': 120.0, 'cad': 85.0},
+        {'time': 1520504603.0, 'ele': 433.0},
+    ]
+    track = read_track(io.BytesIO(TCX))
+    assert track['ele'].tolist() == [432.5, 433]
+    assert numpy.isnan(track['hr'][1])
+
+
+def test_convert_directory(tmp_path, capsys):
+    os.makedirs(tmp_path / '2025')
+    shutil.copy('test_output/activity_20190519532.gpx', tmp_path / '2025')
+    with open(tmp_path / 'activity_2.tcx', 'wb') as tcx_file:
+        tcx_file.write(TCX)
+    # written empty by gcexport.py if Garmin has no TCX file
+    open(tmp_path / 'activity_3.tcx', 'wb').close()
+    with open(tmp_path / 'activity_4.gpx', 'wb') as invalid_file:
+        invalid_file.write(b'<gpx><trk>')
+
+    assert convert_directory(str(tmp_path), workers=2) == (3, 0, 1)
+    with numpy.load(tmp_path / '2025' / 'activity_20190519532.npz') as arrays:
+        assert len(arrays['lat']) == 4195
+    with numpy.load(tmp_path / 'activity_3.npz') as arrays:
+        assert len(arrays['time']) == 0
+    # the arrays are up to date
+    assert convert_directory(str(tmp_path), workers=2) == (0, 3, 1)
+
+    assert main(['tracks.py', 'show', str(tmp_path / 'activity_2.tcx')]) == 0
+    assert '2 track points' in capsys.readouterr().out